@@ -0,0 +1,347 @@
+"""
+Benchmarks for the package's hot paths. They run headless: an IPython shell is created
+without a frontend and `IPython.display.display` is replaced with a no-op.
+
+Usage:
+```
+python benchmarks/hot_paths.py [-k FILTER] [--repeat 5] [--save-baseline]
+  [--baseline benchmarks/baseline.json] [--threshold 0.2]
+```
+For each benchmark, the median time over `--repeat` runs and the throughput are
+printed, along with the peak memory allocated during one run (measured separately
+with tracemalloc, which NumPy reports its allocations to). If a baseline file exists,
+each result is compared with it and any which is more than `--threshold` slower (or
+uses that much more memory) is flagged; the exit status is 1 if there are any
+regressions. `--save-baseline` writes the results as the new baseline. Baselines are
+machine-specific, so create one on the machine you compare on.
+"""
+
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+from IPython import display
+from IPython.core.interactiveshell import InteractiveShell
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(REPO_DIR))
+# the magics modules register themselves with the running shell when imported
+InteractiveShell.instance()
+display.display = lambda *args, **kwargs: None
+
+from jupyter_magics import save_load  # noqa: E402
+from jupyter_magics import visualization_magic as vm  # noqa: E402
+
+try:
+    import torch
+    torch_imported = True
+except ImportError:
+    torch_imported = False
+
+DEFAULT_BASELINE = Path(__file__).resolve().parent / "baseline.json"
+# a benchmark returns a function to time plus the amount of work one call does
+Benchmark = Callable[[str], Tuple[Callable[[], None], float, str]]
+BENCHMARKS: Dict[str, Benchmark] = {}
+
+
+class SkipBenchmark(Exception):
+    """Raised by a benchmark whose dependencies aren't available."""
+
+
+def benchmark(name: str) -> Callable[[Benchmark], Benchmark]:
+    def register(func: Benchmark) -> Benchmark:
+        BENCHMARKS[name] = func
+        return func
+
+    return register
+
+
+def _frames(n_frames: int, height: int = 84, width: int = 84) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (n_frames, height, width, 3), dtype=np.uint8)
+
+
+@benchmark("normalize_img/uint8_hwc")
+def bench_normalize_uint8(tmp_dir: str):
+    img = _frames(1, 256, 256)[0]
+    n = 50_000
+    return lambda: [vm.normalize_img(img) for _ in range(n)], n, "images"
+
+
+@benchmark("normalize_img/float_chw")
+def bench_normalize_float_chw(tmp_dir: str):
+    img = np.random.default_rng(0).random((3, 256, 256), dtype=np.float32)
+    n = 50_000
+    return lambda: [vm.normalize_img(img) for _ in range(n)], n, "images"
+
+
+@benchmark("normalize_img/torch_chw")
+def bench_normalize_torch(tmp_dir: str):
+    if not torch_imported:
+        raise SkipBenchmark("torch isn't installed")
+    img = torch.rand(3, 256, 256)
+    n = 1_000
+    return lambda: [vm.normalize_img(img) for _ in range(n)], n, "images"
+
+
+@benchmark("normalize_imgs/float_bchw")
+def bench_normalize_batch(tmp_dir: str):
+    imgs = np.random.default_rng(0).random((64, 3, 128, 128), dtype=np.float32)
+    out = np.empty((64, 128, 128, 3), np.uint8)
+    n = 20
+    return (
+        lambda: [vm.normalize_imgs(imgs, out=out) for _ in range(n)],
+        64 * n,
+        "images",
+    )
+
+
+def _bench_visualizer(**kwargs):
+    frames = _frames(1000)
+
+    def run() -> None:
+        visualizer = vm.Visualizer(**kwargs)
+        for frame in frames:
+            visualizer(frame)
+        visualizer.close()
+
+    return run, len(frames), "frames"
+
+
+@benchmark("Visualizer/holoviews")
+def bench_visualizer_hv(tmp_dir: str):
+    if not vm.hv_imported:
+        raise SkipBenchmark("holoviews isn't installed")
+    return _bench_visualizer()
+
+
+@benchmark("Visualizer/holoviews_max_fps")
+def bench_visualizer_hv_rate_limited(tmp_dir: str):
+    if not vm.hv_imported:
+        raise SkipBenchmark("holoviews isn't installed")
+    return _bench_visualizer(max_fps=30)
+
+
+@benchmark("Visualizer/holoviews_multi_32")
+def bench_visualizer_hv_multi(tmp_dir: str):
+    if not vm.hv_imported:
+        raise SkipBenchmark("holoviews isn't installed")
+    batches = _frames(20 * 32).reshape(20, 32, 84, 84, 3)
+    renderer = vm.hv.renderer("bokeh")
+
+    def run() -> None:
+        # render to a bokeh plot (which each update then refreshes) instead of
+        # displaying, so that building the plot is timed too
+        shown = []
+        vm.display.display = shown.append
+        try:
+            visualizer = vm.Visualizer(multi=True, n_cols=8, tile_labels=True)
+            visualizer(batches[0])
+        finally:
+            vm.display.display = display.display
+        renderer.get_plot(shown[0])
+        for batch in batches[1:]:
+            visualizer(batch)
+        visualizer.close()
+
+    return run, len(batches), "batches"
+
+
+@benchmark("Visualizer/widget")
+def bench_visualizer_widget(tmp_dir: str):
+    if importlib.util.find_spec("ipywidgets") is None:
+        raise SkipBenchmark("ipywidgets isn't installed")
+    return _bench_visualizer(backend="widget")
+
+
+@benchmark("Recorder/ffmpeg")
+def bench_recorder(tmp_dir: str):
+    if not vm.ffmpeg_path:
+        raise SkipBenchmark("ffmpeg isn't installed")
+    frames = _frames(300, 128, 128)
+
+    def run() -> None:
+        recorder = vm.Recorder(fps=30, backend="ffmpeg", max_inline_mb=1000)
+        for frame in frames:
+            recorder.add_frame(frame)
+        recorder.to_video()
+
+    return run, len(frames), "frames"
+
+
+@benchmark("save_frames+from_files/frames")
+def bench_frames_round_trip(tmp_dir: str):
+    if not vm.hv_imported:
+        raise SkipBenchmark("holoviews isn't installed")
+    frames = _frames(1000)
+    fname = os.path.join(tmp_dir, "frames")
+
+    def run() -> None:
+        vm.save_frames(frames, fname)
+        vm.Visualizer.from_files(fname)
+
+    return run, len(frames), "frames"
+
+
+@benchmark("save_frames+open_frames/npy.gz")
+def bench_legacy_round_trip(tmp_dir: str):
+    frames = _frames(1000)
+    fname = os.path.join(tmp_dir, "frames.npy.gz")
+
+    def run() -> None:
+        vm.save_frames(frames, fname)
+        for _ in vm.open_frames(fname):
+            pass
+
+    return run, len(frames), "frames"
+
+
+def _bench_save_load(tmp_dir: str, obj, n_bytes: int, options: str = ""):
+    """:param options: passed to both `%save` and `%load` (e.g. "--mmap")"""
+    path = os.path.join(tmp_dir, "obj.pkl")
+
+    def run() -> None:
+        save_load.save(f"{options} obj {path}", {"obj": obj})
+        save_load.load(f"{options} {path}")
+
+    return run, n_bytes / 2**20, "MiB"
+
+
+@benchmark("save+load/array")
+def bench_save_load_array(tmp_dir: str):
+    array = np.random.default_rng(0).standard_normal((2048, 4096)).astype(np.float32)
+    return _bench_save_load(tmp_dir, array, array.nbytes)
+
+
+@benchmark("save+load/array_mmap")
+def bench_save_load_mmap(tmp_dir: str):
+    array = np.random.default_rng(0).standard_normal((2048, 4096)).astype(np.float32)
+    return _bench_save_load(tmp_dir, array, array.nbytes, "--mmap")
+
+
+@benchmark("save+load/dict_of_arrays")
+def bench_save_load_dict(tmp_dir: str):
+    rng = np.random.default_rng(0)
+    obj = {f"layer{i}": rng.standard_normal((256, 256)) for i in range(64)}
+    return _bench_save_load(tmp_dir, obj, sum(a.nbytes for a in obj.values()))
+
+
+@benchmark("save+load/python_objects")
+def bench_save_load_objects(tmp_dir: str):
+    obj = [{"step": i, "reward": float(i), "info": str(i)} for i in range(100_000)]
+    return _bench_save_load(tmp_dir, obj, 100_000 * 100)
+
+
+@benchmark("updating_curve/update")
+def bench_updating_curve(tmp_dir: str):
+    if not vm.hv_imported:
+        raise SkipBenchmark("holoviews isn't installed")
+    data = np.random.default_rng(0).random((100_000, 8))
+
+    def run() -> None:
+        _, update = vm.updating_curve()
+        for row in data:
+            update(row)
+        update.flush()
+
+    return run, len(data), "updates"
+
+
+def run_benchmark(
+    name: str, bench: Benchmark, repeat: int, tmp_dir: str
+) -> Optional[Dict[str, float]]:
+    try:
+        run, amount, unit = bench(tmp_dir)
+    except SkipBenchmark as e:
+        print(f"{name:32} skipped ({e})")
+        return None
+    run()  # warm up (imports, caches, ...)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    run()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    seconds = statistics.median(times)
+    return {
+        "seconds": seconds,
+        "throughput": amount / seconds,
+        "unit": unit,
+        "peak_bytes": peak_bytes,
+    }
+
+
+def compare(result: Dict[str, float], baseline: Dict[str, float], threshold: float):
+    """:returns: a description of how `result` regressed from `baseline`, if it did"""
+    regressions = []
+    time_ratio = result["seconds"] / baseline["seconds"]
+    if time_ratio > 1 + threshold:
+        regressions.append(f"{time_ratio:.2f}x time")
+    # ignore small absolute changes in memory
+    extra_bytes = result["peak_bytes"] - baseline["peak_bytes"]
+    if extra_bytes > max(threshold * baseline["peak_bytes"], 2**20):
+        regressions.append(f"+{extra_bytes / 2 ** 20:.1f} MiB peak")
+    return ", ".join(regressions)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("-k", "--filter", default="", help="Only run matching names.")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--baseline", type=Path, default=DEFAULT_BASELINE)
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--threshold", type=float, default=0.2)
+    args = parser.parse_args()
+
+    baseline = {}
+    if args.baseline.exists() and not args.save_baseline:
+        baseline = json.loads(args.baseline.read_text())
+
+    results = {}
+    n_regressions = 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, bench in BENCHMARKS.items():
+            if args.filter not in name:
+                continue
+            result = run_benchmark(name, bench, args.repeat, tmp_dir)
+            if result is None:
+                continue
+            results[name] = result
+            line = (
+                f"{name:32} {result['seconds'] * 1000:10.1f} ms "
+                f"{result['throughput']:12,.0f} {result['unit']}/s "
+                f"{result['peak_bytes'] / 2 ** 20:9.1f} MiB peak"
+            )
+            if name in baseline:
+                regression = compare(result, baseline[name], args.threshold)
+                if regression:
+                    n_regressions += 1
+                    line += f"  REGRESSION ({regression})"
+                else:
+                    line += f"  ({result['seconds'] / baseline[name]['seconds']:.2f}x)"
+            print(line, flush=True)
+
+    if args.save_baseline:
+        # keep results for benchmarks which weren't run this time
+        old = json.loads(args.baseline.read_text()) if args.baseline.exists() else {}
+        args.baseline.write_text(json.dumps({**old, **results}, indent=2) + "\n")
+        print(f"Saved baseline to {args.baseline}.")
+    if n_regressions:
+        print(f"{n_regressions} regression(s).")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
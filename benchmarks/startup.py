@@ -0,0 +1,75 @@
+"""
+Compare kernel startup cost of loading jupyter_magics eagerly (importing every module,
+as when they were copied into the IPython startup directory) vs. as a lazy extension.
+
+Usage:
+```
+python benchmarks/startup.py [--repeat 5]
+```
+Each measurement runs in a new interpreter and times the step after an IPython shell
+has been created, so only the cost of the magics themselves is included.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+MODULES = [
+    "bell_magic",
+    "save_load",
+    "test_magic",
+    "visualization_magic",
+    "background_magic",
+]
+
+_SETUP = """
+import time
+from IPython.core.interactiveshell import InteractiveShell
+shell = InteractiveShell.instance()
+start = time.perf_counter()
+"""
+EAGER = _SETUP + f"""
+for module in {MODULES!r}:
+    try:
+        __import__("jupyter_magics." + module)
+    except Exception:  # missing optional dependencies
+        pass
+print(time.perf_counter() - start)
+"""
+LAZY = _SETUP + """
+shell.extension_manager.load_extension("jupyter_magics")
+print(time.perf_counter() - start)
+"""
+
+
+def time_startup(code: str, repeat: int) -> float:
+    """:returns: the median number of seconds `code` reports over `repeat` runs"""
+    times = []
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, "-c", code],
+            cwd=REPO_DIR,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    eager = time_startup(EAGER, args.repeat)
+    lazy = time_startup(LAZY, args.repeat)
+    print(f"eager imports:  {eager * 1000:8.1f} ms")
+    print(f"lazy extension: {lazy * 1000:8.1f} ms ({eager / lazy:.0f}x faster)")
+
+
+if __name__ == "__main__":
+    main()
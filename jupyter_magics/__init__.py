@@ -0,0 +1,83 @@
+"""
+IPython extension which makes all of the magics in this package available:
+```
+%load_ext jupyter_magics
+```
+or, to load it in every kernel, add `"jupyter_magics"` to
+`c.InteractiveShellApp.extensions` in `~/.ipython/profile_default/ipython_config.py`.
+
+Loading the extension only registers small stubs; the module which implements a magic
+(and heavy dependencies like holoviews or requests) is imported the first time one of
+its magics is used, at which point the stubs are replaced by the real magics. Each
+module can also be loaded on its own, e.g. `%load_ext jupyter_magics.save_load`.
+"""
+
+import importlib
+import sys
+from typing import Any, Callable, Optional
+
+from IPython.core.error import UsageError
+
+# magic name -> (module, magic kind, needs local scope, no variable expansion)
+_MAGICS = {
+    "img": ("visualization_magic", "line", True, True),
+    "anim": ("visualization_magic", "cell", False, True),
+    "notify": ("bell_magic", "line_cell", False, False),
+    "save": ("save_load", "line", True, False),
+    "saves": ("save_load", "line", False, False),
+    "load": ("save_load", "line", False, False),
+    "cache": ("save_load", "cell", False, False),
+    "cache_stats": ("save_load", "line", False, False),
+    "background": ("background_magic", "cell", False, False),
+    "jobs": ("background_magic", "line", False, False),
+    "job_result": ("background_magic", "line", False, False),
+    "notebook_path": ("background_magic", "line", False, False),
+    "set_test_path": ("test_magic", "line", False, False),
+    "print_test_path": ("test_magic", "line", False, False),
+    "add_test": ("test_magic", "line", False, False),
+    "add_benchmark": ("test_magic", "line", False, False),
+}
+
+
+def _make_stub(ipython, name: str, module: str, local_scope: bool, no_var_expand: bool):
+    def stub(line: str, cell: Optional[str] = None, local_ns=None) -> Any:
+        module_name = f"{__name__}.{module}"
+        if module_name in sys.modules:
+            # importing it again wouldn't register anything
+            sys.modules[module_name].load_ipython_extension(ipython)
+        else:
+            importlib.import_module(module_name)  # registers its magics on import
+        kind = "line" if cell is None else "cell"
+        magic: Callable = ipython.magics_manager.magics[kind].get(name, stub)
+        if magic is stub:
+            raise UsageError(
+                f"{__name__}.{module} didn't register %{name}; is one of its "
+                "dependencies missing?"
+            )
+        args = (line,) if cell is None else (line, cell)
+        if getattr(magic, "needs_local_scope", False):
+            return magic(*args, local_ns=local_ns)
+        return magic(*args)
+
+    stub.__name__ = name
+    stub.__doc__ = f"Imports {__name__}.{module} and runs its %{name} magic."
+    if local_scope:
+        stub.needs_local_scope = True
+    if no_var_expand:
+        stub._ipython_magic_no_var_expand = True
+    return stub
+
+
+def load_ipython_extension(ipython) -> None:
+    loaded = set()
+    for name, (module, kind, local_scope, no_var_expand) in _MAGICS.items():
+        module_name = f"{__name__}.{module}"
+        if module_name in sys.modules:
+            # already imported (e.g. by `%reload_ext` or a direct import), so register
+            # the real magics rather than stubs which could never be replaced
+            if module_name not in loaded:
+                sys.modules[module_name].load_ipython_extension(ipython)
+                loaded.add(module_name)
+            continue
+        stub = _make_stub(ipython, name, module, local_scope, no_var_expand)
+        ipython.register_magic_function(stub, magic_kind=kind, magic_name=name)
@@ -1,71 +1,547 @@
 """
-Adds a magic to IPython which will run all of the code in the current notebook up until
-the current cell in a new process.
-Put this file in, e.g., ~/.ipython/profile_default/startup to load this magic on startup.
+Adds a magic to IPython which will run the current cell in a new process.
+
+By default, all of the code in the notebook up until the current cell is re-run
+(`--mode replay`). Alternatively, the kernel can be forked so the new process starts
+from the current in-memory state and only runs the body of the cell (`--mode fork`), or
+only the variables the cell uses can be pickled into a fresh interpreter
+(`--mode serialize`).
+Cells are run as jobs in a bounded pool; use `%jobs` to see their status and
+`%job_result N` to get a job's result back.
+Load it with `%load_ext jupyter_magics` (or just this module with
+`%load_ext jupyter_magics.background_magic`).
 """
 
+import ast
+import itertools
 import json
+import os
 import os.path
+import pickle
+import queue
 import re
+import select
+import signal
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, TimeoutError, as_completed
+from contextlib import nullcontext
+from functools import lru_cache, partial
 from os.path import dirname
-from subprocess import Popen
-from tempfile import NamedTemporaryFile
-from time import sleep
-from typing import Optional
+from subprocess import STDOUT, Popen
+from types import ModuleType
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Set, Tuple
 from urllib.parse import urljoin
 
 import ipykernel
 import requests
-from IPython.core.magic import register_cell_magic
-from notebook.notebookapp import list_running_servers
+from IPython import get_ipython
+from IPython.core.displaypub import DisplayPublisher
+from IPython.core.error import UsageError
+from IPython.core.magic_arguments import argument, magic_arguments, parse_argstring
+
+from jupyter_magics.def_use import DefUseVisitor
+
+try:
+    from jupyter_server.serverapp import list_running_servers as jupyter_server_servers
+    jupyter_server_imported = True
+except ImportError:
+    jupyter_server_imported = False
+try:
+    from notebook.notebookapp import list_running_servers as notebook_servers
+    notebook_imported = True
+except ImportError:
+    notebook_imported = False
+try:
+    import cloudpickle
+    cloudpickle_imported = True
+except ImportError:
+    cloudpickle_imported = False
+try:
+    import psutil
+    psutil_imported = True
+except ImportError:
+    psutil_imported = False
+
+
+# where the notebook's path can be given directly (e.g. on machines where the notebook
+# server can't be reached); `%notebook_path path` takes precedence over this
+NOTEBOOK_PATH_ENV = "JUPYTER_MAGICS_NOTEBOOK_PATH"
+_notebook_path: Optional[str] = None
+# kernel id -> (notebook path, server it came from, ETag of the server's response, time
+# it was last checked) for paths found by querying the notebook servers
+_notebook_path_cache: Dict[str, Tuple[str, Dict[str, Any], Optional[str], float]] = {}
+# cached paths are used without asking the server again for this many seconds
+_NOTEBOOK_PATH_TTL = 30
+
+
+def _kernel_id() -> Optional[str]:
+    try:
+        connection_file = ipykernel.connect.get_connection_file()
+    except Exception:  # not running in a kernel
+        return None
+    match = re.search("kernel-(.*).json", connection_file)
+    return match.group(1) if match else None
+
+
+def _list_running_servers() -> List[Dict[str, Any]]:
+    servers = []
+    if jupyter_server_imported:
+        servers.extend(jupyter_server_servers())
+    if notebook_imported:
+        servers.extend(notebook_servers())
+    return servers
+
+
+def _get_sessions(
+    server: Dict[str, Any], timeout: float, etag: Optional[str] = None
+) -> requests.Response:
+    """
+    :param etag: the ETag of an earlier response; if the sessions haven't changed since,
+      the server answers 304 (Not Modified) without a body
+    """
+    return requests.get(
+        urljoin(server["url"], "api/sessions"),
+        params={"token": server.get("token", "")},
+        headers={"If-None-Match": etag} if etag else {},
+        timeout=timeout,
+    )
+
+
+def _session_path(
+    server: Dict[str, Any], response: requests.Response, kernel_id: str
+) -> Optional[str]:
+    """Return the path of the notebook using `kernel_id` in a list of sessions."""
+    try:
+        sessions = response.json()
+    except ValueError:
+        return None
+    for session in sessions:
+        if session["kernel"]["id"] == kernel_id:
+            relative_path = session.get("path") or session["notebook"]["path"]
+            root_dir = server.get("root_dir") or server["notebook_dir"]
+            return os.path.join(root_dir, relative_path)
+    return None
+
+
+def _query_server(
+    server: Dict[str, Any], kernel_id: str, timeout: float
+) -> Optional[Tuple[str, Optional[str]]]:
+    """
+    Return the path of the notebook using `kernel_id` and the ETag of the server's
+    response if `server` is running it.
+    """
+    try:
+        response = _get_sessions(server, timeout)
+    except requests.RequestException:
+        return None
+    path = _session_path(server, response, kernel_id)
+    return (path, response.headers.get("ETag")) if path else None
+
+
+def _cached_notebook_path(kernel_id: str, timeout: float) -> Optional[str]:
+    """
+    Return the cached path of the notebook using `kernel_id` if it's still current.
+
+    After `_NOTEBOOK_PATH_TTL` seconds, the server the path came from is asked again
+    (with the ETag of its last answer, so if nothing changed it only answers "not
+    modified"). If that server can't be reached, the path is used as long as the file
+    exists. Stale entries are removed.
+    """
+    if kernel_id not in _notebook_path_cache:
+        return None
+    path, server, etag, checked = _notebook_path_cache[kernel_id]
+    if time.time() - checked < _NOTEBOOK_PATH_TTL and os.path.exists(path):
+        return path
+    try:
+        response = _get_sessions(server, timeout, etag)
+    except requests.RequestException:
+        return path if os.path.exists(path) else None
+    if response.status_code == 304:
+        new_path = path
+    else:
+        new_path = _session_path(server, response, kernel_id)
+        etag = response.headers.get("ETag")
+    if new_path is None:
+        del _notebook_path_cache[kernel_id]
+        return None
+    _notebook_path_cache[kernel_id] = (new_path, server, etag, time.time())
+    return new_path
+
+
+def _find_notebook_path_offline() -> Optional[str]:
+    """Find the notebook's path from sources that don't need a notebook server."""
+    path = _notebook_path or os.environ.get(NOTEBOOK_PATH_ENV)
+    if path:
+        return os.path.abspath(path)
+    # VS Code sets this in the user namespace
+    shell = get_ipython()
+    path = shell.user_ns.get("__vsc_ipynb_file__") if shell else None
+    if path and os.path.exists(path):
+        return path
+    # set by jupyter_server (>= 2.0) when it starts a kernel; usually an absolute path,
+    # but may be relative to the server's root, which isn't known here
+    path = os.environ.get("JPY_SESSION_NAME")
+    if path:
+        for candidate in [path, os.path.join(os.getcwd(), os.path.basename(path))]:
+            if os.path.isabs(candidate) and os.path.exists(candidate):
+                return candidate
+    return None
 
 
 # copied from jupyter_utils.py so that we can use the magic in kernels where
 # jupyter_utils isn't installed
-def get_notebook_path() -> Optional[str]:
+def get_notebook_path(timeout: float = 1) -> Optional[str]:
     """
     Return the full path of the jupyter notebook.
 
-    From https://github.com/jupyter/notebook/issues/1000#issuecomment-359875246.
+    The path set with `%notebook_path`, the `JUPYTER_MAGICS_NOTEBOOK_PATH` environment
+    variable, VS Code's `__vsc_ipynb_file__`, and `JPY_SESSION_NAME` are checked first.
+    Otherwise, all running notebook servers are asked (in parallel) which notebook
+    this kernel belongs to. The answer is cached; it's checked again with the server
+    it came from (see `_cached_notebook_path`) once it's older than
+    `_NOTEBOOK_PATH_TTL` seconds (e.g. in case the notebook was renamed).
+    Adapted from https://github.com/jupyter/notebook/issues/1000#issuecomment-359875246.
+    :param timeout: seconds to wait for each server
     :returns: the full path to the notebook or None if the path couldn't be found
-      (the latter shouldn't happen)
-    """
-    kernel_id = re.search(
-        "kernel-(.*).json", ipykernel.connect.get_connection_file()
-    ).group(1)
-    servers = list_running_servers()
-    for server in servers:
-        response = requests.get(
-            urljoin(server["url"], "api/sessions"), params={"token": server.get("token", "")}
+    """
+    path = _find_notebook_path_offline()
+    if path:
+        return path
+
+    kernel_id = _kernel_id()
+    if kernel_id is None:
+        return None
+    path = _cached_notebook_path(kernel_id, timeout)
+    if path:
+        return path
+
+    servers = _list_running_servers()
+    if not servers:
+        return None
+    pool = ThreadPoolExecutor(len(servers))
+    futures = {
+        pool.submit(_query_server, server, kernel_id, timeout): server
+        for server in servers
+    }
+    try:
+        for future in as_completed(futures, timeout=timeout * 2):
+            found = future.result()
+            if found:
+                path, etag = found
+                _notebook_path_cache[kernel_id] = (
+                    path,
+                    futures[future],
+                    etag,
+                    time.time(),
+                )
+                return path
+    except TimeoutError:
+        pass
+    finally:
+        # don't wait for servers which haven't answered
+        pool.shutdown(wait=False)
+    return None
+
+
+def notebook_path(line: str) -> Optional[str]:
+    """
+    Usage: %notebook_path [path]
+    Set the path of the current notebook (used by `%%background --mode replay`) or, if
+    no path is given, return the path that will be used.
+    """
+    global _notebook_path
+    if line.strip():
+        _notebook_path = os.path.abspath(os.path.expanduser(line.strip()))
+        return None
+    return get_notebook_path()
+
+
+# run by `sys.executable` for `--mode serialize` jobs; the job's directory holds the
+# pickled variables and the cell
+_SERIALIZE_SCRIPT = """
+import importlib
+import os
+import pickle
+import sys
+
+from IPython.core.interactiveshell import InteractiveShell
+
+try:
+    from cloudpickle import dumps
+except ImportError:
+    from pickle import dumps
+
+job_dir = sys.argv[1]
+state_fname = os.path.join(job_dir, "state.pkl")
+with open(state_fname, "rb") as f:
+    modules, state, return_names = pickle.load(f)
+os.remove(state_fname)
+with open(os.path.join(job_dir, "cell.py")) as f:
+    cell = f.read()
+
+shell = InteractiveShell.instance()
+for name, module in modules.items():
+    shell.user_ns[name] = importlib.import_module(module)
+# each variable was pickled separately
+for name, data in state.items():
+    shell.user_ns[name] = pickle.loads(data)
+result = shell.run_cell(cell)
+if not result.success:
+    sys.exit(1)
+returns = {name: shell.user_ns[name] for name in return_names if name in shell.user_ns}
+with open(os.path.join(job_dir, "result.pkl.tmp"), "wb") as f:
+    f.write(dumps((result.result, returns)))
+os.replace(os.path.join(job_dir, "result.pkl.tmp"), os.path.join(job_dir, "result.pkl"))
+"""
+
+# names IPython defines in the user namespace which shouldn't be sent to the new process
+_IPYTHON_NAMES = {"In", "Out", "get_ipython", "exit", "quit"}
+# the output history (_, __, ___, _3), input history (_i, _ii, _iii, _i3, _ih), _oh,
+# _dh, the exit code of the last `!command`, and module attributes like __name__
+_IPYTHON_NAME_PATTERN = re.compile(r"_{1,3}|_i{1,3}|_i?\d+|_[iod]h|_exit_code|__\w+__")
+
+
+def _is_ipython_name(name: str) -> bool:
+    return name in _IPYTHON_NAMES or _IPYTHON_NAME_PATTERN.fullmatch(name) is not None
+
+
+def _maxrss_bytes(ru_maxrss: int) -> int:
+    # ru_maxrss is in bytes on macOS and KiB elsewhere
+    return ru_maxrss if sys.platform == "darwin" else ru_maxrss * 1024
+
+
+def _wait_pid(pid: int) -> Tuple[int, float, int]:
+    """
+    Wait for the child process `pid` to exit.
+
+    :returns: its exit code (negative if it was killed by a signal, like
+      `Popen.returncode`), CPU time in seconds, and peak resident memory in bytes
+    """
+    _, status, rusage = os.wait4(pid, 0)
+    return (
+        os.waitstatus_to_exitcode(status),
+        rusage.ru_utime + rusage.ru_stime,
+        _maxrss_bytes(rusage.ru_maxrss),
+    )
+
+
+def _process_usage(pid: int) -> Optional[Tuple[float, int]]:
+    """
+    :returns: the CPU seconds and resident memory in bytes of a running process (from
+      psutil if it's installed, otherwise from /proc) or None if they can't be read
+    """
+    if psutil_imported:
+        try:
+            process = psutil.Process(pid)
+            with process.oneshot():
+                times = process.cpu_times()
+                return times.user + times.system, process.memory_info().rss
+        except psutil.Error:
+            return None
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # fields 3 onwards (the command name before them can contain spaces)
+            fields = f.read().rpartition(")")[2].split()
+        with open(f"/proc/{pid}/statm") as f:
+            rss_pages = int(f.read().split()[1])
+        # utime and stime are fields 14 and 15, in clock ticks
+        cpu_ticks = int(fields[11]) + int(fields[12])
+    except (OSError, IndexError, ValueError):
+        return None
+    return cpu_ticks / os.sysconf("SC_CLK_TCK"), rss_pages * os.sysconf("SC_PAGE_SIZE")
+
+
+class Job:
+    """
+    A cell run by `%%background`. Its stdout, stderr, and result are written to files in
+    `job_dir` (or stdout and stderr both to `output`, if given).
+    """
+
+    def __init__(
+        self,
+        job_id: int,
+        mode: str,
+        cell: str,
+        job_dir: str,
+        params: Dict[str, Any],
+        output: Optional[str] = None,
+    ):
+        self.id = job_id
+        self.mode = mode
+        self.cell = cell
+        self.dir = job_dir
+        self.params = params
+        self.stdout = output or os.path.join(job_dir, "stdout.txt")
+        self.stderr = output or os.path.join(job_dir, "stderr.txt")
+        self.status = "queued"
+        self.pid: Optional[int] = None
+        self.returncode: Optional[int] = None
+        # CPU seconds and peak resident memory in bytes, once the job has finished
+        self.cpu_time: Optional[float] = None
+        self.max_rss: Optional[int] = None
+        self.start_time: Optional[float] = None
+        self.end_time: Optional[float] = None
+        # called by the job manager to start the process; returns its pid
+        self._launch: Optional[Callable[[], int]] = None
+        # called instead of _launch if the job is killed while queued
+        self._discard: Callable[[], None] = lambda: None
+        # called (after _launch) to wait for the process to exit; returns its exit
+        # code, CPU time, and peak memory (see `_wait_pid`)
+        self._reap: Callable[[], Tuple[int, float, int]] = lambda: _wait_pid(self.pid)
+        self._done = threading.Event()
+
+    @property
+    def result_fname(self) -> str:
+        return os.path.join(self.dir, "result.pkl")
+
+    def usage(self) -> Tuple[Optional[float], Optional[int]]:
+        """
+        :returns: CPU seconds and memory use in bytes: the current resident memory
+          while the job is running and its peak once it has finished (either can be
+          None if it isn't known, e.g. for a queued job)
+        """
+        if self.status == "running" and self.pid is not None:
+            usage = _process_usage(self.pid)
+            if usage is not None:
+                return usage
+        return self.cpu_time, self.max_rss
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        return self._done.wait(timeout)
+
+    def describe(self) -> str:
+        if self.params:
+            return ", ".join(f"{name}={value!r}" for name, value in self.params.items())
+        return next((line for line in self.cell.splitlines() if line.strip()), "")
+
+
+class JobManager:
+    """
+    Runs at most `max_workers` jobs at once; other jobs wait in a queue. A dispatcher
+    thread starts queued jobs as slots free up, and each running job has a thread
+    which waits for its process to exit and records its resource usage.
+    """
+
+    def __init__(self, max_workers: int = os.cpu_count() or 1, jobs_dir: str = ""):
+        self.max_workers = max_workers
+        self.jobs_dir = jobs_dir or os.path.join(
+            tempfile.gettempdir(), f"jupyter_jobs_{os.getpid()}"
         )
-        for notebook in json.loads(response.text):
-            if notebook["kernel"]["id"] == kernel_id:
-                relative_path = notebook["notebook"]["path"]
-                return os.path.join(server["notebook_dir"], relative_path)
+        self.jobs: Dict[int, Job] = {}
+        self._queue: "queue.Queue[Job]" = queue.Queue()
+        self._n_running = 0
+        self._slots = threading.Condition()
+        self._dispatcher = threading.Thread(target=self._dispatch, daemon=True)
+        self._dispatcher.start()
 
+    def new_job(
+        self,
+        mode: str,
+        cell: str,
+        params: Dict[str, Any],
+        output: Optional[str] = None,
+    ) -> Job:
+        job_id = len(self.jobs) + 1
+        job_dir = os.path.join(self.jobs_dir, str(job_id))
+        os.makedirs(job_dir, exist_ok=True)
+        job = Job(job_id, mode, cell, job_dir, params, output)
+        self.jobs[job_id] = job
+        return job
 
-@register_cell_magic
-def background(line: str, cell: str):
+    def submit(self, job: Job) -> None:
+        self._queue.put(job)
+
+    def set_max_workers(self, max_workers: int) -> None:
+        with self._slots:
+            self.max_workers = max_workers
+            self._slots.notify_all()
+
+    def kill(self, job: Job) -> None:
+        if job.status == "running":
+            try:
+                os.killpg(job.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass  # it just exited
+        if job.status in ("queued", "running"):
+            job.status = "killed"
+
+    def _dispatch(self) -> None:
+        while True:
+            job = self._queue.get()
+            with self._slots:
+                while self._n_running >= self.max_workers and job.status != "killed":
+                    self._slots.wait(timeout=1)
+                if job.status == "killed":
+                    job._discard()
+                    job._done.set()
+                    continue
+                self._n_running += 1
+            job.start_time = time.time()
+            try:
+                job.pid = job._launch()
+            except Exception:
+                with open(job.stderr, "a") as f:
+                    traceback.print_exc(file=f)
+                job.status = "failed"
+                job.end_time = time.time()
+                self._release(job)
+                continue
+            job.status = "running"
+            threading.Thread(target=self._wait, args=(job,), daemon=True).start()
+
+    def _wait(self, job: Job) -> None:
+        try:
+            job.returncode, job.cpu_time, job.max_rss = job._reap()
+        except Exception:
+            with open(job.stderr, "a") as f:
+                traceback.print_exc(file=f)
+        job.end_time = time.time()
+        if job.status != "killed":
+            job.status = "done" if job.returncode == 0 else "failed"
+        self._release(job)
+
+    def _release(self, job: Job) -> None:
+        with self._slots:
+            self._n_running -= 1
+            self._slots.notify()
+        job._done.set()
+
+
+_job_manager: Optional[JobManager] = None
+
+
+def get_job_manager() -> JobManager:
+    global _job_manager
+    if _job_manager is None:
+        _job_manager = JobManager()
+    return _job_manager
+
+
+def _replay_code(nb_fname: str, slice_cells: bool = False) -> str:
     """
     Any cells with cell magics will be skipped (in case it's something like %%bash) as
     will any lines with line magics. The exception is that the rest of the code in the
     cell that's running this magic will be included.
+    :param slice_cells: only include the earlier cells which the `%%background` cell
+      depends on (see `_slice_cells`)
     """
-    nb_fname = get_notebook_path()
-    if nb_fname is None:
-        raise RuntimeError("Unable to find path to current notebook.")
-
     with open(nb_fname) as f:
         nb = json.load(f)
 
-    code = ""
-
-    terminate = False
+    cells = []
     for cell in nb["cells"]:
         # skip markdown and empty code cells
         if cell["cell_type"] != "code" or not cell["source"]:
             continue
 
+        terminate = False
         if cell["source"][0].startswith("%%"):
             if cell["source"][0].startswith("%%background"):  # end after this cell
                 cell["source"] = cell["source"][1:]  # skip the line with the magic
@@ -73,26 +549,597 @@ def background(line: str, cell: str):
             else:  # skip cells with any other cell magics; this might, e.g., be something like %%bash
                 continue
 
-            if cell["source"][0].startswith("%%"):
-                if cell["source"][0].startswith("%%background"):  # end after this cell
-                    cell["source"] = cell["source"][1:]  # skip the line with the magic
-                    terminate = True
-                else:  # skip cells with any other cell magics; this might, e.g., be something like %%bash
-                    continue
+        # skip line magics
+        cells.append(
+            "".join([line for line in cell["source"] if not line.startswith("%")])
+        )
+        if terminate:
+            break
+    if slice_cells:
+        cells = _slice_cells(cells)
+    return "\n".join(cells) + "\n"
+
+
+@lru_cache(maxsize=1024)
+def _cell_names(
+    source: str,
+) -> Optional[Tuple[FrozenSet[str], FrozenSet[str], FrozenSet[str], bool]]:
+    """
+    Return (binds, mutates, uses, has star import) for a cell's code (see
+    `DefUseVisitor`) or None if it can't be parsed. Cached by the cell's content.
+    """
+    try:
+        tree = ast.parse(source)
+    except SyntaxError:
+        return None
+    visitor = DefUseVisitor()
+    visitor.visit(tree)
+    return (
+        frozenset(visitor.binds),
+        frozenset(visitor.mutates),
+        frozenset(visitor.uses),
+        visitor.star_import,
+    )
+
+
+def _slice_cells(cells: List[str]) -> List[str]:
+    """
+    Return the cells which the last cell depends on (including itself), in order.
+
+    Going backwards from the last cell, a cell is kept if it binds or might modify a
+    name that a kept cell uses; the names it uses are then needed too. Cells which
+    can't be parsed or have star imports are always kept. This misses dependencies
+    that aren't visible by name (e.g. `os.chdir` or seeding a random number
+    generator) unless the name involved is needed anyway.
+    """
+    names = [_cell_names(cell) for cell in cells]
+    needed = set()
+    keep = set()
+    # a cell kept later in the pass can make an earlier-skipped (i.e. later in the
+    # notebook) cell needed, e.g. one that modifies a variable a kept function uses,
+    # so repeat until nothing changes
+    changed = True
+    while changed:
+        changed = False
+        for i in reversed(range(len(cells))):
+            if i in keep:
+                continue
+            if names[i] is None:
+                keep.add(i)
+                continue
+            binds, mutates, uses, star_import = names[i]
+            is_target = i == len(cells) - 1
+            if is_target or star_import or not needed.isdisjoint(binds | mutates):
+                keep.add(i)
+                changed |= not needed.issuperset(uses | mutates)
+                needed |= uses | mutates
+    return [cell for i, cell in enumerate(cells) if i in keep]
+
+
+def _used_names(code: str) -> Set[str]:
+    """
+    Return the names which `code` reads (a superset of the variables it needs).
+    :param code: Python code (i.e. after IPython's transformations)
+    """
+    names = set()
+    for node in ast.walk(ast.parse(code)):
+        if isinstance(node, ast.Name) and not isinstance(node.ctx, ast.Store):
+            names.add(node.id)
+        elif isinstance(node, ast.AugAssign) and isinstance(node.target, ast.Name):
+            names.add(node.target.id)
+    return names
+
+
+def _exec_with_result(code: str, namespace: Dict[str, Any]) -> Any:
+    """Run `code` in `namespace` and return the value of its last expression (if any)."""
+    tree = ast.parse(code)
+    last_expr = None
+    if tree.body and isinstance(tree.body[-1], ast.Expr):
+        last_expr = ast.Expression(tree.body.pop().value)
+    exec(compile(tree, "<background>", "exec"), namespace)
+    if last_expr is not None:
+        return eval(compile(last_expr, "<background>", "eval"), namespace)
+
+
+def _dumps(obj: Any) -> bytes:
+    return cloudpickle.dumps(obj) if cloudpickle_imported else pickle.dumps(obj)
+
+
+class _ForkServer:
+    """
+    A fork of the kernel, made when a `%%background` cell is run, which forks a process
+    for each of the cell's jobs once the job manager starts it.
+
+    Forking the kernel once per cell gives every job of a sweep the variables as they
+    were when the cell was run, without a forked copy of the kernel per queued job.
+    The server reads the index of each job to start from one pipe (and exits once that
+    pipe is closed and its jobs have finished). Only the server can wait for the jobs'
+    processes, so it reports "started <index> <pid>" and "exited <pid> <wait status>
+    <CPU seconds> <max rss>" through another pipe, which a thread in the kernel reads.
+    """
+
+    # the kernel's ends of every server's pipes, which servers forked later close
+    _kernel_fds: Set[int] = set()
+
+    def __init__(self, jobs: List[Job], code: str, return_names: List[str]):
+        self._n_pending = len(jobs)  # jobs neither started nor discarded yet
+        self._pending_lock = threading.Lock()
+        self._pids: Dict[int, int] = {}  # job index -> pid
+        self._exits: Dict[int, Tuple[int, float, int]] = {}  # pid -> `_wait_pid` result
+        self._exited = False
+        self._status = threading.Condition()
+        command_read, self._command_fd = os.pipe()
+        status_read, status_write = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        self.pid = os.fork()
+        if self.pid == 0:
+            os.close(self._command_fd)
+            os.close(status_read)
+            self._serve(jobs, code, return_names, command_read, status_write)
+        os.close(command_read)
+        os.close(status_write)
+        self._kernel_fds.update((self._command_fd, status_read))
+        threading.Thread(
+            target=self._read_status, args=(status_read,), daemon=True
+        ).start()
+        for idx, job in enumerate(jobs):
+            job._launch = partial(self._launch, job, idx)
+            job._discard = self._resolve
+
+    def _launch(self, job: Job, idx: int) -> int:
+        try:
+            os.write(self._command_fd, f"{idx}\n".encode())
+        finally:
+            self._resolve()
+        with self._status:
+            while idx not in self._pids:
+                if self._exited:
+                    raise RuntimeError("The fork server exited early.")
+                self._status.wait()
+            pid = self._pids.pop(idx)
+        job._reap = partial(self._reap, pid)
+        return pid
+
+    def _resolve(self) -> None:
+        """Record that a job was started or discarded; the last one stops the server."""
+        with self._pending_lock:
+            self._n_pending -= 1
+            if self._n_pending == 0:
+                self._kernel_fds.discard(self._command_fd)
+                os.close(self._command_fd)
+
+    def _reap(self, pid: int) -> Tuple[int, float, int]:
+        with self._status:
+            while pid not in self._exits:
+                if self._exited:
+                    raise RuntimeError("The fork server exited early.")
+                self._status.wait()
+            return self._exits.pop(pid)
+
+    def _read_status(self, fd: int) -> None:
+        status = open(fd)
+        try:
+            for line in status:
+                kind, *values = line.split()
+                with self._status:
+                    if kind == "started":
+                        self._pids[int(values[0])] = int(values[1])
+                    else:
+                        pid, wait_status, cpu_time, max_rss = values
+                        self._exits[int(pid)] = (
+                            os.waitstatus_to_exitcode(int(wait_status)),
+                            float(cpu_time),
+                            int(max_rss),
+                        )
+                    self._status.notify_all()
+        finally:
+            # reap the server even if a message couldn't be read (once the pipe is
+            # closed, writing to it fails and the server exits)
+            self._kernel_fds.discard(fd)
+            status.close()
+            os.waitpid(self.pid, 0)
+            with self._status:
+                self._exited = True
+                self._status.notify_all()
+
+    def _serve(
+        self,
+        jobs: List[Job],
+        code: str,
+        return_names: List[str],
+        command_fd: int,
+        status_fd: int,
+    ) -> None:
+        """The server's main loop (in the forked process); never returns."""
+        exit_code = 1
+        try:
+            for fd in self._kernel_fds:
+                try:
+                    os.close(fd)  # so other servers see their command pipe close
+                except OSError:
+                    pass
+            os.setsid()  # don't get the kernel's interrupts
+            signal.signal(signal.SIGINT, signal.default_int_handler)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            # the kernel's sys.stdout and sys.stderr send messages on its sockets
+            sys.stdout = sys.stderr = open(2, "w", buffering=1, closefd=False)
+            status = open(status_fd, "w", buffering=1)
+            unread = b""
+            n_running = 0
+            commands_open = True
+            while commands_open or n_running:
+                wait_options = 0
+                if commands_open:
+                    wait_options = os.WNOHANG
+                    if select.select([command_fd], [], [], 0.1)[0]:
+                        data = os.read(command_fd, 4096)
+                        commands_open = bool(data)
+                        *lines, unread = (unread + data).split(b"\n")
+                        for line in lines:
+                            job = jobs[int(line)]
+                            pid = os.fork()
+                            if pid == 0:
+                                _run_forked_job(
+                                    job, code, return_names, (command_fd, status_fd)
+                                )
+                            try:
+                                # (the job does this too; whichever runs first wins)
+                                os.setpgid(pid, pid)
+                            except OSError:
+                                pass
+                            status.write(f"started {line.decode()} {pid}\n")
+                            n_running += 1
+                while n_running:
+                    pid, wait_status, rusage = os.wait4(-1, wait_options)
+                    if not pid:
+                        break
+                    n_running -= 1
+                    cpu_time = rusage.ru_utime + rusage.ru_stime
+                    max_rss = _maxrss_bytes(rusage.ru_maxrss)
+                    status.write(f"exited {pid} {wait_status} {cpu_time} {max_rss}\n")
+            exit_code = 0
+        except BaseException:
+            traceback.print_exc()
+        finally:
+            os._exit(exit_code)
+
+
+def _prepare_forked(jobs: List[Job], code: str, return_names: List[str]) -> None:
+    """
+    Fork the kernel now, so the jobs see the current variables, but only fork a
+    process for each job once the job manager starts it (see `_ForkServer`).
+    """
+    _ForkServer(jobs, code, return_names)
+
+
+def _redirect_output(job: Job) -> None:
+    """Send this process's stdout and stderr (including file descriptors) to the job's."""
+    flags = os.O_WRONLY | os.O_CREAT | os.O_TRUNC
+    stdout_fd = os.open(job.stdout, flags, 0o644)
+    stderr_fd = stdout_fd if job.stderr == job.stdout else os.open(job.stderr, flags)
+    os.dup2(stdout_fd, 1)
+    os.dup2(stderr_fd, 2)
+    for fd in {stdout_fd, stderr_fd}:
+        os.close(fd)
+    sys.stdout = open(1, "w", buffering=1, closefd=False)
+    sys.stderr = open(2, "w", buffering=1, closefd=False)
+
+
+def _run_forked_job(
+    job: Job, code: str, return_names: List[str], server_fds: Tuple[int, ...]
+) -> None:
+    """Run a fork mode job (in a process forked by a `_ForkServer`); never returns."""
+    # the kernel's sockets belong to the kernel, so send all output to files and leave
+    # with os._exit so that none of its exit handlers run
+    exit_code = 1
+    try:
+        os.setpgid(0, 0)  # so that killing the job also kills processes it started
+        for fd in server_fds:
+            os.close(fd)
+        _redirect_output(job)
+        shell = get_ipython()
+        shell.display_pub = DisplayPublisher(shell=shell)
+        namespace = shell.user_ns
+        namespace.update(job.params)
+        result = _exec_with_result(code, namespace)
+        returns = {name: namespace[name] for name in return_names if name in namespace}
+        with open(job.result_fname + ".tmp", "wb") as f:
+            f.write(_dumps((result, returns)))
+        os.replace(job.result_fname + ".tmp", job.result_fname)
+        exit_code = 0
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        try:
+            sys.stdout.flush()
+            sys.stderr.flush()
+        finally:
+            os._exit(exit_code)
+
+
+def _prepare_serialized(
+    job: Job, code: str, extra_names: List[str], return_names: List[str]
+) -> None:
+    """
+    Pickle the variables `code` uses now; the job will run the cell with them in a new
+    interpreter.
+    """
+    user_ns = get_ipython().user_ns
+    names = (_used_names(code) | set(extra_names)) - set(job.params)
+    modules = {}
+    # name -> pickled value; each variable is pickled on its own so that one which
+    # can't be pickled is skipped without pickling the rest twice
+    state = {name: _dumps(value) for name, value in job.params.items()}
+    skipped = []
+    for name in sorted(names):
+        if _is_ipython_name(name) or name not in user_ns:
+            continue
+        value = user_ns[name]
+        if isinstance(value, ModuleType):
+            modules[name] = value.__name__
+            continue
+        try:
+            state[name] = _dumps(value)
+        except Exception as e:
+            skipped.append(f"{name} ({type(e).__name__}: {e})")
+    if skipped:
+        print(
+            "These variables couldn't be pickled and won't be defined in the background"
+            " process: " + ", ".join(skipped)
+        )
+
+    with open(os.path.join(job.dir, "state.pkl"), "wb") as f:
+        pickle.dump((modules, state, return_names), f)
+    with open(os.path.join(job.dir, "cell.py"), "w") as f:
+        f.write(job.cell)
+    script = os.path.join(job.dir, "run.py")
+    with open(script, "w") as f:
+        f.write(_SERIALIZE_SCRIPT)
+    job._launch = lambda: _popen(job, [sys.executable, script, job.dir])
+
+
+def _prepare_replay(job: Job, slice_cells: bool = False) -> None:
+    nb_fname = get_notebook_path()
+    if nb_fname is None:
+        raise RuntimeError(
+            "Unable to find path to current notebook; set it with `%notebook_path path`"
+            f" or the {NOTEBOOK_PATH_ENV} environment variable."
+        )
+    script = os.path.join(job.dir, "replay.py")
+    with open(script, "w") as f:
+        f.write(_replay_code(nb_fname, slice_cells))
+    # execute code from the notebook's directory in case relative paths are used
+    job._launch = lambda: _popen(job, [sys.executable, script], cwd=dirname(nb_fname))
+
+
+def _popen(job: Job, command: List[str], cwd: Optional[str] = None) -> int:
+    same_file = job.stderr == job.stdout
+    with open(job.stdout, "w") as stdout, (
+        nullcontext(STDOUT) if same_file else open(job.stderr, "w")
+    ) as stderr:
+        process = Popen(
+            command, stdout=stdout, stderr=stderr, cwd=cwd, start_new_session=True
+        )
+
+    def reap() -> Tuple[int, float, int]:
+        # os.wait4 (rather than process.wait) also gets the resource usage; tell
+        # `process` it has been waited for so that it never waits for the pid again
+        returncode, cpu_time, max_rss = _wait_pid(process.pid)
+        process.returncode = returncode
+        return returncode, cpu_time, max_rss
+
+    job._reap = reap
+    return process.pid
+
+
+def _parse_sweep(sweep: List[str], user_ns: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    :param sweep: strings like "lr=[0.1, 0.01]"; the values are evaluated in `user_ns`
+    :returns: one dict of parameters for each element of the cartesian product of the
+      values
+    """
+    names = []
+    values = []
+    for spec in sweep:
+        name, sep, expr = spec.partition("=")
+        if not sep or not name.strip().isidentifier():
+            raise UsageError(f"--sweep takes name=values, not {spec!r}.")
+        names.append(name.strip())
+        values.append(list(eval(expr, user_ns)))
+    return [dict(zip(names, combo)) for combo in itertools.product(*values)]
+
+
+@magic_arguments()
+@argument(
+    "-m",
+    "--mode",
+    choices=["fork", "serialize", "replay"],
+    default="replay",
+    help="replay (default): re-run all of the notebook's code up to this cell in a new "
+    "process. fork: run the cell in a copy of the kernel (not available on Windows; "
+    "forking a kernel whose other threads hold locks can deadlock the copy). "
+    "serialize: pickle the variables the cell uses into a new process (needs "
+    "cloudpickle).",
+)
+@argument(
+    "-n",
+    "--names",
+    nargs="*",
+    default=[],
+    help="Extra variables to send in serialize mode (the ones the cell uses directly "
+    "are found automatically).",
+)
+@argument(
+    "-o",
+    "--output",
+    help="File to write the job's stdout and stderr to (default: stdout.txt and "
+    "stderr.txt in the job's directory). With --sweep, each job's id is added to the "
+    "file name.",
+)
+@argument(
+    "-r",
+    "--return",
+    dest="return_names",
+    nargs="*",
+    default=[],
+    help="Variables to bring back with `%%job_result` (besides the value of the "
+    "cell's last expression).",
+)
+@argument(
+    "-s",
+    "--sweep",
+    action="append",
+    default=[],
+    help="Run one job per value, e.g. --sweep lr=[1e-3,1e-4]; repeat to sweep over the "
+    "cartesian product of several variables. Values are evaluated in the notebook's "
+    "namespace.",
+)
+@argument(
+    "--slice",
+    action="store_true",
+    help="In replay mode, only re-run the earlier cells that define (or might "
+    "modify) variables this cell depends on, rather than every cell.",
+)
+def background(line: str, cell: str):
+    """
+    Usage: %%background [-m replay|fork|serialize] [-n NAMES...] [-o OUTPUT]
+      [-r NAMES...] [-s name=values]... [--slice]
+    Run the cell as a background job. At most as many jobs as there are CPUs run at
+    once (see `%jobs`); the rest are queued. In fork and serialize mode, each job
+    starts from the values the notebook's variables have when the cell is run (later
+    changes to them aren't seen by the job, nor are the job's changes seen by the
+    notebook; use `%job_result` to get values back). In fork mode, the kernel is
+    forked once when the cell is run and each job's process is forked from that copy
+    when the job starts.
+    """
+    args = parse_argstring(background, line)
+    shell = get_ipython()
+    manager = get_job_manager()
+    param_sets = _parse_sweep(args.sweep, shell.user_ns) if args.sweep else [{}]
+    if args.mode == "replay" and (args.sweep or args.return_names):
+        raise UsageError("--sweep and --return aren't supported in replay mode.")
+    if args.slice and args.mode != "replay":
+        raise UsageError("--slice only applies to replay mode.")
+    if args.mode == "fork" and not hasattr(os, "fork"):
+        raise UsageError("Fork mode needs os.fork, which isn't available here.")
+    if args.mode == "serialize" and not cloudpickle_imported:
+        # plain pickle can't send functions or classes defined in the notebook
+        raise UsageError(
+            "Serialize mode needs cloudpickle; install it or use another --mode."
+        )
+    code = shell.transform_cell(cell)
+
+    jobs = [
+        manager.new_job(args.mode, cell, params, args.output) for params in param_sets
+    ]
+    if args.output and len(jobs) > 1:
+        root, ext = os.path.splitext(args.output)
+        for job in jobs:
+            job.stdout = job.stderr = f"{root}-{job.id}{ext}"
+    if args.mode == "fork":
+        _prepare_forked(jobs, code, args.return_names)
+    for job in jobs:
+        if args.mode == "serialize":
+            _prepare_serialized(job, code, args.names, args.return_names)
+        elif args.mode == "replay":
+            _prepare_replay(job, args.slice)
+        manager.submit(job)
+
+    ids = f"{jobs[0].id}" if len(jobs) == 1 else f"{jobs[0].id}-{jobs[-1].id}"
+    print(
+        f"Queued job{'s' if len(jobs) > 1 else ''} {ids} (output in {manager.jobs_dir})."
+    )
+
+
+def _format_seconds(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    return time.strftime("%H:%M:%S", time.gmtime(seconds))
+
+
+@magic_arguments()
+@argument("-k", "--kill", type=int, nargs="*", help="Kill these jobs.")
+@argument(
+    "-w", "--max-workers", type=int, help="Set the number of jobs which run at once."
+)
+def jobs(line: str) -> None:
+    """
+    Usage: %jobs [-k IDS...] [-w MAX_WORKERS]
+    List the `%%background` jobs with their status and resource use (wall time, CPU
+    time, and memory: the current resident memory of running jobs and the peak of
+    finished ones).
+    """
+    args = parse_argstring(jobs, line)
+    manager = get_job_manager()
+    if args.max_workers:
+        manager.set_max_workers(args.max_workers)
+    for job_id in args.kill or []:
+        manager.kill(_get_job(job_id))
+    if not manager.jobs:
+        print("No jobs.")
+        return
+
+    print(
+        f"{'id':>4}  {'status':8}  {'pid':>7}  {'wall':>8}  {'cpu':>8}  {'rss':>8}  job"
+    )
+    now = time.time()
+    for job in manager.jobs.values():
+        wall = cpu = rss = ""
+        if job.start_time is not None:
+            wall = _format_seconds((job.end_time or now) - job.start_time)
+        cpu_time, memory = job.usage()
+        if cpu_time is not None:
+            cpu = _format_seconds(cpu_time)
+        if memory is not None:
+            rss = f"{memory / 2 ** 20:.0f} MiB"
+        print(
+            f"{job.id:>4}  {job.status:8}  {job.pid or '':>7}  {wall:>8}  {cpu:>8}  "
+            f"{rss:>8}  {job.describe()}"
+        )
+
+
+def _get_job(job_id: int) -> Job:
+    try:
+        return get_job_manager().jobs[job_id]
+    except KeyError:
+        raise UsageError(f"There's no job {job_id}.")
+
+
+@magic_arguments()
+@argument(
+    "-w", "--wait", action="store_true", help="Wait for the job if it's still running."
+)
+@argument("job_id", type=int)
+def job_result(line: str) -> Any:
+    """
+    Usage: %job_result [-w] JOB_ID
+    Return the value of the last expression in a finished `%%background` job's cell.
+    Variables passed to `%%background --return` are also put back into the namespace.
+    """
+    args = parse_argstring(job_result, line)
+    job = _get_job(args.job_id)
+    if args.wait:
+        job.wait()
+    if not job.done():
+        raise UsageError(f"Job {job.id} is {job.status}; use -w to wait for it.")
+    if job.status != "done":
+        with open(job.stderr) as f:
+            sys.stderr.write(f.read()[-5000:])
+        raise RuntimeError(f"Job {job.id} {job.status} (exit code {job.returncode}).")
+    if not os.path.exists(job.result_fname):
+        return None
+    with open(job.result_fname, "rb") as f:
+        result, returns = pickle.load(f)
+    get_ipython().user_ns.update(returns)
+    return result
+
+
+def load_ipython_extension(ipython) -> None:
+    for magic in (notebook_path, jobs, job_result):
+        ipython.register_magic_function(magic, magic_kind="line")
+    ipython.register_magic_function(background, magic_kind="cell")
+
 
-            # skip line magics
-            code += (
-                "".join([line for line in cell["source"] if not line.startswith("%")])
-                + "\n"
-            )
-            if terminate:
-                break
-
-        # execute code, from the same directory in case relative paths are used
-        with NamedTemporaryFile("w", dir=dirname(nb_fname)) as tmp:
-            tmp.write(code)
-            tmp.seek(0)  # running cat didn't show anything unless I did this
-
-            Popen(["python", tmp.name])
-            # otherwise, it seems like the file is deleted before Popen even gets to it
-            sleep(0.5)
+if get_ipython() is not None:
+    load_ipython_extension(get_ipython())
@@ -1,11 +1,12 @@
 """
 Adds a magic to IPython which will play a given sound when a cell finishes running.
 Requires Python 3.6+.
-Put this file in, e.g., ~/.ipython/profile_default/startup to load this magic on startup.
+Load it with `%load_ext jupyter_magics` (or just this module with
+`%load_ext jupyter_magics.bell_magic`).
 
 Usage:
 ```
-%notify [-u/--url URL] [command]
+%notify [-u/--url URL] [-t/--time] [-p/--profile] [command]
 ```
 
 Examples
@@ -13,11 +14,13 @@ Examples
 %notify # no command needed
 %notify run_long_command()
 %notify -u https://www.example.com/sound.wav run_long_command()
+%notify -t run_long_command()  # also print wall time, CPU time, peak memory, etc.
+%notify -p run_long_command()  # also print the lines where most time was spent
 ```
 
 There's also a cell magic version (don't put commands on the first line if using this).
 ```
-%%notify [-u/--url URL]
+%%notify [-u/--url URL] [-t/--time] [-p/--profile]
 command1()
 command2()
 ...
@@ -26,13 +29,25 @@ command2()
 To always play your preferred audio file, just change the default below.
 """
 
+import os
+import sys
+import threading
+import time
+from collections import Counter
 from pathlib import Path
-from typing import Optional
+from types import FrameType
+from typing import Dict, Optional
 from IPython import get_ipython
 from IPython.core.magic import line_cell_magic, Magics, magics_class
 from IPython.core.magic_arguments import argument, magic_arguments, parse_argstring
 from IPython.display import Audio, display
 
+try:
+    import resource
+    resource_imported = True
+except ImportError:  # not available on Windows
+    resource_imported = False
+
 
 class _InvisibleAudio(Audio):
     """
@@ -48,6 +63,126 @@ class _InvisibleAudio(Audio):
         return f'<div style="display:none">{audio}</div>'
 
 
+def _format_bytes(n_bytes: float) -> str:
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(n_bytes) < 1024:
+            break
+        n_bytes /= 1024
+    else:
+        unit = "TiB"
+    return f"{n_bytes:.1f} {unit}"
+
+
+def _format_seconds(seconds: float) -> str:
+    if seconds < 60:
+        return f"{seconds:.2f}s"
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    if hours:
+        return f"{hours}h {minutes}m {seconds:.0f}s"
+    return f"{minutes}m {seconds:.1f}s"
+
+
+class _ResourceUsage:
+    """Measures the wall time, CPU time, and (where available) other resource use."""
+
+    def __init__(self):
+        self.start_wall = time.perf_counter()
+        self.start_cpu = time.process_time()
+        self.start_rusage = (
+            resource.getrusage(resource.RUSAGE_SELF) if resource_imported else None
+        )
+
+    def report(self) -> str:
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        parts = [
+            f"Wall time: {_format_seconds(wall)}",
+            f"CPU time: {_format_seconds(cpu)} ({cpu / max(wall, 1e-9):.0%})",
+        ]
+        if self.start_rusage is not None:
+            start = self.start_rusage
+            end = resource.getrusage(resource.RUSAGE_SELF)
+            # ru_maxrss is in KiB on Linux and bytes on macOS
+            scale = 1 if sys.platform == "darwin" else 1024
+            parts.append(
+                f"Peak RSS: {_format_bytes(end.ru_maxrss * scale)} "
+                f"(+{_format_bytes((end.ru_maxrss - start.ru_maxrss) * scale)})"
+            )
+            parts.append(f"Major page faults: {end.ru_majflt - start.ru_majflt}")
+            parts.append(
+                "Context switches (voluntary/involuntary): "
+                f"{end.ru_nvcsw - start.ru_nvcsw}/{end.ru_nivcsw - start.ru_nivcsw}"
+            )
+            parts.append(
+                "Block I/O (in/out): "
+                f"{end.ru_inblock - start.ru_inblock}/{end.ru_oublock - start.ru_oublock}"
+            )
+        return "\n".join(parts)
+
+
+class _SamplingProfiler:
+    """
+    Samples the stack of the thread which created it every `interval` seconds from a
+    background thread. Unlike cProfile, the profiled code isn't slowed down by
+    per-call hooks; the cost is one stack walk per sample.
+    """
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.n_samples = 0
+        # (file, line, function) -> number of samples where it was running / on the stack
+        self.self_counts: Dict[tuple, int] = Counter()
+        self.total_counts: Dict[tuple, int] = Counter()
+        self._thread_id = threading.get_ident()
+        # frames at and above this one (the magic and IPython) aren't counted
+        self._root = sys._getframe(1)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            if frame is not None:
+                self._sample(frame)
+
+    def _sample(self, frame: FrameType) -> None:
+        locations = []
+        while frame is not None and frame is not self._root:
+            code = frame.f_code
+            locations.append((code.co_filename, frame.f_lineno, code.co_name))
+            frame = frame.f_back
+        if not locations:
+            return
+        self.n_samples += 1
+        self.self_counts[locations[0]] += 1
+        # count each location once per sample, even if it's on the stack repeatedly
+        self.total_counts.update(set(locations))
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def report(self, n_top: int = 15) -> str:
+        if not self.n_samples:
+            return "Profile: no samples (the code finished too quickly)."
+        lines = [
+            f"Profile: top {n_top} of {len(self.self_counts)} lines by samples "
+            f"({self.n_samples} samples, every {self.interval * 1000:g} ms)",
+            f"{'self':>7} {'total':>7}  location",
+        ]
+        for location, count in self.self_counts.most_common(n_top):
+            fname, line_no, function = location
+            fname = os.path.join(*Path(fname).parts[-2:]) if os.sep in fname else fname
+            lines.append(
+                f"{count / self.n_samples:>7.1%} "
+                f"{self.total_counts[location] / self.n_samples:>7.1%}  "
+                f"{fname}:{line_no} ({function})"
+            )
+        return "\n".join(lines)
+
+
 @magics_class
 class NotificationMagics(Magics):
     """
@@ -65,6 +200,28 @@ class NotificationMagics(Magics):
     @argument(
         "-u", "--url", default=SOUND_FILE, help="URL of audio file to play.",
     )
+    @argument(
+        "-t",
+        "--time",
+        action="store_true",
+        help="Print the wall time, CPU time, peak memory, and other resource use.",
+    )
+    @argument(
+        "-p",
+        "--profile",
+        action="store_true",
+        help="Sample the stack while the code runs and print where the most time was "
+        "spent (implies --time).",
+    )
+    @argument(
+        "--interval",
+        type=float,
+        default=0.01,
+        help="Seconds between stack samples with --profile.",
+    )
+    @argument(
+        "--top", type=int, default=15, help="Number of lines to show with --profile."
+    )
     @argument(
         "line_code",
         nargs="*",
@@ -75,9 +232,17 @@ class NotificationMagics(Magics):
         args = parse_argstring(self.notify, line)
 
         code = cell if cell else " ".join(args.line_code)
+        usage = _ResourceUsage() if args.time or args.profile else None
+        profiler = _SamplingProfiler(args.interval) if args.profile else None
         try:
             ret = self.shell.ex(code)
         finally:
+            if profiler:
+                profiler.stop()
+            if usage:
+                print(usage.report())
+            if profiler:
+                print(profiler.report(args.top))
             maybe_url = args.url
             if maybe_url == self.SOUND_FILE:
                 if Path(self.SOUND_FILE).is_file():
@@ -91,4 +256,9 @@ class NotificationMagics(Magics):
         return ret
 
 
-get_ipython().register_magics(NotificationMagics)
+def load_ipython_extension(ipython) -> None:
+    ipython.register_magics(NotificationMagics)
+
+
+if get_ipython() is not None:
+    load_ipython_extension(get_ipython())
@@ -0,0 +1,92 @@
+"""
+Finds the names that Python code binds, modifies, and reads. `%%background --slice`
+uses this to find the cells a job depends on and `%%cache` uses it to find a cell's
+inputs and outputs. This module only uses the standard library so that it's cheap to
+import from any of the magics modules.
+"""
+
+import ast
+from typing import Set
+
+
+class DefUseVisitor(ast.NodeVisitor):
+    """
+    Collects the global names code binds, the names it might modify in place
+    (`x.a = 1`, `x[0] = 1`, `x.append(1)`, or assigning to `global x` in a function),
+    and all of the names it reads (including in nested scopes, which over-counts).
+    """
+
+    def __init__(self):
+        self.binds: Set[str] = set()
+        self.mutates: Set[str] = set()
+        self.uses: Set[str] = set()
+        self.star_import = False
+        self._depth = 0  # > 0 inside functions, classes, lambdas, and comprehensions
+
+    def _bind(self, name: str) -> None:
+        if self._depth == 0:
+            self.binds.add(name)
+
+    def _mutate(self, node: ast.AST) -> None:
+        while isinstance(node, (ast.Attribute, ast.Subscript)):
+            node = node.value
+        if isinstance(node, ast.Name):
+            self.mutates.add(node.id)
+
+    def _visit_nested(self, node: ast.AST) -> None:
+        self._depth += 1
+        self.generic_visit(node)
+        self._depth -= 1
+
+    def visit_Name(self, node: ast.Name) -> None:
+        if isinstance(node.ctx, ast.Load):
+            self.uses.add(node.id)
+        else:
+            self._bind(node.id)
+
+    def _visit_def(self, node) -> None:
+        self._bind(node.name)
+        for decorator in node.decorator_list:
+            self.visit(decorator)
+        self._visit_nested(node)
+
+    visit_FunctionDef = visit_AsyncFunctionDef = visit_ClassDef = _visit_def
+
+    visit_Lambda = visit_ListComp = visit_SetComp = _visit_nested
+    visit_DictComp = visit_GeneratorExp = _visit_nested
+
+    def visit_Import(self, node: ast.Import) -> None:
+        for alias in node.names:
+            self._bind(alias.asname or alias.name.split(".")[0])
+
+    def visit_ImportFrom(self, node: ast.ImportFrom) -> None:
+        for alias in node.names:
+            if alias.name == "*":
+                self.star_import = True
+            else:
+                self._bind(alias.asname or alias.name)
+
+    def visit_AugAssign(self, node: ast.AugAssign) -> None:
+        # `x += 1`, `x.a += 1`, and `x[0] += 1` read x before assigning to it
+        base = node.target
+        while isinstance(base, (ast.Attribute, ast.Subscript)):
+            base = base.value
+        if isinstance(base, ast.Name):
+            self.uses.add(base.id)
+        self.generic_visit(node)
+
+    def visit_Global(self, node: ast.Global) -> None:
+        self.mutates.update(node.names)
+
+    def _visit_target(self, node) -> None:
+        if not isinstance(node.ctx, ast.Load):
+            self._mutate(node.value)
+        self.generic_visit(node)
+
+    visit_Attribute = visit_Subscript = _visit_target
+
+    def visit_Call(self, node: ast.Call) -> None:
+        # a method call might modify the object it's called on
+        if isinstance(node.func, ast.Attribute):
+            self._mutate(node.func.value)
+        self.generic_visit(node)
@@ -1,43 +1,1071 @@
+import ast
+import hashlib
+import importlib
+import json
+import lzma
+import marshal
+import mmap as _mmap
+import os
 import pickle
+import re
+import struct
+import threading
+import time
+import traceback
+import types
+import uuid
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import (
+    Any,
+    BinaryIO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
-from IPython.core.magic import register_line_magic, needs_local_scope
+from IPython import get_ipython
+from IPython.core.magic import needs_local_scope
+from IPython.core.magic_arguments import argument, magic_arguments, parse_argstring
 
-@register_line_magic
-@needs_local_scope
-def save(line: str, local_ns) -> None:
+from jupyter_magics.def_use import DefUseVisitor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+try:
+    import lz4.frame
+    lz4_imported = True
+except ImportError:
+    lz4_imported = False
+
+
+# Layout of a file written by `%save`:
+#   _MAGIC | compressed chunks... | raw buffers... | JSON header | header length (uint64)
+#   | _MAGIC
+# The header lists, for the pickle stream and for each out-of-band buffer, the
+# (offset, compressed size, raw size) of every chunk. Uncompressed ("raw") buffers are
+# stored as one chunk each, starting on a page boundary, so they can be memory mapped.
+# Files without _MAGIC at the start are plain pickles (as written by older versions of
+# %save).
+_MAGIC = b"JMSAVE01"
+_HEADER_LEN = struct.Struct("<Q")
+# buffers smaller than this are left in the pickle stream
+_MIN_OUT_OF_BAND = 1 << 16
+_CHUNK_SIZE = 1 << 22
+_ALIGN = _mmap.PAGESIZE
+# deduplicated stores use smaller chunks so that a small change rewrites less
+_DEDUP_CHUNK_SIZE = 1 << 20
+N_THREADS = os.cpu_count() or 1
+
+
+def _zstd_compress(data) -> bytes:
+    # compressor objects aren't thread safe, but they're cheap to make
+    return zstandard.ZstdCompressor(level=3).compress(data)
+
+
+def _zstd_decompress(data) -> bytes:
+    return zstandard.ZstdDecompressor().decompress(data)
+
+
+def _get_codecs() -> Dict[str, Tuple[Callable, Callable]]:
+    """:returns: a dict of codec name -> (compress, decompress) for available codecs"""
+    codecs = {}
+    if zstandard is not None:
+        codecs["zstd"] = (_zstd_compress, _zstd_decompress)
+    if lz4_imported:
+        codecs["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+    codecs["zlib"] = (lambda data: zlib.compress(data, 1), zlib.decompress)
+    codecs["lzma"] = (lambda data: lzma.compress(data, preset=1), lzma.decompress)
+    codecs["none"] = (lambda data: data, lambda data: data)
+    return codecs
+
+
+CODECS = _get_codecs()
+# the first available codec is the fastest one
+DEFAULT_CODEC = next(iter(CODECS))
+
+
+def _chunks(data: memoryview, chunk_size: int = _CHUNK_SIZE) -> Iterator[memoryview]:
+    for start in range(0, data.nbytes, chunk_size):
+        yield data[start : start + chunk_size]
+
+
+def _map_ordered(
+    pool: ThreadPoolExecutor, func: Callable, items: Iterator, window: int
+) -> Iterator:
     """
-    Usage: %save obj [path]
-    Default path is tmp.pkl.
-    ".pkl" will be added to path if not already present
+    Like `pool.map(func, items)` but with at most `window` items in flight, so results
+    (e.g. compressed chunks) don't pile up in memory faster than they're consumed.
+    """
+    pending = deque()
+    for item in items:
+        pending.append(pool.submit(func, item))
+        if len(pending) >= window:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+
+def _pickle_with_buffers(obj: Any) -> Tuple[bytes, List[memoryview]]:
+    """
+    Pickle `obj` with protocol 5, keeping large buffers (e.g. array data) out of band.
+
+    :returns: the pickle stream and the raw memory of each out-of-band buffer
+    """
+    buffers = []
+
+    def buffer_callback(buffer: pickle.PickleBuffer) -> bool:
+        raw = buffer.raw()
+        if raw.nbytes < _MIN_OUT_OF_BAND:
+            return True  # serialize in band
+        buffers.append(raw)
+        return False
+
+    data = pickle.dumps(obj, protocol=5, buffer_callback=buffer_callback)
+    return data, buffers
+
+
+def _dump(
+    obj: Any,
+    f: BinaryIO,
+    codec: str = DEFAULT_CODEC,
+    n_threads: int = N_THREADS,
+    raw_buffers: bool = False,
+) -> None:
+    """
+    Write `obj` to `f`, compressing the pickle and its large buffers in parallel.
+
+    :param codec: one of `CODECS`
+    :param n_threads: number of threads used for compression
+    :param raw_buffers: if True, large buffers are written uncompressed and page
+      aligned so that they can be memory mapped by `_load(f, mmap=True)`. This is
+      always the case if `codec` is "none".
+    """
+    data, buffers = _pickle_with_buffers(obj)
+    _dump_pickled(data, buffers, f, codec, n_threads, raw_buffers)
+
+
+def _dump_pickled(
+    data: bytes,
+    buffers: List[memoryview],
+    f: BinaryIO,
+    codec: str = DEFAULT_CODEC,
+    n_threads: int = N_THREADS,
+    raw_buffers: bool = False,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> None:
+    """
+    `_dump` for an object already split up by `_pickle_with_buffers`.
+
+    :param progress: called with (bytes done, total bytes) as chunks are written
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown {codec=}; available codecs are {list(CODECS)}.")
+    compress = CODECS[codec][0]
+    raw_buffers = raw_buffers or codec == "none"
+    n_bytes_total = len(data) + sum(buffer.nbytes for buffer in buffers)
+    n_bytes_done = 0
+    segments = [memoryview(data)] + ([] if raw_buffers else buffers)
+
+    def compress_chunk(item: Tuple[int, memoryview]) -> Tuple[int, Any, int]:
+        segment_idx, chunk = item
+        return segment_idx, compress(chunk), chunk.nbytes
+
+    items = (
+        (segment_idx, chunk)
+        for segment_idx, segment in enumerate(segments)
+        for chunk in _chunks(segment)
+    )
+    records = [[] for _ in segments]
+    f.write(_MAGIC)
+    offset = len(_MAGIC)
+    with ThreadPoolExecutor(n_threads) as pool:
+        for segment_idx, compressed, raw_size in _map_ordered(
+            pool, compress_chunk, items, 2 * n_threads
+        ):
+            f.write(compressed)
+            size = memoryview(compressed).nbytes
+            records[segment_idx].append((offset, size, raw_size))
+            offset += size
+            n_bytes_done += raw_size
+            if progress:
+                progress(n_bytes_done, n_bytes_total)
+
+    if raw_buffers:
+        for buffer in buffers:
+            padding = -offset % _ALIGN
+            f.write(bytes(padding))
+            offset += padding
+            f.write(buffer)
+            records.append([(offset, buffer.nbytes, buffer.nbytes)])
+            offset += buffer.nbytes
+            n_bytes_done += buffer.nbytes
+            if progress:
+                progress(n_bytes_done, n_bytes_total)
+
+    header = {
+        "codec": codec,
+        "buffer_codec": "none" if raw_buffers else codec,
+        "pickle": records[0],
+        "buffers": [
+            {"nbytes": buffer.nbytes, "chunks": chunks}
+            for buffer, chunks in zip(buffers, records[1:])
+        ],
+    }
+    header = json.dumps(header).encode()
+    f.write(header)
+    f.write(_HEADER_LEN.pack(len(header)))
+    f.write(_MAGIC)
+
+
+def _read_header(f: BinaryIO) -> Optional[Dict[str, Any]]:
+    """:returns: the header of a file written by `_dump` or None for a plain pickle"""
+    f.seek(0)
+    if f.read(len(_MAGIC)) != _MAGIC:
+        return None
+    f.seek(-(_HEADER_LEN.size + len(_MAGIC)), os.SEEK_END)
+    (header_len,) = _HEADER_LEN.unpack(f.read(_HEADER_LEN.size))
+    f.seek(-(header_len + _HEADER_LEN.size + len(_MAGIC)), os.SEEK_END)
+    return json.loads(f.read(header_len))
+
+
+def _load(f: BinaryIO, n_threads: int = N_THREADS, mmap: bool = False) -> Any:
     """
-    usage = "%save obj [path]"
-    line = line.strip()
-    if " " in line:
+    Read an object written by `_dump` (or a plain pickle), decompressing in parallel.
+
+    :param mmap: if True, large buffers are memory mapped (copy on write) instead of
+      read, so e.g. arrays are backed directly by the file and only the pages that are
+      accessed are read. Requires the buffers to have been saved uncompressed.
+    """
+    header = _read_header(f)
+    if header is None:
+        if mmap:
+            raise ValueError("Can't memory map a plain pickle file.")
+        f.seek(0)
+        return pickle.load(f)
+
+    data = bytearray(sum(raw_size for _, _, raw_size in header["pickle"]))
+    segments = [(data, header["pickle"], header["codec"])]
+    # files written before --mmap existed compress buffers with the same codec
+    buffer_codec = header.get("buffer_codec", header["codec"])
+    if mmap:
+        if buffer_codec != "none":
+            raise ValueError(
+                "Only uncompressed buffers can be memory mapped; "
+                "save with `%save --mmap` or `%save -c none`."
+            )
+        # ACCESS_COPY gives writable arrays whose changes aren't written to the file
+        file_map = memoryview(_mmap.mmap(f.fileno(), 0, access=_mmap.ACCESS_COPY))
+        buffers = [
+            file_map[offset : offset + size]
+            for info in header["buffers"]
+            for offset, size, _ in info["chunks"]
+        ]
+    else:
+        buffers = [bytearray(buffer["nbytes"]) for buffer in header["buffers"]]
+        segments += [
+            (buffer, info["chunks"], buffer_codec)
+            for buffer, info in zip(buffers, header["buffers"])
+        ]
+
+    def read_chunks():
+        # reads happen here (sequentially) and decompression happens in the pool
+        for out, chunks, codec in segments:
+            out = memoryview(out)
+            decompress = CODECS[codec][1]
+            start = 0
+            for offset, size, raw_size in chunks:
+                f.seek(offset)
+                yield out[start : start + raw_size], f.read(size), decompress
+                start += raw_size
+
+    def decompress_chunk(item: Tuple[memoryview, bytes, Callable]) -> None:
+        out, compressed, decompress = item
+        out[:] = decompress(compressed)
+
+    with ThreadPoolExecutor(n_threads) as pool:
+        for _ in _map_ordered(pool, decompress_chunk, read_chunks(), 2 * n_threads):
+            pass
+    return pickle.loads(data, buffers=buffers)
+
+
+# Layout of a deduplicated store written by `%save --dedup`:
+#   path/chunks/<hash[:2]>/<hash>.<codec>  one compressed chunk, named by the hash of
+#                                          its uncompressed contents
+#   path/versions/<n>.json                 manifest of version n: the codec and the
+#                                          hashes of the chunks of the pickle stream
+#                                          and of each out-of-band buffer
+# Buffers are chunked at fixed offsets, so an array that didn't change (or a part of
+# one) maps to chunks which are already stored and only new chunks are written.
+
+
+def _write_atomic(path: str, data) -> None:
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _dedup_versions(path: str) -> List[int]:
+    versions_dir = os.path.join(path, "versions")
+    if not os.path.isdir(versions_dir):
+        return []
+    return sorted(
+        int(fname[: -len(".json")])
+        for fname in os.listdir(versions_dir)
+        if fname.endswith(".json") and fname[: -len(".json")].isdigit()
+    )
+
+
+def _dump_dedup(
+    obj: Any, path: str, codec: str = DEFAULT_CODEC, n_threads: int = N_THREADS
+) -> int:
+    """
+    Save `obj` as a new version in the deduplicated store at `path`.
+
+    Chunks are hashed and compressed in parallel; only chunks which aren't already in
+    the store are written.
+
+    :returns: the new version number
+    """
+    data, buffers = _pickle_with_buffers(obj)
+    manifest = _store_dedup_chunks(data, buffers, path, codec, n_threads)
+    return _commit_dedup_version(path, manifest)
+
+
+def _store_dedup_chunks(
+    data: bytes,
+    buffers: List[memoryview],
+    path: str,
+    codec: str = DEFAULT_CODEC,
+    n_threads: int = N_THREADS,
+    progress: Optional[Callable[[int, int], None]] = None,
+) -> bytes:
+    """
+    Write the chunks of an object split up by `_pickle_with_buffers` to the store.
+
+    :param progress: called with (bytes done, total bytes) as chunks are stored
+    :returns: the manifest to pass to `_commit_dedup_version`
+    """
+    if codec not in CODECS:
+        raise ValueError(f"Unknown {codec=}; available codecs are {list(CODECS)}.")
+    compress = CODECS[codec][0]
+    n_bytes_total = len(data) + sum(buffer.nbytes for buffer in buffers)
+    n_bytes_done = 0
+
+    def store_chunk(chunk: memoryview) -> Tuple[str, int]:
+        """:returns: the chunk's hash and the number of bytes written to store it"""
+        digest = hashlib.blake2b(chunk, digest_size=20).hexdigest()
+        chunk_dir = os.path.join(path, "chunks", digest[:2])
+        chunk_path = os.path.join(chunk_dir, f"{digest}.{codec}")
+        n_bytes_written = 0
+        if not os.path.exists(chunk_path):
+            os.makedirs(chunk_dir, exist_ok=True)
+            compressed = compress(chunk)
+            _write_atomic(chunk_path, compressed)
+            n_bytes_written = memoryview(compressed).nbytes
+        return digest, n_bytes_written
+
+    segments = []
+    n_bytes_written = 0
+    with ThreadPoolExecutor(n_threads) as pool:
+        for segment in [memoryview(data), *buffers]:
+            chunks = []
+            for chunk, (digest, n_bytes) in zip(
+                _chunks(segment, _DEDUP_CHUNK_SIZE),
+                pool.map(store_chunk, _chunks(segment, _DEDUP_CHUNK_SIZE)),
+            ):
+                chunks.append(digest)
+                n_bytes_written += n_bytes
+                n_bytes_done += chunk.nbytes
+                if progress:
+                    progress(n_bytes_done, n_bytes_total)
+            segments.append({"nbytes": segment.nbytes, "chunks": chunks})
+    manifest = {
+        "codec": codec,
+        "pickle": segments[0],
+        "buffers": segments[1:],
+        "time": time.time(),
+        "bytes_written": n_bytes_written,
+    }
+    return json.dumps(manifest).encode()
+
+
+def _commit_dedup_version(path: str, manifest: bytes) -> int:
+    """
+    Write `manifest` as the next version of the store at `path`.
+
+    :returns: the new version number
+    """
+    versions_dir = os.path.join(path, "versions")
+    os.makedirs(versions_dir, exist_ok=True)
+    version = (_dedup_versions(path) or [0])[-1] + 1
+    while True:
+        # claim the version number with O_EXCL in case another save is racing this one
         try:
-            obj, path = line.split(" ")
-        except ValueError:
-            raise ValueError(f"Error saving object! Usage: {usage}")
-        if not path.endswith(".pkl"):
-            path += ".pkl"
+            fd = os.open(
+                os.path.join(versions_dir, f"{version}.json"),
+                os.O_WRONLY | os.O_CREAT | os.O_EXCL,
+            )
+        except FileExistsError:
+            version += 1
+            continue
+        with os.fdopen(fd, "wb") as f:
+            f.write(manifest)
+        return version
+
+
+def _load_dedup(
+    path: str, version: Optional[int] = None, n_threads: int = N_THREADS
+) -> Any:
+    """
+    Load a version (default: the latest one) from the deduplicated store at `path`.
+    """
+    if version is None:
+        versions = _dedup_versions(path)
+        if not versions:
+            raise FileNotFoundError(f"No saved versions found in {path}.")
+        version = versions[-1]
+    with open(os.path.join(path, "versions", f"{version}.json"), "rb") as f:
+        manifest = json.load(f)
+    codec = manifest["codec"]
+    decompress = CODECS[codec][1]
+
+    def read_chunk(item: Tuple[memoryview, str]) -> None:
+        out, digest = item
+        chunk_path = os.path.join(path, "chunks", digest[:2], f"{digest}.{codec}")
+        with open(chunk_path, "rb") as f:
+            out[:] = decompress(f.read())
+
+    segments = [manifest["pickle"], *manifest["buffers"]]
+    outs = [bytearray(segment["nbytes"]) for segment in segments]
+    items = [
+        (chunk, digest)
+        for out, segment in zip(outs, segments)
+        for chunk, digest in zip(
+            _chunks(memoryview(out), _DEDUP_CHUNK_SIZE), segment["chunks"]
+        )
+    ]
+    with ThreadPoolExecutor(n_threads) as pool:
+        list(pool.map(read_chunk, items))
+    return pickle.loads(outs[0], buffers=outs[1:])
+
+
+class SaveHandle:
+    """
+    Handle to a `%save --async` running in the background.
+
+    `progress` is the fraction of the object written so far. Call `wait` to block until
+    the save has finished (this raises if the save failed).
+    """
+
+    def __init__(self, obj_name: str, path: str):
+        self.obj_name = obj_name
+        self.path = path
+        self.progress = 0.0
+        self.error = None
+        self.result = None
+        self.start_time = time.time()
+        self.end_time = None
+        self._done = threading.Event()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout: Optional[float] = None) -> Optional[int]:
+        """
+        :returns: the version number if saving to a --dedup store, otherwise None
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError(
+                f"Saving {self.obj_name} to {self.path} is still running."
+            )
+        if self.error is not None:
+            raise RuntimeError(
+                f"Saving {self.obj_name} to {self.path} failed:\n{self.error}"
+            )
+        return self.result
+
+    @property
+    def status(self) -> str:
+        if not self.done():
+            return "running"
+        return "failed" if self.error is not None else "done"
+
+    def __repr__(self) -> str:
+        elapsed = (self.end_time or time.time()) - self.start_time
+        return (
+            f"<SaveHandle {self.obj_name} -> {self.path}: {self.status} "
+            f"({self.progress:.0%}, {elapsed:.1f}s)>"
+        )
+
+
+# running saves and the most recent finished ones (for `%saves -a`)
+_save_handles: List[SaveHandle] = []
+_MAX_FINISHED_HANDLES = 20
+# the most recent running save to each (real) path; each save waits for the previous
+# one to the same path before committing its result so that an older snapshot never
+# replaces a newer one
+_last_save_to_path: Dict[str, SaveHandle] = {}
+_save_handles_lock = threading.Lock()
+
+
+def _prune_save_handles() -> None:
+    finished = [handle for handle in _save_handles if handle.done()]
+    for handle in finished[: max(len(finished) - _MAX_FINISHED_HANDLES, 0)]:
+        _save_handles.remove(handle)
+
+
+def _wait_for_saves_to(path: str) -> None:
+    with _save_handles_lock:
+        previous = _last_save_to_path.get(os.path.realpath(path))
+    if previous is not None:
+        previous._done.wait()
+
+
+def _write_snapshot(
+    data: bytes,
+    buffers: List[memoryview],
+    path: str,
+    tmp_path: str,
+    dedup: bool,
+    codec: str,
+    n_threads: int,
+    raw_buffers: bool,
+    progress: Callable[[int, int], None],
+) -> Optional[bytes]:
+    """
+    Write everything for an async save except the final commit (see `_commit_snapshot`).
+
+    :returns: the manifest to commit if `dedup`, otherwise None (`tmp_path` is written)
+    """
+    if dedup:
+        return _store_dedup_chunks(data, buffers, path, codec, n_threads, progress)
+    with open(tmp_path, "wb") as f:
+        _dump_pickled(data, buffers, f, codec, n_threads, raw_buffers, progress)
+
+
+def _commit_snapshot(
+    path: str, tmp_path: str, manifest: Optional[bytes]
+) -> Optional[int]:
+    if manifest is not None:
+        return _commit_dedup_version(path, manifest)
+    os.replace(tmp_path, path)
+
+
+def _save_async(
+    obj: Any,
+    obj_name: str,
+    path: str,
+    dedup: bool = False,
+    codec: str = DEFAULT_CODEC,
+    n_threads: int = N_THREADS,
+    raw_buffers: bool = False,
+    fork: bool = False,
+) -> SaveHandle:
+    """
+    Save `obj` in the background.
+
+    A snapshot of `obj` is taken before returning, so it's safe to keep modifying it.
+    By default, `obj` is pickled right away (copying its large buffers) and written
+    from a thread. With `fork`, the snapshot is a forked child process which shares
+    the parent's memory copy-on-write, so nothing is copied up front; the child
+    pickles and writes the object and reports back through a pipe. Forking a process
+    with other threads running is unsafe in general (the child can deadlock on a lock
+    one of them held), so this is opt-in.
+    """
+    if fork and not hasattr(os, "fork"):
+        raise ValueError("Saving from a forked process requires os.fork.")
+    handle = SaveHandle(obj_name, path)
+    # saves to the same file through different paths (e.g. symlinks) are ordered too
+    key = os.path.realpath(path)
+    with _save_handles_lock:
+        previous = _last_save_to_path.get(key)
+        _last_save_to_path[key] = handle
+        _prune_save_handles()
+        _save_handles.append(handle)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+
+    def set_progress(n_bytes_done: int, n_bytes_total: int) -> None:
+        handle.progress = n_bytes_done / max(n_bytes_total, 1)
+
+    if fork:
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # child
+            os.close(read_fd)
+            with os.fdopen(write_fd, "w") as pipe:
+
+                def report(message: Dict[str, Any]) -> None:
+                    pipe.write(json.dumps(message) + "\n")
+                    pipe.flush()
+
+                exit_code = 1
+                try:
+                    data, buffers = _pickle_with_buffers(obj)
+                    manifest = _write_snapshot(
+                        data,
+                        buffers,
+                        path,
+                        tmp_path,
+                        dedup,
+                        codec,
+                        n_threads,
+                        raw_buffers,
+                        lambda done, total: report({"progress": [done, total]}),
+                    )
+                    report({"manifest": manifest and manifest.decode()})
+                    exit_code = 0
+                except BaseException:
+                    report({"error": traceback.format_exc()})
+                finally:
+                    try:
+                        pipe.flush()
+                    finally:
+                        os._exit(exit_code)
+        os.close(write_fd)
+
+        def write() -> Optional[bytes]:
+            manifest = error = None
+            try:
+                with os.fdopen(read_fd) as pipe:
+                    for line in pipe:
+                        message = json.loads(line)
+                        if "progress" in message:
+                            set_progress(*message["progress"])
+                        elif "error" in message:
+                            error = message["error"]
+                        elif message.get("manifest"):
+                            manifest = message["manifest"].encode()
+            finally:
+                # reap the child even if its messages couldn't be read
+                _, status = os.waitpid(pid, 0)
+            if error is not None or status:
+                raise RuntimeError(error or f"Save process exited with {status=}.")
+            return manifest
+
     else:
-        obj = line
-        path = "tmp.pkl"
-    
-    obj = local_ns[obj]
+        data, buffers = _pickle_with_buffers(obj)
+        buffers = [memoryview(bytearray(buffer)) for buffer in buffers]
+
+        def write() -> Optional[bytes]:
+            return _write_snapshot(
+                data,
+                buffers,
+                path,
+                tmp_path,
+                dedup,
+                codec,
+                n_threads,
+                raw_buffers,
+                set_progress,
+            )
+
+    def run() -> None:
+        try:
+            manifest = write()
+            if previous is not None:
+                previous._done.wait()
+            handle.result = _commit_snapshot(path, tmp_path, manifest)
+            handle.progress = 1.0
+        except BaseException:
+            handle.error = traceback.format_exc()
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        finally:
+            handle.end_time = time.time()
+            handle._done.set()
+            with _save_handles_lock:
+                if _last_save_to_path.get(key) is handle:
+                    del _last_save_to_path[key]
+
+    threading.Thread(target=run, daemon=True).start()
+    return handle
+
+
+@needs_local_scope
+@magic_arguments()
+@argument(
+    "-c",
+    "--codec",
+    default=DEFAULT_CODEC,
+    choices=list(CODECS),
+    help=f"Compression codec (default: {DEFAULT_CODEC}).",
+)
+@argument(
+    "-t", "--threads", type=int, default=N_THREADS, help="Number of threads to use."
+)
+@argument(
+    "-m",
+    "--mmap",
+    action="store_true",
+    help="Store large buffers uncompressed so they can be loaded with `%%load --mmap`.",
+)
+@argument(
+    "-d",
+    "--dedup",
+    action="store_true",
+    help="Save a new version in a deduplicated store (a directory) at path.",
+)
+@argument(
+    "-a",
+    "--async",
+    dest="async_",
+    action="store_true",
+    help="Save in the background and return a handle immediately.",
+)
+@argument(
+    "--fork",
+    action="store_true",
+    help="With --async, snapshot the object by forking instead of copying it.",
+)
+@argument("obj", help="Name of the variable to save.")
+@argument("path", nargs="?", default="tmp.pkl", help="Where to save the object.")
+def save(line: str, local_ns) -> Union[int, SaveHandle, None]:
+    """
+    Usage: %save [-c codec] [-t threads] [-m] [-d] [-a [--fork]] obj [path]
+    Default path is tmp.pkl.
+    ".pkl" will be added to path if not already present (except with --dedup)
+    Large buffers (e.g. array data) are compressed in parallel using the given codec.
+    With --dedup, path is a directory holding every saved version; only the chunks of
+    the object which changed since earlier versions are written. The new version
+    number is returned; load it with `%load path@version`.
+    With --async, a snapshot of the object is saved in the background and a
+    `SaveHandle` is returned (see `%saves` for all running saves). The snapshot copies
+    the object's buffers; with --fork, it's a forked process sharing memory
+    copy-on-write instead, which avoids the copy for huge objects but can deadlock if
+    another thread holds a lock (e.g. in a data loader) when the kernel forks.
+    """
+    args = parse_argstring(save, line)
+    obj = local_ns[args.obj]
+    if args.mmap and args.dedup:
+        raise ValueError("--mmap can't be used with --dedup.")
+    path = args.path
+    if not (args.dedup or path.endswith(".pkl")):
+        path += ".pkl"
+
+    if args.async_:
+        return _save_async(
+            obj,
+            args.obj,
+            path,
+            args.dedup,
+            args.codec,
+            args.threads,
+            args.mmap,
+            fork=args.fork,
+        )
+
+    # don't let a save that's still running replace this one when it finishes
+    _wait_for_saves_to(path)
+    if args.dedup:
+        return _dump_dedup(obj, path, args.codec, args.threads)
     with open(path, "wb") as f:
-        pickle.dump(obj, f)
+        _dump(obj, f, args.codec, args.threads, args.mmap)
+
 
-@register_line_magic
+@magic_arguments()
+@argument("-a", "--all", action="store_true", help="Include recent finished saves.")
+def saves(line: str) -> None:
+    """
+    Usage: %saves [-a]
+    List the `%save --async` calls which are still running (with -a, also the last
+    20 which finished).
+    """
+    args = parse_argstring(saves, line)
+    handles = [handle for handle in _save_handles if args.all or not handle.done()]
+    if not handles:
+        print("No saves running.")
+    for handle in handles:
+        print(handle)
+        if handle.error is not None:
+            print(handle.error)
+
+
+@magic_arguments()
+@argument(
+    "-t", "--threads", type=int, default=N_THREADS, help="Number of threads to use."
+)
+@argument(
+    "-m",
+    "--mmap",
+    action="store_true",
+    help="Memory map large buffers instead of reading them (see `%%save --mmap`).",
+)
+@argument("path", nargs="?", default="tmp.pkl", help="File to load.")
 def load(line: str):
     """
-    Usage: %load [path]
+    Usage: %load [-t threads] [--mmap] [path[@version]]
     Default path is tmp.pkl
-    ".pkl" will be added to path if not already present
+    ".pkl" will be added to path if not already present (unless path is a directory)
+    The codec used when saving is detected automatically. With --mmap, arrays are
+    backed by the file (copy on write) so loading is nearly instant and only the parts
+    that are used are read from disk.
+    If path is a store written by `%save --dedup`, the given version (default: the
+    latest) is loaded.
     """
-    path = line.strip()
-    if not path:
-        path = "tmp.pkl"
+    args = parse_argstring(load, line)
+    path = args.path
+    version = None
+    store, _, suffix = path.rpartition("@")
+    # "@" can also be part of a file name
+    if suffix.isdigit() and os.path.isdir(store):
+        path, version = store, int(suffix)
+    if os.path.isdir(path):
+        if args.mmap:
+            raise ValueError("--mmap can't be used with a --dedup store.")
+        return _load_dedup(path, version, args.threads)
     if not path.endswith(".pkl"):
         path += ".pkl"
     with open(path, "rb") as f:
-        return pickle.load(f)
+        return _load(f, args.threads, args.mmap)
+
+
+# `%%cache` stores the variables a cell assigns in CACHE_DIR/<key>-<hash>.pkl (in the
+# same format as `%save`), where the hash covers the cell's source and the contents of
+# the variables it reads. Files are touched when they're used so that the least
+# recently used ones can be evicted once the cache is larger than its maximum size.
+CACHE_DIR_ENV = "JUPYTER_MAGICS_CACHE_DIR"
+CACHE_MAX_GB_ENV = "JUPYTER_MAGICS_CACHE_MAX_GB"
+_cache_stats = {
+    "hits": 0,
+    "misses": 0,
+    "bytes_read": 0,
+    "bytes_written": 0,
+    "seconds_saved": 0.0,
+    "evictions": 0,
+}
+
+
+def _default_cache_dir() -> str:
+    return os.environ.get(CACHE_DIR_ENV) or os.path.join(
+        os.path.expanduser("~"), ".cache", "jupyter_magics"
+    )
+
+
+def _cell_inputs_outputs(code: str) -> Tuple[List[str], List[str]]:
+    """
+    :param code: Python code (i.e. after IPython's transformations)
+    :returns: the names `code` reads before assigning them (its inputs) and the names
+      it assigns or might modify (its outputs)
+    """
+    inputs = {}
+    outputs = {}
+    bound = set()
+    for statement in ast.parse(code).body:
+        names = DefUseVisitor()
+        names.visit(statement)
+        for name in sorted(names.uses | names.mutates):
+            if name not in bound:
+                inputs[name] = None
+        for name in sorted(names.binds | names.mutates):
+            outputs[name] = None
+        bound |= names.binds
+    return list(inputs), list(outputs)
+
+
+def _code_key(const: Any) -> Any:
+    """
+    :returns: what a code object (or another constant in one) does, as something
+      `marshal` can dump. This leaves out where the code was defined (its file name and
+      line numbers) so that the key stays the same after restarting the kernel.
+    """
+    if isinstance(const, types.CodeType):
+        return (
+            const.co_code,
+            const.co_names,
+            const.co_varnames,
+            tuple(_code_key(c) for c in const.co_consts),
+        )
+    if isinstance(const, tuple):
+        return tuple(_code_key(c) for c in const)
+    if isinstance(const, frozenset):
+        # the iteration order of a set of strings changes between processes
+        return ("frozenset", tuple(sorted((_code_key(c) for c in const), key=repr)))
+    return const
+
+
+def _hash_value(value: Any, hasher) -> bool:
+    """
+    Add the contents of `value` to `hasher`.
+    :returns: whether `value` could be hashed by content (if not, only its type is used)
+    """
+    if isinstance(value, types.ModuleType):
+        hasher.update(value.__name__.encode())
+        return True
+    if isinstance(value, types.FunctionType):
+        # functions are pickled by name, so hash their code instead
+        hasher.update(marshal.dumps(_code_key(value.__code__)))
+        defaults = (value.__defaults__, value.__kwdefaults__)
+        return _hash_value(defaults, hasher)
+    try:
+        data, buffers = _pickle_with_buffers(value)
+    except Exception:
+        hasher.update(type(value).__qualname__.encode())
+        return False
+    hasher.update(data)
+    for buffer in buffers:
+        hasher.update(buffer)
+    return True
+
+
+def _evict(cache_dir: str, max_bytes: int) -> None:
+    """Delete the least recently used entries until the cache fits in `max_bytes`."""
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.name.endswith(".pkl"):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_bytes:
+            break
+        os.remove(path)
+        total -= size
+        _cache_stats["evictions"] += 1
+
+
+@magic_arguments()
+@argument(
+    "-d",
+    "--dir",
+    default=None,
+    help=f"Cache directory (default: ${CACHE_DIR_ENV} or ~/.cache/jupyter_magics).",
+)
+@argument(
+    "--max-gb",
+    type=float,
+    default=None,
+    help="Evict the least recently used entries once the cache is larger than this "
+    f"(default: ${CACHE_MAX_GB_ENV} or 10).",
+)
+@argument(
+    "-f", "--force", action="store_true", help="Run the cell even if it's cached."
+)
+@argument(
+    "-c",
+    "--codec",
+    default=DEFAULT_CODEC,
+    choices=list(CODECS),
+    help=f"Compression codec (default: {DEFAULT_CODEC}).",
+)
+@argument("key", help="Name for the cached results (e.g. what the cell computes).")
+def cache(line: str, cell: str) -> None:
+    """
+    Usage: %%cache [-d dir] [--max-gb GB] [-f] [-c codec] key
+    Cache the variables the cell assigns. If the cell has been run before with the
+    same key, source, and values of the variables it reads, those variables are loaded
+    from disk instead of running the cell (e.g. after restarting the kernel).
+    Variables the cell might modify in place (`x[0] = 1`, `model.fit()`) are cached too.
+    Modules are restored by importing them again; other values which can't be pickled
+    (e.g. functions defined in the notebook) aren't cached, so only use this on cells
+    whose other outputs are data. See `%cache_stats` for hits and misses.
+    """
+    args = parse_argstring(cache, line)
+    shell = get_ipython()
+    user_ns = shell.user_ns
+    cache_dir = args.dir or _default_cache_dir()
+    if args.max_gb is not None:
+        max_gb = args.max_gb
+    else:
+        max_gb = float(os.environ.get(CACHE_MAX_GB_ENV, 10))
+    os.makedirs(cache_dir, exist_ok=True)
+
+    inputs, outputs = _cell_inputs_outputs(shell.transform_cell(cell))
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(cell.encode())
+    unhashable = []
+    for name in inputs:
+        if name in user_ns:
+            hasher.update(name.encode())
+            if not _hash_value(user_ns[name], hasher):
+                unhashable.append(name)
+    if unhashable:
+        print(
+            "These inputs can't be pickled, so changes to them won't invalidate the "
+            "cache: " + ", ".join(unhashable)
+        )
+    key = re.sub(r"[^\w.-]", "_", args.key)
+    path = os.path.join(cache_dir, f"{key}-{hasher.hexdigest()}.pkl")
+
+    if not args.force and os.path.exists(path):
+        with open(path, "rb") as f:
+            modules, values, run_time = _load(f)
+        os.utime(path)  # mark as recently used
+        for name, module in modules.items():
+            user_ns[name] = importlib.import_module(module)
+        user_ns.update(values)
+        _cache_stats["hits"] += 1
+        _cache_stats["bytes_read"] += os.path.getsize(path)
+        _cache_stats["seconds_saved"] += run_time
+        return
+
+    _cache_stats["misses"] += 1
+    start = time.perf_counter()
+    result = shell.run_cell(cell)
+    run_time = time.perf_counter() - start
+    if not result.success:
+        return
+
+    modules = {}
+    values = {}
+    skipped = []
+    for name in outputs:
+        if name not in user_ns:
+            continue
+        value = user_ns[name]
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+            continue
+        try:
+            pickle.dumps(value, protocol=5, buffer_callback=lambda buffer: False)
+        except Exception:
+            skipped.append(name)
+        else:
+            values[name] = value
+    if skipped:
+        print("Not cached (can't be pickled): " + ", ".join(skipped))
+
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        _dump((modules, values, run_time), f, args.codec)
+    os.replace(tmp_path, path)
+    _cache_stats["bytes_written"] += os.path.getsize(path)
+    _evict(cache_dir, int(max_gb * 2**30))
+
+
+@magic_arguments()
+@argument("-d", "--dir", default=None, help="Cache directory (see `%%cache`).")
+def cache_stats(line: str) -> Dict[str, Any]:
+    """
+    Usage: %cache_stats [-d dir]
+    Return this session's `%%cache` hits, misses, bytes read and written, run time
+    saved by hits, and evictions, along with the cache's current size on disk.
+    """
+    args = parse_argstring(cache_stats, line)
+    cache_dir = args.dir or _default_cache_dir()
+    n_entries = 0
+    n_bytes = 0
+    if os.path.isdir(cache_dir):
+        for entry in os.scandir(cache_dir):
+            if entry.name.endswith(".pkl"):
+                n_entries += 1
+                n_bytes += entry.stat().st_size
+    return {**_cache_stats, "dir": cache_dir, "entries": n_entries, "size": n_bytes}
+
+
+def load_ipython_extension(ipython) -> None:
+    for magic in (save, saves, load, cache_stats):
+        ipython.register_magic_function(magic, magic_kind="line")
+    ipython.register_magic_function(cache, magic_kind="cell")
+
+
+if get_ipython() is not None:
+    load_ipython_extension(get_ipython())
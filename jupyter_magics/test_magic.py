@@ -1,7 +1,136 @@
+import argparse
+import ast
+import hashlib
 import inspect
+import os
+import pickle
+import statistics
+import time
+import tracemalloc
+from pathlib import Path
 
+from IPython import get_ipython
+from IPython.core.error import UsageError
 from IPython.core.magic import Magics, magics_class, line_magic
 
+try:
+    import numpy as np
+    np_imported = True
+except ImportError:
+    np_imported = False
+
+# appended once to a test file before its first binary test (see `add_test --binary`)
+_FIXTURE_HELPERS = """
+import math
+import pickle
+from pathlib import Path
+
+import numpy as np
+
+FIXTURES_DIR = Path(__file__).resolve().parent / "fixtures"
+
+
+def _load_fixture(name):
+    path = FIXTURES_DIR / name
+    if path.suffix == ".npy":
+        # copy on write so the function under test may modify its arguments
+        return np.load(path, mmap_mode="c")
+    with open(path, "rb") as f:
+        return pickle.load(f)
+
+
+def _assert_close(result, expected, rtol, atol):
+    if type(expected).__module__.startswith("pandas"):
+        import pandas.testing
+
+        if hasattr(expected, "columns"):
+            pandas.testing.assert_frame_equal(result, expected, rtol=rtol, atol=atol)
+        else:
+            pandas.testing.assert_series_equal(result, expected, rtol=rtol, atol=atol)
+    elif isinstance(expected, np.ndarray):
+        assert isinstance(result, np.ndarray), type(result)
+        assert result.shape == expected.shape, (result.shape, expected.shape)
+        if np.issubdtype(expected.dtype, np.number):
+            np.testing.assert_allclose(result, expected, rtol=rtol, atol=atol)
+        else:
+            np.testing.assert_array_equal(result, expected)
+    elif isinstance(expected, dict):
+        assert result.keys() == expected.keys()
+        for key in expected:
+            _assert_close(result[key], expected[key], rtol, atol)
+    elif isinstance(expected, (list, tuple)):
+        assert type(result) == type(expected) and len(result) == len(expected)
+        for result_item, expected_item in zip(result, expected):
+            _assert_close(result_item, expected_item, rtol, atol)
+    elif isinstance(expected, float):
+        assert math.isclose(result, expected, rel_tol=rtol, abs_tol=atol), result
+    else:
+        assert result == expected
+"""
+
+
+def _measure(func, warmup, repeat):
+    """
+    :returns: the median time per call in seconds and the peak traced memory of one
+      call in bytes
+    """
+    for _ in range(warmup):
+        func()
+    # time enough calls per sample that timer resolution and noise matter less
+    number = 1
+    while True:
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        if time.perf_counter() - start >= 0.01 or number >= 10**6:
+            break
+        number *= 10
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            func()
+        times.append((time.perf_counter() - start) / number)
+    tracemalloc.start()
+    try:
+        func()
+        peak_bytes = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return statistics.median(times), peak_bytes
+
+
+def _check_benchmark(
+    func, baseline_seconds, baseline_peak_bytes, warmup, repeat, threshold
+):
+    threshold = float(os.environ.get("BENCHMARK_THRESHOLD", threshold))
+    seconds, peak_bytes = _measure(func, warmup, repeat)
+    message = f"took {seconds:.4g}s; baseline {baseline_seconds:.4g}s"
+    assert seconds <= baseline_seconds * (1 + threshold), message
+    # allow for small absolute changes in memory
+    max_bytes = max(baseline_peak_bytes * (1 + threshold), baseline_peak_bytes + 2**20)
+    message = f"peak memory {peak_bytes} bytes; baseline {baseline_peak_bytes} bytes"
+    assert peak_bytes <= max_bytes, message
+
+
+# appended once to a test file before its first benchmark (see `add_benchmark`); the
+# kernel uses the same `_measure` so that baselines and checks are comparable
+_BENCHMARK_HELPERS = (
+    "\nimport os\nimport statistics\nimport time\nimport tracemalloc\n\n\n"
+    + inspect.getsource(_measure)
+    + "\n\n"
+    + inspect.getsource(_check_benchmark)
+)
+_MAX_INLINE_REPR = 200
+
+
+def _is_inline(value) -> bool:
+    """Whether `value` can be written into a test as its repr."""
+    if value is None or isinstance(value, (bool, int, float, complex, str, bytes)):
+        return len(repr(value)) <= _MAX_INLINE_REPR
+    return False
+
+
 @magics_class
 class TestMagics(Magics):
     test_path = None
@@ -16,7 +145,19 @@ class TestMagics(Magics):
 
     @line_magic
     def add_test(self, line):
-        """        
+        """
+        Usage: %add_test [-b/--binary [--rtol RTOL] [--atol ATOL]] func(args...)
+        Add a test of `func(args...)` to the test path which checks that it returns
+        what it returns now.
+
+        With --binary, the call is evaluated once and its arguments and result are
+        stored as fixtures (.npy for arrays, pickles otherwise) in a `fixtures`
+        directory next to the test file, named by a hash of their contents so that
+        identical values are only stored once. Each test loads its fixtures when it
+        runs (not when the file is imported) and compares the result with tolerance
+        (numeric arrays, floats, and pandas objects use `rtol`/`atol`). Only short
+        scalars and strings are written inline.
+
         Caveats
         * no imports are added, so you'll likely need to include some of those for the
           test to work
@@ -28,6 +169,11 @@ class TestMagics(Magics):
         * `line` may be evaluated fully or partially more than once while generating the
           test case (so only use pure functions)
         """
+        if line.startswith("-"):
+            options, line = self._parse_options(line)
+            if options.binary:
+                return self._add_binary_test(line, options.rtol, options.atol)
+
         assert line.endswith(")")
 
         func_name, arg_str = line[:-1].split("(", 1)
@@ -54,4 +200,221 @@ class TestMagics(Magics):
             f.write(test)
         return expected
 
-get_ipython().register_magics(TestMagics)
+    @staticmethod
+    def _parse_options(line):
+        """:returns: the parsed options at the start of `line` and the rest of it"""
+        parser = argparse.ArgumentParser(prog="%add_test", add_help=False)
+        parser.add_argument("-b", "--binary", action="store_true")
+        # None (not given) so that they can be rejected without --binary
+        parser.add_argument("--rtol", type=float)
+        parser.add_argument("--atol", type=float)
+        tokens = []
+        while line.startswith("-"):
+            token, _, line = line.partition(" ")
+            tokens.append(token)
+            if token in ("--rtol", "--atol"):
+                value, _, line = line.lstrip().partition(" ")
+                tokens.append(value)
+            line = line.lstrip()
+        try:
+            options = parser.parse_args(tokens)
+        except SystemExit:
+            raise UsageError(f"Invalid options for %add_test: {' '.join(tokens)}")
+        if not options.binary and (options.rtol, options.atol) != (None, None):
+            raise UsageError("--rtol and --atol only apply with -b/--binary.")
+        if options.rtol is None:
+            options.rtol = 1e-7
+        if options.atol is None:
+            options.atol = 0.0
+        return options, line
+
+    def _store_fixture(self, value) -> str:
+        """
+        Save `value` in the fixtures directory next to the test file.
+        :returns: the fixture's file name
+        """
+        if np_imported and type(value) is np.ndarray and not value.dtype.hasobject:
+            data = value.tobytes()
+            header = f"{value.dtype.str}{value.shape}".encode()
+            suffix = ".npy"
+        else:
+            data = pickle.dumps(value, protocol=4)
+            header = b""
+            suffix = ".pkl"
+        name = hashlib.blake2b(header + data, digest_size=12).hexdigest() + suffix
+        fixtures_dir = self.test_path.parent / "fixtures"
+        fixtures_dir.mkdir(exist_ok=True)
+        path = fixtures_dir / name
+        if not path.exists():  # fixtures with the same contents are shared
+            tmp_path = path.with_suffix(".tmp")
+            if suffix == ".npy":
+                with open(tmp_path, "wb") as f:
+                    np.save(f, value, allow_pickle=False)
+            else:
+                tmp_path.write_bytes(data)
+            tmp_path.replace(path)
+        return name
+
+    def _capture_call(self, line):
+        """
+        Parse `line` as a call and evaluate the function and each argument once.
+        :returns: (source of the function, function, argument names, positional
+          arguments, keyword arguments)
+        """
+        try:
+            call = ast.parse(line.strip(), mode="eval").body
+        except SyntaxError:
+            raise UsageError(f"Can't parse {line!r}.")
+        if (
+            not isinstance(call, ast.Call)
+            or any(isinstance(arg, ast.Starred) for arg in call.args)
+            or any(keyword.arg is None for keyword in call.keywords)
+        ):
+            raise UsageError("Expected a call like func(x, y=1) (without * or **).")
+
+        def evaluate(node):
+            return eval(
+                compile(ast.Expression(node), "<add_test>", "eval"), self.shell.user_ns
+            )
+
+        func = evaluate(call.func)
+        args = [evaluate(arg) for arg in call.args]
+        kwargs = {keyword.arg: evaluate(keyword.value) for keyword in call.keywords}
+        try:
+            param_names = list(inspect.signature(func).parameters)
+        except (TypeError, ValueError):  # e.g. some builtins
+            param_names = []
+        arg_names = [
+            (
+                param_names[i]
+                if i < len(param_names) and param_names[i] not in kwargs
+                else f"arg{i}"
+            )
+            for i in range(len(args))
+        ]
+        return ast.unparse(call.func), func, arg_names, args, kwargs
+
+    def _value_source(self, value, in_memory: bool = False) -> str:
+        """
+        :param in_memory: read array fixtures into memory instead of memory mapping
+          them (e.g. so that benchmarks don't time reading from disk)
+        :returns: code which recreates `value` (inline or from a fixture)
+        """
+        if _is_inline(value):
+            return repr(value)
+        name = self._store_fixture(value)
+        if in_memory and name.endswith(".npy"):
+            return f"np.array(_load_fixture({name!r}))"
+        return f"_load_fixture({name!r})"
+
+    def _write_test(self, test_name, body, helpers):
+        """
+        Append a test function to the test file, adding `helpers` first if the file
+        doesn't have them yet.
+        :param helpers: (name of a function which must be defined, its source) pairs
+        :returns: the name of the test (numbered if `test_name` was already used)
+        """
+        existing = self.test_path.read_text() if self.test_path.exists() else ""
+        name = test_name
+        i = 2
+        while f"def {name}(" in existing:
+            name = f"{test_name}_{i}"
+            i += 1
+        indent = " " * 4
+        test = "\n".join(
+            ["", "", f"def {name}():", *(f"{indent}{line}" for line in body), ""]
+        )
+        with open(self.test_path, "a") as f:
+            for helper_name, source in helpers:
+                if f"def {helper_name}(" not in existing:
+                    f.write(source)
+            f.write(test)
+        return name
+
+    def _add_binary_test(self, line, rtol, atol):
+        func_source, func, arg_names, args, kwargs = self._capture_call(line)
+        # store the arguments before the call in case it modifies them
+        body = [
+            f"{name} = {self._value_source(value)}"
+            for name, value in [*zip(arg_names, args), *kwargs.items()]
+        ]
+        result = func(*args, **kwargs)
+
+        call_args = [*arg_names, *(f"{name}={name}" for name in kwargs)]
+        body += [
+            f"result = {func_source}({', '.join(call_args)})",
+            f"expected = {self._value_source(result)}",
+            f"_assert_close(result, expected, rtol={rtol!r}, atol={atol!r})",
+        ]
+        func_name = func_source.rsplit(".", 1)[-1]
+        self._write_test(
+            f"test_{func_name}", body, [("_load_fixture", _FIXTURE_HELPERS)]
+        )
+        return result
+
+    @line_magic
+    def add_benchmark(self, line):
+        """
+        Usage: %add_benchmark [-w WARMUP] [-r REPEAT] [-t THRESHOLD] func(args...)
+        Add a benchmark of `func(args...)` to the test path: the call is timed in the
+        kernel now (median of REPEAT runs after WARMUP runs) and its peak memory is
+        measured with tracemalloc. The generated pytest test repeats the measurement
+        and fails if either is more than THRESHOLD (a fraction, default 0.5) above
+        this baseline; set the BENCHMARK_THRESHOLD environment variable to override
+        it (e.g. on slower CI machines). Arguments are stored as in
+        `%add_test --binary`, but arrays are read into memory before timing.
+        :returns: the baseline measurements
+        """
+        parser = argparse.ArgumentParser(prog="%add_benchmark", add_help=False)
+        parser.add_argument("-w", "--warmup", type=int, default=1)
+        parser.add_argument("-r", "--repeat", type=int, default=5)
+        parser.add_argument("-t", "--threshold", type=float, default=0.5)
+        tokens = []
+        while line.startswith("-"):
+            option, _, line = line.partition(" ")
+            value, _, line = line.lstrip().partition(" ")
+            tokens += [option, value]
+            line = line.lstrip()
+        try:
+            options = parser.parse_args(tokens)
+        except SystemExit:
+            raise UsageError(f"Invalid options for %add_benchmark: {' '.join(tokens)}")
+
+        func_source, func, arg_names, args, kwargs = self._capture_call(line)
+        body = [
+            f"{name} = {self._value_source(value, in_memory=True)}"
+            for name, value in [*zip(arg_names, args), *kwargs.items()]
+        ]
+        seconds, peak_bytes = _measure(
+            lambda: func(*args, **kwargs), options.warmup, options.repeat
+        )
+
+        call_args = [*arg_names, *(f"{name}={name}" for name in kwargs)]
+        body += [
+            "_check_benchmark(",
+            f"    lambda: {func_source}({', '.join(call_args)}),",
+            f"    baseline_seconds={seconds!r},",
+            f"    baseline_peak_bytes={peak_bytes!r},",
+            f"    warmup={options.warmup!r},",
+            f"    repeat={options.repeat!r},",
+            f"    threshold={options.threshold!r},",
+            ")",
+        ]
+        func_name = func_source.rsplit(".", 1)[-1]
+        self._write_test(
+            f"test_benchmark_{func_name}",
+            body,
+            [
+                ("_load_fixture", _FIXTURE_HELPERS),
+                ("_check_benchmark", _BENCHMARK_HELPERS),
+            ],
+        )
+        return {"seconds": seconds, "peak_bytes": peak_bytes}
+
+
+def load_ipython_extension(ipython) -> None:
+    ipython.register_magics(TestMagics)
+
+
+if get_ipython() is not None:
+    load_ipython_extension(get_ipython())
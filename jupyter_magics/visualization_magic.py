@@ -1,9 +1,24 @@
 from __future__ import annotations
 
 import gzip
+import importlib.util
+import io
+import json
+import mmap
+import multiprocessing
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
 import time
-from functools import partial
-from typing import Any, Callable, Dict, Optional, Sequence, Tuple, Union
+import weakref
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache, partial
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 import numpy as np
 from IPython import display, get_ipython
@@ -29,6 +44,22 @@ except ImportError:
     mpl_imported = False
 
 
+def _find_ffmpeg() -> Optional[str]:
+    """:returns: the path to an ffmpeg executable or None if none can be found"""
+    ffmpeg = shutil.which("ffmpeg")
+    if ffmpeg is None:
+        try:
+            import imageio_ffmpeg
+
+            ffmpeg = imageio_ffmpeg.get_ffmpeg_exe()
+        except (ImportError, RuntimeError):
+            pass
+    return ffmpeg
+
+
+ffmpeg_path = _find_ffmpeg()
+
+
 def check_type(o: Any, target_type: str) -> bool:
     """
     Check if `o`'s class path + name matches `target_type`.
@@ -40,16 +71,27 @@ def check_type(o: Any, target_type: str) -> bool:
     the code by handling import errors if any of these are missing, importing comet-ml
     before pytorch, etc.).
     """
-    return str(type(o)) == f"<class '{target_type}'>"
+    return _type_path(type(o)) == target_type
+
+
+@lru_cache(maxsize=None)
+def _type_path(cls: type) -> str:
+    return f"{cls.__module__}.{cls.__qualname__}"
 
 
 def is_chw(img: np.ndarray) -> bool:
     return img.ndim == 3 and img.shape[0] == 3 and img.shape[2] != 3
 
 
+def is_bchw(shape: Tuple[int, ...]) -> bool:
+    return len(shape) == 4 and shape[1] in (1, 3) and shape[3] not in (1, 3)
+
+
 def normalize_img(img) -> np.ndarray:
     """Converts `img` to a HWC or HW numpy array."""
-    if check_type(img, "torch.Tensor"):
+    if isinstance(img, np.ndarray):
+        pass
+    elif check_type(img, "torch.Tensor"):
         img = img.detach().cpu().numpy()
     elif check_type(img, "PIL.Image.Image"):
         img = np.array(img)
@@ -67,6 +109,77 @@ def normalize_img(img) -> np.ndarray:
     return img
 
 
+def normalize_imgs(
+    imgs, out: Optional[np.ndarray] = None, to_uint8: bool = True
+) -> np.ndarray:
+    """
+    Converts a batch of images to one contiguous BHWC or BHW numpy array.
+
+    :param imgs: a BCHW or BHWC (or BHW) torch tensor or numpy array, or a sequence of
+      images that `normalize_img` can handle. Single-channel images are returned as BHW.
+      A torch tensor is permuted (and scaled, if `to_uint8`) on its device and then
+      copied to the host in one transfer.
+    :param out: array to write the result into (e.g. one reused between batches)
+    :param to_uint8: if True, float images (assumed to be in [0, 1]) are scaled to
+      [0, 255] and converted to uint8.
+    """
+    if check_type(imgs, "torch.Tensor"):
+        imgs = imgs.detach()
+        if is_bchw(imgs.shape):
+            imgs = imgs.permute(0, 2, 3, 1)
+        if to_uint8 and imgs.is_floating_point():
+            imgs = imgs.mul(255).clamp_(0, 255).round_().byte()
+        imgs = imgs.contiguous().cpu().numpy()
+    elif not isinstance(imgs, np.ndarray):
+        imgs = [normalize_img(img) for img in imgs]
+        if not imgs:
+            raise ValueError("Can't normalize an empty batch of images.")
+
+    if isinstance(imgs, np.ndarray):
+        if is_bchw(imgs.shape):
+            imgs = imgs.transpose(0, 2, 3, 1)
+        if imgs.ndim == 4 and imgs.shape[3] == 1:
+            imgs = imgs[..., 0]
+        if imgs.ndim not in (3, 4):
+            raise ValueError(
+                f"Don't know how to handle a batch with {imgs.ndim=}; "
+                "expected ndim = 3 or 4."
+            )
+        shape = imgs.shape
+        dtype = imgs.dtype
+    else:
+        shape = (len(imgs), *imgs[0].shape)
+        dtype = imgs[0].dtype
+    if to_uint8:
+        dtype = np.uint8
+
+    if out is None:
+        if isinstance(imgs, np.ndarray) and imgs.dtype == dtype:
+            return np.ascontiguousarray(imgs)
+        out = np.empty(shape, dtype)
+    if isinstance(imgs, np.ndarray):
+        _copy_scaled(out, imgs)
+    else:
+        for i, img in enumerate(imgs):
+            _copy_scaled(out[i], img)
+    return out
+
+
+def _copy_scaled(dst: np.ndarray, src: np.ndarray) -> None:
+    """
+    Copy `src` into `dst`, scaling [0, 1] floats to [0, 255] if `dst` is uint8.
+
+    The copy also does any transpose needed, since `src` can be a strided view.
+    """
+    if src.dtype.kind == "f" and dst.dtype == np.uint8:
+        scaled = np.multiply(src, 255, dtype=np.float32)
+        np.clip(scaled, 0, 255, out=scaled)
+        np.rint(scaled, out=scaled)
+        np.copyto(dst, scaled, casting="unsafe")
+    else:
+        np.copyto(dst, src, casting="unsafe")
+
+
 @magics_class
 class MplAnimation(Magics):
     magic_name = "anim"
@@ -75,27 +188,200 @@ class MplAnimation(Magics):
     @cell_magic
     @no_var_expand
     def anim(self, line: str, cell: str) -> None:
-        lines = [f"{self.rec_name} = Recorder({line})"]
+        # Recorder may not be in the user namespace (e.g. if loaded as an extension)
+        self.shell.user_ns[self.rec_name] = eval(
+            f"_Recorder({line})", {"_Recorder": Recorder}, self.shell.user_ns
+        )
+        lines = []
         for line in cell.split("\n"):
             if line.strip().startswith(f"%{self.magic_name} "):
                 line = line.replace(f"%{self.magic_name} ", f"{self.rec_name}.add_frame(") + ")"
             lines.append(line)
         cell = "\n".join(lines)
-        self.shell.ex(cell)
-        recorder = self.shell.user_ns.pop(self.rec_name)
+        recorder = self.shell.user_ns[self.rec_name]
+        try:
+            self.shell.ex(cell)
+        except BaseException:
+            recorder.abort()
+            raise
+        finally:
+            self.shell.user_ns.pop(self.rec_name, None)
         return recorder.to_video()
 
 
+class _FFmpegWriter:
+    """Encode frames by piping their raw bytes to an ffmpeg subprocess."""
+
+    _pix_fmts = {1: "gray", 3: "rgb24", 4: "rgba"}
+
+    def __init__(
+        self,
+        fname: str,
+        frame_shape: Tuple[int, ...],
+        fps: float = 30,
+        codec: str = "libx264",
+        crf: Optional[int] = None,
+    ):
+        """
+        :param frame_shape: HWC or HW shape of the (uint8) frames to be written
+        :param crf: constant rate factor (lower = higher quality); ffmpeg's default for
+          `codec` if None
+        """
+        if ffmpeg_path is None:
+            raise RuntimeError("ffmpeg isn't installed.")
+        height, width = frame_shape[:2]
+        n_channels = frame_shape[2] if len(frame_shape) == 3 else 1
+        pix_fmt = self._pix_fmts[n_channels]
+        self.fname = fname
+        # keep stderr in a file so that a chatty ffmpeg can't fill a pipe and block
+        self._stderr = tempfile.TemporaryFile()
+        cmd = [
+            ffmpeg_path,
+            *("-loglevel", "error", "-y"),
+            *("-f", "rawvideo", "-pix_fmt", pix_fmt, "-s", f"{width}x{height}"),
+            *("-r", str(fps), "-i", "-"),
+            # yuv420p needs even dimensions
+            *("-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2"),
+            *("-c:v", codec, "-pix_fmt", "yuv420p"),
+            *(() if crf is None else ("-crf", str(crf))),
+            *("-movflags", "+faststart", fname),
+        ]
+        self._process = subprocess.Popen(
+            cmd, stdin=subprocess.PIPE, stderr=self._stderr
+        )
+
+    def write(self, frames: np.ndarray) -> None:
+        """:param frames: one uint8 frame or a batch of them"""
+        try:
+            self._process.stdin.write(memoryview(np.ascontiguousarray(frames)))
+        except BrokenPipeError:
+            self.close()  # raises with ffmpeg's error message
+
+    def close(self) -> None:
+        try:
+            if not self._process.stdin.closed:
+                self._process.stdin.close()
+        except BrokenPipeError:
+            pass  # ffmpeg already exited; its exit code and stderr say why
+        try:
+            if self._process.wait():
+                self._stderr.seek(0)
+                raise RuntimeError(
+                    f"ffmpeg failed writing {self.fname}:\n"
+                    f"{self._stderr.read().decode()}"
+                )
+        finally:
+            self._stderr.close()
+
+    def kill(self) -> None:
+        """Stop ffmpeg without finishing the video (`close` still cleans up)."""
+        self._process.kill()
+        self._process.wait()
+
+
 class Recorder:
-    def __init__(self, repeat: bool = True, fps: int=30):
+    """
+    Collects frames for `%%anim` and turns them into a video.
+
+    With the "ffmpeg" backend, frames are piped to an ffmpeg encoder on a background
+    thread as they're added, so encoding overlaps with the rest of the cell and frames
+    aren't kept in memory. The video is embedded in the notebook unless it's larger
+    than `max_inline_mb`; then the file is moved to `video_dir` (relative to the
+    working directory, normally the notebook's directory) and referenced instead. The "mpl" backend draws each frame
+    with matplotlib and embeds the result.
+    """
+
+    video_dir = "anim_videos"
+
+    def __init__(
+        self,
+        repeat: bool = True,
+        fps: int = 30,
+        fname: Optional[str] = None,
+        max_inline_mb: float = 10,
+        backend: str = "auto",
+        max_pending: int = 64,
+    ):
+        """
+        :param fname: video file to write with the ffmpeg backend. By default, a
+          temporary file is used, which is deleted if the video is embedded.
+        :param backend: "ffmpeg", "mpl", or "auto" (ffmpeg if it's installed)
+        :param max_pending: max number of frames waiting to be encoded before adding
+          frames blocks
+        """
+        if backend == "auto":
+            backend = "ffmpeg" if ffmpeg_path else "mpl"
+        if backend not in ("ffmpeg", "mpl"):
+            raise ValueError(f"Unknown {backend=}; expected 'ffmpeg' or 'mpl'.")
         self.frames = []
         self.repeat = repeat
+        self.fps = fps
         self.delay = 1000 // fps
+        self.backend = backend
+        self.max_inline_mb = max_inline_mb
+        self.fname = fname
+        self._temp_video = fname is None
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._encoder_thread = None
+        self._writer = None
+        self._encoder_errors = []
+        self._frame_shape = None
 
     def add_frame(self, frame):
-        self.frames.append(normalize_img(frame))
+        """
+        Add one frame or, if `frame` is a sequence or has a batch dimension of size > 1,
+        a batch of frames (see `add_frames`).
+        """
+        if isinstance(frame, (list, tuple)) or (
+            getattr(frame, "ndim", 0) == 4 and frame.shape[0] != 1
+        ):
+            self.add_frames(frame)
+        else:
+            # a batch of one, so single frames are converted the same way as batches
+            self.add_frames(normalize_img(frame)[None])
+
+    def add_frames(self, frames):
+        """Add a batch of frames; see `normalize_imgs` for the supported formats."""
+        if self.backend == "ffmpeg":
+            self._encode(frames)
+        else:
+            self.frames.extend(normalize_imgs(frames))
+
+    def _encode(self, frames) -> None:
+        """Queue a batch of frames for encoding."""
+        batch = normalize_imgs(frames)
+        if batch is frames or not batch.flags.owndata:
+            # the caller may modify the frames while they're waiting to be encoded
+            batch = batch.copy()
+        frames = batch
+        self._check_encoder()
+        if self._encoder_thread is None:
+            self._frame_shape = frames.shape[1:]
+            if self.fname is None:
+                fd, self.fname = tempfile.mkstemp(prefix="anim-", suffix=".mp4")
+                os.close(fd)
+            self._writer = _FFmpegWriter(self.fname, self._frame_shape, self.fps)
+            self._encoder_thread = threading.Thread(
+                target=_encode_loop,
+                args=(self._writer, self._queue, self._encoder_errors),
+                daemon=True,
+            )
+            self._encoder_thread.start()
+        elif frames.shape[1:] != self._frame_shape:
+            raise ValueError(
+                f"Frame shape {frames.shape[1:]} doesn't match the video's "
+                f"{self._frame_shape}."
+            )
+        self._queue.put(frames)
+
+    def _check_encoder(self) -> None:
+        if self._encoder_errors:
+            error = self._encoder_errors[0]
+            raise RuntimeError("Encoding the video failed.") from error
 
     def to_video(self):
+        if self.backend == "ffmpeg":
+            return self._finish_encoding()
         if not self.frames:
             return
         fig = plt.figure()
@@ -112,9 +398,66 @@ class Recorder:
         )
         return display.HTML(anim.to_html5_video())
 
+    def _finish_encoding(self):
+        if self._encoder_thread is None:
+            return
+        self._queue.put(None)
+        self._encoder_thread.join()
+        self._check_encoder()
+
+        html_attributes = "controls autoplay loop" if self.repeat else "controls"
+        size_mb = os.path.getsize(self.fname) / 2**20
+        if size_mb > self.max_inline_mb:
+            if self._temp_video:
+                # keep the video where the notebook can reference it
+                os.makedirs(self.video_dir, exist_ok=True)
+                fname = os.path.join(self.video_dir, os.path.basename(self.fname))
+                shutil.move(self.fname, fname)
+                self.fname = fname
+                self._temp_video = False
+            return display.Video(self.fname, html_attributes=html_attributes)
+        with open(self.fname, "rb") as f:
+            data = f.read()
+        if self._temp_video:
+            os.remove(self.fname)
+        return display.Video(
+            data, embed=True, mimetype="video/mp4", html_attributes=html_attributes
+        )
+
+    def abort(self) -> None:
+        """Stop encoding and delete the partial video (e.g. if the cell failed)."""
+        if self._encoder_thread is None:
+            return
+        # writing to the killed ffmpeg fails, so the encoder thread drops the rest
+        self._writer.kill()
+        self._queue.put(None)
+        self._encoder_thread.join()
+        if os.path.exists(self.fname):
+            os.remove(self.fname)
+
+
+def _encode_loop(writer: _FFmpegWriter, frames: queue.Queue, errors: list) -> None:
+    """Write batches of frames from `frames` to `writer` until None is received."""
+    while True:
+        batch = frames.get()
+        if batch is None:
+            try:
+                writer.close()
+            except Exception as e:
+                errors.append(e)
+            return
+        try:
+            if not errors:
+                writer.write(batch)
+        except Exception as e:
+            errors.append(e)
+
 
 @magics_class
 class Vis(Magics):
+    # `%img -c` in a loop only updates the display at most this often
+    max_fps = 30
+
     def __init__(self, shell):
         super().__init__(shell)
         self.vis = None
@@ -131,7 +474,10 @@ class Vis(Magics):
         line = line.strip()
         if line.startswith("-c "):
             line = line[3:]
-        else:
+        elif self.vis is not None:
+            # show the last image and stop the old visualizer's display thread
+            self.vis.flush()
+            self.vis.close()
             self.vis = None
 
         self.shell.ex(f"_ = {line}")
@@ -145,18 +491,24 @@ class Vis(Magics):
                 raise ValueError(
                     f"Don't know how to handle image with ndim = {img.ndim}; expected ndim = 2 or 3."
                 )
-            self.vis = Visualizer(opts=opts)
+            self.vis = Visualizer(opts=opts, max_fps=self.max_fps)
         self.vis(img)
 
-if hv_imported:
-    get_ipython().register_magics(Vis)
-else:
-    print("Can't register %img magic because holoviews is missing.")
 
-if mpl_imported:
-    get_ipython().register_magics(MplAnimation)
-else:
-    print("Can't register %anim magic because matplotlib is missing.")
+def load_ipython_extension(ipython) -> None:
+    if hv_imported:
+        ipython.register_magics(Vis)
+    else:
+        print("Can't register %img magic because holoviews is missing.")
+
+    if mpl_imported or ffmpeg_path:
+        ipython.register_magics(MplAnimation)
+    else:
+        print("Can't register %anim magic because matplotlib and ffmpeg are missing.")
+
+
+if get_ipython() is not None:
+    load_ipython_extension(get_ipython())
 
 
 #
@@ -196,7 +548,46 @@ class Visualizer:
         multi: bool = False,
         n_cols: int = 3,
         show: bool = True,
+        max_obs_in_memory: int = 1024,
+        obs_fname: Optional[str] = None,
+        max_fps: Optional[float] = None,
+        backend: str = "holoviews",
+        image_format: str = "jpeg",
+        quality: int = 75,
+        downscale: int = 1,
+        tile_labels: Union[bool, Sequence[str]] = False,
+        label_opts: Optional[Dict[str, Any]] = None,
     ):
+        """
+        :param multi: whether each observation is a batch of frames (e.g. one per
+          environment). They're shown as the tiles of a single image with `n_cols`
+          columns; `opts` apply to that whole image.
+        :param save_obs: whether to keep the observations (for `replay`, `save_video`,
+          and `save_frames`). Only the most recent `max_obs_in_memory` are kept in
+          memory; older ones are written to disk in the background.
+        :param max_obs_in_memory: size of the in-memory buffer of saved observations
+        :param obs_fname: ".frames" file to spill saved observations to; a temporary
+          file is used by default.
+        :param max_fps: if given, the display is updated from a background thread at
+          most this many times per second, always with the latest observation, and
+          observations that arrive in between are skipped. Calling the visualizer then
+          only stores a copy of the observation (so it's fine to keep modifying the
+          array afterwards). See `display_stats` and `close`.
+        :param backend: "holoviews" or "widget". The widget backend sends each frame as
+          a compressed image (see `image_format`) over a single `ipywidgets.Image`, which
+          uses much less bandwidth (e.g. over a remote connection) than sending raw
+          arrays to holoviews. It needs ipywidgets and either cv2 or PIL.
+        :param image_format: "jpeg", "png", or "webp" (widget backend only)
+        :param quality: JPEG/WebP quality from 0 to 100 (widget backend only)
+        :param downscale: only every `downscale`th row and column is shown (widget
+          backend or multi mode only)
+        :param tile_labels: in multi mode with the holoviews backend, a label for each
+          tile, or True to label the tiles with their indices
+        :param label_opts: holoviews options for the tile labels (e.g.
+          `{"text_color": "white"}`)
+        """
+        if backend not in ("holoviews", "widget"):
+            raise ValueError(f"Unknown {backend=}; expected 'holoviews' or 'widget'.")
         if obs_transform is None:
             obs_transform = lambda x: x
         self.opts = opts or {}
@@ -204,32 +595,30 @@ class Visualizer:
         self.n_cols = n_cols
         self.show = show
         self.obs = []
+        if save_obs:
+            spill_size = min(256, max_obs_in_memory)
+            self.obs = FrameBuffer(max_obs_in_memory, obs_fname, spill_size)
         self.save_obs = save_obs
         self.obs_transform = obs_transform
+        self.max_fps = max_fps
+        self.backend = backend
+        self.image_format = image_format
+        self.quality = quality
+        self.downscale = downscale
+        self.tile_labels = tile_labels
+        self.label_opts = label_opts or {}
         self.update = None
+        self.n_obs = 0
 
     def _get_dmap_updater(self, obs: np.ndarray):
-        example = {"img": obs[None]}  # add dimension so length=1 means 1 image
-        stream = hv.streams.Buffer(example, length=1)
-        Element = hv.RGB if obs.ndim - int(self.multi) == 3 else hv.Image
         if self.multi:
+            return self._get_tiled_dmap_updater(obs)
 
-            def callback(obs):
-                plot = None
-                for ob in obs:
-                    if plot is None:
-                        plot = Element(ob).opts(**self.opts)
-                    else:
-                        plot += Element(ob).opts(**self.opts)
-                if self.n_cols:
-                    plot.cols(self.n_cols)
-                return plot
-
-        else:
-            callback = lambda obs: Element(obs).opts(**self.opts)
-
+        example = {"img": obs[None]}  # add dimension so length=1 means 1 image
+        stream = hv.streams.Buffer(example, length=1)
+        Element = hv.RGB if obs.ndim == 3 else hv.Image
         img_dmap = hv.DynamicMap(
-            lambda data: callback(data["img"][0]), streams=[stream]
+            lambda data: Element(data["img"][0]).opts(**self.opts), streams=[stream]
         )
 
         def update(data):
@@ -238,8 +627,64 @@ class Visualizer:
         display.display(img_dmap)
         return update
 
+    def _get_tiled_dmap_updater(self, obs: np.ndarray):
+        """Show a batch of frames as the tiles of a single image (see `_TileCompositor`)."""
+        compositor = _TileCompositor(self.n_cols, self.downscale)
+        # the canvas is reused for the next batch, so send copies which holoviews can
+        # keep (e.g. while rendering on another thread)
+        pipe = hv.streams.Pipe(data=compositor.compose(obs).copy())
+        Element = hv.RGB if np.ndim(obs) == 4 else hv.Image
+
+        def callback(data: np.ndarray):
+            # pixel coordinates, so that labels can be placed on the tiles
+            bounds = (0, 0, data.shape[1], data.shape[0])
+            return Element(data, bounds=bounds).opts(**self.opts)
+
+        plot = hv.DynamicMap(callback, streams=[pipe])
+        if self.tile_labels:
+            positions = compositor.label_positions()
+            texts = self.tile_labels
+            if texts is True:
+                texts = [str(i) for i in range(len(positions))]
+            labels = [(x, y, text) for (x, y), text in zip(positions, texts)]
+            plot = plot * hv.Labels(labels).opts(**self.label_opts)
+
+        def update(obs):
+            pipe.send(compositor.compose(obs).copy())
+
+        display.display(plot)
+        return update
+
+    def _get_widget_updater(self, obs: np.ndarray):
+        import ipywidgets
+
+        if self.multi:
+            # the compositor downscales the tiles, so the encoder doesn't need to
+            compositor = _TileCompositor(self.n_cols, self.downscale)
+            encoder = _FrameEncoder(self.image_format, self.quality)
+            obs = compositor.compose(obs)
+        else:
+            encoder = _FrameEncoder(self.image_format, self.quality, self.downscale)
+        widget = ipywidgets.Image(value=encoder.encode(obs), format=self.image_format)
+
+        def update(obs):
+            if self.multi:
+                obs = compositor.compose(obs)
+            data = encoder.encode(obs)
+            if data is not None:  # None means the frame didn't change
+                widget.value = data
+
+        display.display(widget)
+        return update
+
+    def _get_updater(self, obs: np.ndarray):
+        if self.backend == "widget":
+            return self._get_widget_updater(obs)
+        return self._get_dmap_updater(obs)
+
     def __call__(self, obs: np.ndarray) -> None:
         obs = self.obs_transform(obs)
+        self.n_obs += 1
         if self.save_obs:
             self.obs.append(obs)
 
@@ -249,30 +694,90 @@ class Visualizer:
         if self.update:
             self.update(obs)
         else:
-            self.update = self._get_dmap_updater(obs)
+            # the first update is always synchronous so that the plot is displayed in
+            # the output of the cell that's running now
+            self.update = self._get_updater(obs)
+            if self.max_fps:
+                self.update = _RateLimitedUpdater(self.update, self.max_fps)
+
+    @property
+    def display_stats(self) -> Dict[str, int]:
+        """Number of observations received, displayed, and skipped (dropped)."""
+        if isinstance(self.update, _RateLimitedUpdater):
+            # +1 for the synchronous first update
+            n_displayed = self.update.n_displayed + 1
+            n_pending = int(self.update.pending)
+        else:
+            n_displayed = self.n_obs if self.update and self.show else 0
+            n_pending = 0
+        return {
+            "received": self.n_obs,
+            "displayed": n_displayed,
+            "dropped": self.n_obs - n_displayed - n_pending if self.show else 0,
+        }
+
+    def flush(self) -> None:
+        """Wait until the latest observation has been displayed."""
+        if isinstance(self.update, _RateLimitedUpdater):
+            self.update.flush()
+
+    def close(self) -> None:
+        """Stop the background display thread (if `max_fps` was given)."""
+        if isinstance(self.update, _RateLimitedUpdater):
+            self.update.close()
+
+    def extend(self, frames) -> None:
+        """
+        Add a batch of observations at once (e.g. a BCHW tensor straight off the GPU).
+
+        The batch is converted with one call to `normalize_imgs`. If `multi`, `frames`
+        should be a sequence of steps, each of which is a batch of frames (one per video).
+        """
+        if self.multi:
+            for step in frames:
+                self(normalize_imgs(step))
+        else:
+            for frame in normalize_imgs(frames):
+                self(frame)
 
-    def save_video(self, fname: str, fps: int = 30, fourcc: str = "MP4V") -> None:
+    def save_video(
+        self,
+        fname: str,
+        fps: int = 30,
+        fourcc: str = "MP4V",
+        n_workers: int = 1,
+        codec: str = "libx264",
+        crf: Optional[int] = None,
+        progress: bool = True,
+    ) -> None:
         """
         :param fname: should probably be a .mp4 file if using MP4V on Mac
+        :param fourcc: codec used by cv2 when `n_workers` is 1
+        :param n_workers: if > 1, the video is encoded in parallel segments with ffmpeg
+          (see `export_video`); `codec`, `crf`, and `progress` only apply then.
         """
+        if n_workers > 1:
+            export_video(self.obs, fname, fps, codec, crf, n_workers, progress=progress)
+            return
+
         try:
             import cv2
         except ImportError:
             raise RuntimeError("save_video only works if cv2 is installed.")
 
         cc = cv2.VideoWriter_fourcc(*fourcc)
-        writer = cv2.VideoWriter(fname, cc, fps, self.obs[0].shape[:-1][::-1])
+        writer = cv2.VideoWriter(fname, cc, fps, self.obs[0].shape[:2][::-1])
         for frame in self.obs:
-            writer.write(frame[..., ::-1])  # convert to BGR
+            writer.write(_to_bgr(frame))
         writer.release()
 
-    def save_frames(self, fname: str) -> None:
+    def save_frames(self, fname: str, **kwargs) -> str:
         """
-        Save the collected observations to a .npy.gz file.
+        Save the collected observations to a chunked .frames file.
 
         See `save_frames` for more information.
         """
-        save_frames(self.obs, fname)
+        return save_frames(self.obs, fname, **kwargs)
 
     def replay(
         self,
@@ -296,15 +801,20 @@ class Visualizer:
                 "Can't replay an empty list of observations. "
                 "Make sure to set save_obs=True at init."
             )
-        self.update = self._get_dmap_updater(self.obs[start_index])
-        for i, obs in enumerate(self.obs[start_index + 1 : end_index]):
+        start_index, end_index, _ = slice(start_index, end_index).indices(len(self.obs))
+        self.close()
+        self.update = self._get_updater(self.obs[start_index])
+        n_calls = 0
+        # index one frame at a time rather than slicing so on-disk frames are streamed
+        for idx in range(start_index + 1, end_index):
             if delay:
                 time.sleep(delay)
             if callback:
-                callback(i)
-            self.update(obs)
+                callback(n_calls)
+                n_calls += 1
+            self.update(self.obs[idx])
         if callback:
-            callback(i + 1)
+            callback(n_calls)
 
     @classmethod
     def from_files(
@@ -313,44 +823,304 @@ class Visualizer:
         opts: Optional[Dict[str, Any]] = None,
         multi: bool = False,
         delay: float = 0,
+        start_index: int = 0,
+        n_prefetch: int = 4,
     ):
         """
-        If some arrays are longer (more frames) than others, all arrays will be padded to
-        the length of the longest array. The "padding" frames will be the same as the
-        final frame of the array, so shorter videos will appear to stop on their final
-        frame. All videos are shown simultaneously.
+        If some videos are longer (more frames) than others, the shorter ones will stay
+        on their final frame until the longest one finishes. All videos are shown
+        simultaneously.
 
-        :param fnames: ".npy.gz" will be added at the end of each name if no extension
-          is given; ".npy" is also allowed if given explicitly.
+        :param fnames: ".frames" or ".npy.gz" will be added at the end of each name if no
+          extension is given (see `open_frames`); ".npy" is also allowed if given
+          explicitly.
         :param opts: Holoviews options for the RGB or Image elements used for the videos.
         :param multi: if True, there should only be one input file but which contains
           frames for multiple videos. Otherwise, there can be either one file with one
           video saved or multiple files with one video each.
         :param delay: how many seconds to wait between showing each frame
+        :param start_index: index of the first frame to show. Chunked .frames files
+          seek straight to this frame without reading the frames before it.
+        :param n_prefetch: how many steps to read ahead on a worker thread
+
+        Files are read lazily (see `open_frames` and `MultiFrameReader`), so memory use
+        stays at a few frames per file no matter how long the videos are.
         """
         if isinstance(fnames, str):
             fnames = [fnames]
 
-        all_obs = []
-        for fname in fnames:
-            if not (fname.endswith(".npy") or fname.endswith(".npy.gz")):
-                fname = fname + ".npy.gz"
-            if fname.endswith(".gz"):
-                with gzip.GzipFile(fname, "r") as f:
-                    all_obs.append(np.load(f))
-            else:
-                all_obs.append(np.load(fname))
-        max_len = max(map(len, all_obs))
-        for i, obs in enumerate(all_obs):
-            len_diff = max_len - len(obs)
-            if len_diff:
-                all_obs[i] = np.concatenate((obs, [obs[-1]] * len_diff))
-        all_obs = np.stack(all_obs, axis=1).squeeze()
+        sources = [open_frames(fname) for fname in fnames]
         visualizer = cls(opts=opts, multi=multi or len(fnames) > 1)
-        for frame in all_obs:
-            visualizer(frame)
-            if delay:
-                time.sleep(delay)
+        if len(sources) == 1:
+            source = sources[0]
+            if isinstance(source, np.ndarray):
+                frames = iter(source[start_index:])
+            else:
+                frames = source.iter_frames(start_index)
+        else:
+            frames = MultiFrameReader(sources).iter_steps(start_index)
+        steps = prefetch(frames, n_prefetch)
+        try:
+            for frame in steps:
+                visualizer(frame)
+                if delay:
+                    time.sleep(delay)
+        finally:
+            steps.close()  # stop reading before the sources are closed
+            for source in sources:
+                if hasattr(source, "close"):
+                    source.close()
+
+
+class _TileCompositor:
+    """
+    Draws a batch of frames (e.g. from parallel environments) as tiles of one image.
+
+    The grid image ("canvas") is allocated once and each batch is copied into it
+    through a (row, column, y, x) view, so composing costs one or two vectorized
+    copies however many tiles there are. Every `downscale`th row and column of each
+    frame is used.
+    """
+
+    def __init__(self, n_cols: Optional[int] = None, downscale: int = 1):
+        """:param n_cols: number of tiles per row (all in one row if None or 0)"""
+        self.n_cols = n_cols
+        self.downscale = downscale
+        self.canvas = None
+        # a (row, column, y, x) view of the canvas
+        self._tiles = None
+        self.grid_shape = (0, 0)
+        self.tile_shape = (0, 0)
+        self._key = None
+
+    def _allocate(self, frames: np.ndarray) -> None:
+        n_frames, height, width = frames.shape[:3]
+        channels = frames.shape[3:]
+        tile_height = -(-height // self.downscale)
+        tile_width = -(-width // self.downscale)
+        n_cols = min(self.n_cols or n_frames, n_frames)
+        n_rows = -(-n_frames // n_cols)
+        self.canvas = np.zeros(
+            (n_rows * tile_height, n_cols * tile_width, *channels), frames.dtype
+        )
+        self._tiles = self.canvas.reshape(
+            n_rows, tile_height, n_cols, tile_width, *channels
+        ).swapaxes(1, 2)
+        self.grid_shape = (n_rows, n_cols)
+        self.tile_shape = (tile_height, tile_width)
+        self._key = (frames.shape, frames.dtype)
+
+    def compose(self, frames: np.ndarray) -> np.ndarray:
+        """
+        :param frames: NHWC or NHW frames
+        :returns: the canvas (the same array each time, unless the frames' shape or
+          dtype changes)
+        """
+        frames = np.asarray(frames)
+        if (frames.shape, frames.dtype) != self._key:
+            self._allocate(frames)
+        if self.downscale > 1:
+            frames = frames[:, :: self.downscale, :: self.downscale]
+        n_cols = self.grid_shape[1]
+        n_full_rows, n_remaining = divmod(len(frames), n_cols)
+        n_full = n_full_rows * n_cols
+        if n_full_rows:
+            self._tiles[:n_full_rows] = frames[:n_full].reshape(
+                n_full_rows, n_cols, *frames.shape[1:]
+            )
+        if n_remaining:
+            self._tiles[n_full_rows, :n_remaining] = frames[n_full:]
+        return self.canvas
+
+    def label_positions(self) -> List[Tuple[float, float]]:
+        """
+        :returns: the (x, y) position near the top middle of each tile, in pixels from
+          the bottom left of the canvas
+        """
+        n_rows, n_cols = self.grid_shape
+        tile_height, tile_width = self.tile_shape
+        canvas_height = n_rows * tile_height
+        n_tiles = self._key[0][0] if self._key else 0  # no frames composed yet
+        return [
+            (
+                (i % n_cols + 0.5) * tile_width,
+                canvas_height - (i // n_cols + 0.1) * tile_height,
+            )
+            for i in range(n_tiles)
+        ]
+
+
+class _FrameEncoder:
+    """Compresses frames to JPEG/PNG/WebP bytes, skipping frames that didn't change."""
+
+    def __init__(
+        self, image_format: str = "jpeg", quality: int = 75, downscale: int = 1
+    ):
+        if image_format not in ("jpeg", "png", "webp"):
+            raise ValueError(f"Unknown {image_format=}; expected jpeg, png, or webp.")
+        self.image_format = image_format
+        self.quality = quality
+        self.downscale = downscale
+        self._previous = None
+        try:
+            import cv2
+
+            self._cv2 = cv2
+        except ImportError:
+            self._cv2 = None
+            if importlib.util.find_spec("PIL") is None:
+                raise RuntimeError("Encoding frames requires cv2 or PIL.")
+
+    def encode(self, frame: np.ndarray) -> Optional[bytes]:
+        """:returns: the encoded frame or None if it's the same as the last frame"""
+        frame = np.asarray(frame)
+        if self.downscale > 1:
+            frame = frame[:: self.downscale, :: self.downscale]
+        if frame.dtype != np.uint8:
+            scaled = np.empty(frame.shape, np.uint8)
+            _copy_scaled(scaled, frame)
+            frame = scaled
+        if self._previous is not None and np.array_equal(frame, self._previous):
+            return None
+        self._previous = frame.copy()
+        if self.image_format == "jpeg" and frame.ndim == 3 and frame.shape[2] == 4:
+            frame = frame[..., :3]  # JPEG has no alpha channel
+
+        if self._cv2 is not None:
+            cv2 = self._cv2
+            if frame.ndim == 3 and frame.shape[2] == 3:
+                frame = frame[..., ::-1]  # RGB -> BGR
+            elif frame.ndim == 3 and frame.shape[2] == 4:
+                frame = frame[..., [2, 1, 0, 3]]  # RGBA -> BGRA
+            params = {
+                "jpeg": [cv2.IMWRITE_JPEG_QUALITY, self.quality],
+                "webp": [cv2.IMWRITE_WEBP_QUALITY, self.quality],
+                "png": [cv2.IMWRITE_PNG_COMPRESSION, 1],
+            }[self.image_format]
+            ok, data = cv2.imencode(
+                f".{self.image_format}", np.ascontiguousarray(frame), params
+            )
+            if not ok:
+                raise RuntimeError(f"Encoding a frame as {self.image_format} failed.")
+            return data.tobytes()
+
+        from PIL import Image
+
+        f = io.BytesIO()
+        Image.fromarray(frame).save(f, format=self.image_format, quality=self.quality)
+        return f.getvalue()
+
+
+class _RateLimitedUpdater:
+    """
+    Calls `update` with the most recent frame at most `max_fps` times per second.
+
+    Calling an instance only stores (a copy of) the frame; the update happens on a
+    background thread. Frames which are replaced before the thread gets to them are
+    dropped.
+    """
+
+    def __init__(self, update: Callable[[np.ndarray], None], max_fps: float):
+        self._update = update
+        self._interval = 1 / max_fps
+        self._latest = None
+        self._new_frame = threading.Event()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._stopped = False
+        self.n_received = 0
+        self.n_displayed = 0
+        self.error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __call__(self, frame: np.ndarray) -> None:
+        if self.error is not None:
+            raise RuntimeError("Updating the display failed.") from self.error
+        # the caller may reuse the array for the next frame before this one is shown
+        self._latest = frame.copy() if isinstance(frame, np.ndarray) else frame
+        self.n_received += 1
+        self._idle.clear()
+        self._new_frame.set()
+
+    @property
+    def pending(self) -> bool:
+        """Whether there's a frame that hasn't been displayed yet."""
+        return self._new_frame.is_set()
+
+    def _run(self) -> None:
+        next_time = time.perf_counter()
+        while True:
+            self._new_frame.wait()
+            if self._stopped:
+                return
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)  # more frames may arrive; only the last is shown
+            self._new_frame.clear()
+            frame = self._latest
+            try:
+                self._update(frame)
+                self.n_displayed += 1
+            except Exception as e:
+                self.error = e
+            next_time = time.perf_counter() + self._interval
+            if not self._new_frame.is_set():
+                self._idle.set()
+
+    def flush(self) -> None:
+        while self.pending or not self._idle.is_set():
+            if self.error is not None or self._stopped:
+                return
+            self._idle.wait(self._interval)
+
+    def close(self) -> None:
+        self._stopped = True
+        self._new_frame.set()
+        self._thread.join()
+
+
+class _Throttle:
+    """
+    Calls `send` at most once every `min_interval` seconds.
+
+    Calling an instance sends right away if the last send was long enough ago.
+    Otherwise, a send is scheduled on a timer thread for when the interval is over, so
+    the last calls of a burst are always sent even if no more calls follow.
+    """
+
+    def __init__(self, send: Callable[[], None], min_interval: float):
+        self._send = send
+        self._min_interval = min_interval
+        self._last_send = 0.0
+        self._timer = None
+        self._lock = threading.Lock()
+        # `flush` can be called from the timer thread and the caller's thread at once
+        self._send_lock = threading.Lock()
+
+    def __call__(self) -> None:
+        if self._timer is not None:
+            # the scheduled send hasn't started yet, so it will include this call
+            return
+        with self._lock:
+            delay = self._last_send + self._min_interval - time.perf_counter()
+            if delay > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(delay, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.flush()
+
+    def flush(self) -> None:
+        """Send now (and cancel the scheduled send, if any)."""
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            self._last_send = time.perf_counter()
+        with self._send_lock:
+            self._send()
 
 
 def visualize(
@@ -379,13 +1149,954 @@ def visualize(
             break
 
 
-def save_frames(frames: Union[np.ndarray, Sequence[np.ndarray]], fname):
-    if not isinstance(frames, np.ndarray):
-        frames = np.stack(frames)
-    if not fname.endswith(".npy.gz"):
-        fname += ".npy.gz"
-    with gzip.GzipFile(fname, "w") as f:
-        np.save(f, frames)
+def save_frames(
+    frames: Union[np.ndarray, Sequence[np.ndarray]],
+    fname: str,
+    chunk_size: int = 256,
+    compression: Optional[str] = "zlib",
+) -> str:
+    """
+    Save `frames` to disk in the chunked frame format (see `FrameWriter`).
+
+    Frames are written one chunk at a time, so `frames` can be any iterable of arrays
+    with the same shape and dtype; it's never stacked into one big array.
+
+    :param fname: ".frames" will be added at the end if no extension is given. If the
+      name ends in ".npy.gz" or ".npy", the legacy single-array format is written instead.
+    :param chunk_size: number of frames per independently-compressed chunk
+    :param compression: "zlib" or None (raw chunks, which can be memory mapped)
+    :returns: the name of the file that was written
+    """
+    if fname.endswith(".npy.gz") or fname.endswith(".npy"):
+        if not isinstance(frames, np.ndarray):
+            frames = np.stack(frames)
+        if fname.endswith(".gz"):
+            with gzip.GzipFile(fname, "w") as f:
+                np.save(f, frames)
+        else:
+            np.save(fname, frames)
+        return fname
+
+    if not fname.endswith(FrameWriter.extension):
+        fname += FrameWriter.extension
+    with FrameWriter(fname, chunk_size=chunk_size, compression=compression) as writer:
+        writer.extend(frames)
+    if not writer.n_frames:
+        # the header needs the frames' shape and dtype, so there's nothing valid to write
+        os.remove(fname)
+        raise ValueError("There are no frames to save.")
+    return fname
+
+
+def open_frames(fname: str) -> Union[np.ndarray, "FrameReader", "GzipNpyReader"]:
+    """
+    Open frames saved by `save_frames` without loading them into memory.
+
+    Chunked ".frames" files are opened with a `FrameReader`, legacy ".npy" files are
+    memory mapped, and legacy ".npy.gz" files are opened with a `GzipNpyReader`. All of
+    these support `len`, integer indexing, and iteration.
+
+    :param fname: if no extension is given, ".frames" is tried before ".npy.gz".
+    """
+    if not fname.endswith((FrameWriter.extension, ".npy", ".npy.gz")):
+        if os.path.exists(fname + FrameWriter.extension):
+            fname += FrameWriter.extension
+        else:
+            fname += ".npy.gz"
+    if fname.endswith(FrameWriter.extension):
+        return FrameReader(fname)
+    if fname.endswith(".gz"):
+        return GzipNpyReader(fname)
+    return np.load(fname, mmap_mode="r")
+
+
+class GzipNpyReader:
+    """
+    Read frames one at a time from a gzipped .npy file (the legacy `save_frames` format).
+
+    Reading forward only decompresses as far as the frame being read; reading backward
+    has to decompress from the start of the file again. The last frame read is cached,
+    so holding on a frame is free.
+    """
+
+    def __init__(self, fname: str):
+        self.fname = fname
+        self._file = gzip.GzipFile(fname, "r")
+        version = np.lib.format.read_magic(self._file)
+        read_header = (
+            np.lib.format.read_array_header_1_0
+            if version == (1, 0)
+            else np.lib.format.read_array_header_2_0
+        )
+        shape, fortran_order, dtype = read_header(self._file)
+        if fortran_order or dtype.hasobject:
+            raise ValueError(f"Can't read frames one at a time from {fname}.")
+        self.shape = shape[1:]
+        self.dtype = dtype
+        self.frame_nbytes = int(np.prod(self.shape)) * dtype.itemsize
+        self._len = shape[0]
+        self._data_offset = self._file.tell()
+        self._cached_frame = (-1, None)
+
+    def __len__(self) -> int:
+        return self._len
+
+    def __getitem__(self, idx: int) -> np.ndarray:
+        if idx < 0:
+            idx += self._len
+        if not 0 <= idx < self._len:
+            raise IndexError(f"Frame {idx} out of range for {self._len} frames.")
+        if self._cached_frame[0] == idx:
+            return self._cached_frame[1]
+        offset = self._data_offset + idx * self.frame_nbytes
+        if self._file.tell() != offset:
+            self._file.seek(offset)
+        frame = np.frombuffer(self._file.read(self.frame_nbytes), self.dtype)
+        frame = frame.reshape(self.shape)
+        self._cached_frame = (idx, frame)
+        return frame
+
+    def iter_frames(self, start: int = 0, stop: Optional[int] = None):
+        stop = self._len if stop is None else min(stop, self._len)
+        for idx in range(start, stop):
+            yield self[idx]
+
+    def __iter__(self):
+        return self.iter_frames()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+class MultiFrameReader:
+    """
+    Step through several videos at once without loading them.
+
+    Step `t` is the stack of frame `t` from each source; sources which are shorter than
+    the longest one hold their final frame. Only the frames for the current step are
+    read, so memory use stays at a few frames per source.
+    """
+
+    def __init__(self, sources: Sequence[Any]):
+        """
+        :param sources: anything returned by `open_frames` (or other sequences of frames)
+        """
+        self.sources = list(sources)
+        self._lengths = [len(source) for source in self.sources]
+
+    def __len__(self) -> int:
+        return max(self._lengths)
+
+    def __getitem__(self, step: int) -> np.ndarray:
+        if step < 0:
+            step += len(self)
+        return np.stack(
+            [
+                source[min(step, length - 1)]
+                for source, length in zip(self.sources, self._lengths)
+            ]
+        )
+
+    def iter_steps(self, start: int = 0, stop: Optional[int] = None):
+        stop = len(self) if stop is None else min(stop, len(self))
+        for step in range(start, stop):
+            yield self[step]
+
+    def __iter__(self):
+        return self.iter_steps()
+
+
+def prefetch(iterable, n_ahead: int = 4):
+    """
+    Iterate over `iterable` on a worker thread, staying up to `n_ahead` items ahead.
+
+    This overlaps reading (and decompressing) frames with displaying them. The worker
+    stops when the returned generator is closed or garbage collected; closing it waits
+    for the item the worker is reading (if any), so e.g. files it reads from can be
+    closed afterwards.
+    """
+    items = queue.Queue(maxsize=n_ahead)
+    stop = threading.Event()
+    done = object()
+
+    def put(item) -> bool:
+        """:returns: False if the consumer stopped before `item` could be queued"""
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((done, None))
+        except Exception as e:
+            put((done, e))
+
+    worker = threading.Thread(target=produce, daemon=True)
+    worker.start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is done:
+                return
+            yield item
+    finally:
+        stop.set()
+        worker.join()
+
+
+# Layout of a ".frames" file:
+#   magic (8 bytes) | header length (uint32) | JSON header, zero-padded to _ALIGN bytes
+#   then any number of chunks, each:
+#   n_frames (uint32) | flags (uint32) | payload bytes (uint64), zero-padded to _ALIGN
+#   payload, zero-padded to _ALIGN
+# Every payload starts on an _ALIGN-byte boundary so raw chunks can be viewed directly
+# out of a memory map. The chunk index is rebuilt by walking the chunk headers, which
+# only touches one small record per chunk.
+_FRAMES_MAGIC = b"JMFRAMES"
+_FRAMES_VERSION = 1
+_ALIGN = 64
+_HEADER_LEN = struct.Struct("<I")
+_CHUNK_HEADER = struct.Struct("<IIQ")
+_COMPRESSIONS = (None, "zlib")
+
+
+def _pad(n: int) -> int:
+    """Number of zero bytes needed after `n` bytes to reach an `_ALIGN` boundary."""
+    return -n % _ALIGN
+
+
+class FrameWriter:
+    """
+    Append frames one at a time to a chunked ".frames" file.
+
+    Frames are buffered in a preallocated chunk array and written (compressed
+    independently of each other) every `chunk_size` frames. The header with the frame
+    shape and dtype is written with the first frame.
+    """
+
+    extension = ".frames"
+
+    def __init__(
+        self,
+        fname: str,
+        chunk_size: int = 256,
+        compression: Optional[str] = "zlib",
+        level: int = 1,
+        append: bool = False,
+    ):
+        """
+        :param compression: "zlib" or None; raw (None) chunks can be memory mapped
+          without copying when reading.
+        :param level: zlib compression level
+        :param append: if True and `fname` exists, new frames are added to the end of
+          it (its header must match the frames appended).
+        """
+        if compression not in _COMPRESSIONS:
+            raise ValueError(
+                f"Unknown {compression=}; expected one of {_COMPRESSIONS}."
+            )
+        self.fname = fname
+        self.chunk_size = chunk_size
+        self.compression = compression
+        self.level = level
+        self.n_frames = 0
+        self.shape = None
+        self.dtype = None
+        self._buffer = None
+        self._n_buffered = 0
+
+        if append and os.path.exists(fname) and os.path.getsize(fname):
+            with FrameReader(fname) as reader:
+                self.shape = reader.shape
+                self.dtype = reader.dtype
+                self.chunk_size = reader.chunk_size
+                self.compression = reader.compression
+                self.n_frames = len(reader)
+                end = reader.end_offset
+            self._file = open(fname, "r+b")
+            # drop any partially-written chunk at the end
+            self._file.truncate(end)
+            self._file.seek(end)
+            self._buffer = np.empty((self.chunk_size, *self.shape), self.dtype)
+        else:
+            self._file = open(fname, "wb")
+
+    def _write_header(self, frame: np.ndarray) -> None:
+        self.shape = frame.shape
+        self.dtype = frame.dtype
+        self._buffer = np.empty((self.chunk_size, *self.shape), self.dtype)
+        header = json.dumps(
+            {
+                "version": _FRAMES_VERSION,
+                "shape": list(self.shape),
+                "dtype": self.dtype.str,
+                "chunk_size": self.chunk_size,
+                "compression": self.compression,
+            }
+        ).encode()
+        n_bytes = len(_FRAMES_MAGIC) + _HEADER_LEN.size + len(header)
+        self._file.write(_FRAMES_MAGIC)
+        self._file.write(_HEADER_LEN.pack(len(header)))
+        self._file.write(header)
+        self._file.write(bytes(_pad(n_bytes)))
+
+    def append(self, frame: np.ndarray) -> None:
+        frame = np.asarray(frame)
+        if self._buffer is None:
+            self._write_header(frame)
+        elif frame.shape != self.shape:
+            raise ValueError(
+                f"Frame has shape {frame.shape} but this file stores {self.shape}."
+            )
+        self._buffer[self._n_buffered] = frame
+        self._n_buffered += 1
+        self.n_frames += 1
+        if self._n_buffered == self.chunk_size:
+            self._write_chunk()
+
+    def extend(self, frames: Union[np.ndarray, Sequence[np.ndarray]]) -> None:
+        for frame in frames:
+            self.append(frame)
+
+    def _write_chunk(self) -> None:
+        if not self._n_buffered:
+            return
+        payload = memoryview(self._buffer[: self._n_buffered]).cast("B")
+        if self.compression == "zlib":
+            payload = zlib.compress(payload, self.level)
+        self._file.write(_CHUNK_HEADER.pack(self._n_buffered, 0, len(payload)))
+        self._file.write(bytes(_pad(_CHUNK_HEADER.size)))
+        self._file.write(payload)
+        self._file.write(bytes(_pad(len(payload))))
+        self._n_buffered = 0
+
+    def flush(self) -> None:
+        """
+        Write any buffered frames (as a possibly short chunk) so readers can see them.
+        """
+        self._write_chunk()
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+    def __len__(self) -> int:
+        return self.n_frames
+
+    def __enter__(self) -> FrameWriter:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class FrameReader:
+    """
+    Random access to the frames in a ".frames" file without loading the whole file.
+
+    The file is memory mapped; looking up frame `i` finds its chunk in the index and
+    decodes only that chunk (raw chunks are returned as views into the map). The most
+    recently decoded chunk is cached, so sequential access decodes each chunk once.
+    """
+
+    def __init__(self, fname: str):
+        self.fname = fname
+        self._file = open(fname, "rb")
+        self._map = None
+        self._chunk_offsets = []
+        self._chunk_nbytes = []
+        self._chunk_starts = [0]
+        self.end_offset = 0
+        self._cached_chunk = (-1, None)
+
+        magic = self._file.read(len(_FRAMES_MAGIC))
+        if magic != _FRAMES_MAGIC:
+            raise ValueError(f"{fname} isn't a .frames file.")
+        (header_len,) = _HEADER_LEN.unpack(self._file.read(_HEADER_LEN.size))
+        header = json.loads(self._file.read(header_len))
+        if header["version"] > _FRAMES_VERSION:
+            raise ValueError(f"{fname} was written by a newer version of this format.")
+        self.shape = tuple(header["shape"])
+        self.dtype = np.dtype(header["dtype"])
+        self.chunk_size = header["chunk_size"]
+        self.compression = header["compression"]
+        self.frame_nbytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        n_bytes = len(_FRAMES_MAGIC) + _HEADER_LEN.size + header_len
+        self.end_offset = n_bytes + _pad(n_bytes)
+        self.refresh()
+
+    def refresh(self) -> None:
+        """Pick up any chunks appended to the file since it was opened."""
+        size = os.fstat(self._file.fileno()).st_size
+        offset = self.end_offset
+        chunk_region = _CHUNK_HEADER.size + _pad(_CHUNK_HEADER.size)
+        while offset + chunk_region <= size:
+            self._file.seek(offset)
+            n_frames, _, nbytes = _CHUNK_HEADER.unpack(
+                self._file.read(_CHUNK_HEADER.size)
+            )
+            payload_offset = offset + chunk_region
+            if payload_offset + nbytes > size:
+                break  # chunk is still being written
+            self._chunk_offsets.append(payload_offset)
+            self._chunk_nbytes.append(nbytes)
+            self._chunk_starts.append(self._chunk_starts[-1] + n_frames)
+            offset = payload_offset + nbytes + _pad(nbytes)
+        self.end_offset = offset
+        # the old map isn't closed explicitly because frames handed out earlier may
+        # still be views into it; it's released once they're garbage collected
+        if size:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self) -> int:
+        return self._chunk_starts[-1]
+
+    def _chunk(self, chunk_idx: int) -> np.ndarray:
+        if self._cached_chunk[0] == chunk_idx:
+            return self._cached_chunk[1]
+        offset = self._chunk_offsets[chunk_idx]
+        nbytes = self._chunk_nbytes[chunk_idx]
+        n_frames = self._chunk_starts[chunk_idx + 1] - self._chunk_starts[chunk_idx]
+        if self.compression == "zlib":
+            data = zlib.decompress(memoryview(self._map)[offset : offset + nbytes])
+            chunk = np.frombuffer(data, self.dtype)
+        else:
+            chunk = np.frombuffer(
+                self._map, self.dtype, n_frames * int(np.prod(self.shape)), offset
+            )
+        chunk = chunk.reshape(n_frames, *self.shape)
+        self._cached_chunk = (chunk_idx, chunk)
+        return chunk
+
+    def _locate(self, idx: int) -> Tuple[int, int]:
+        """:returns: (chunk index, index of the frame within that chunk)"""
+        chunk_idx = int(np.searchsorted(self._chunk_starts, idx, side="right")) - 1
+        return chunk_idx, idx - self._chunk_starts[chunk_idx]
+
+    def __getitem__(self, idx: Union[int, slice]) -> np.ndarray:
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            frames = list(self.iter_frames(start, stop))[::step]
+            if not frames:
+                return np.empty((0, *self.shape), self.dtype)
+            return np.stack(frames)
+        n_frames = len(self)
+        if idx < 0:
+            idx += n_frames
+        if not 0 <= idx < n_frames:
+            raise IndexError(f"Frame {idx} out of range for {n_frames} frames.")
+        chunk_idx, frame_idx = self._locate(idx)
+        return self._chunk(chunk_idx)[frame_idx]
+
+    def iter_frames(self, start: int = 0, stop: Optional[int] = None):
+        """Yield frames `start` to `stop` (exclusive), decoding one chunk at a time."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        if start >= stop:
+            return
+        chunk_idx, frame_idx = self._locate(start)
+        idx = start
+        while idx < stop:
+            chunk = self._chunk(chunk_idx)
+            for frame in chunk[frame_idx : frame_idx + stop - idx]:
+                yield frame
+            idx += len(chunk) - frame_idx
+            chunk_idx += 1
+            frame_idx = 0
+
+    def __iter__(self):
+        return self.iter_frames()
+
+    def close(self) -> None:
+        self._cached_chunk = (-1, None)
+        if self._map is not None:
+            try:
+                self._map.close()
+            except BufferError:
+                pass  # raw frames are still referenced; the map closes when they're freed
+            self._map = None
+        self._file.close()
+
+    def __enter__(self) -> FrameReader:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+
+class FrameBuffer:
+    """
+    A bounded buffer of frames that keeps the most recent ones in memory and spills
+    older ones to an append-only ".frames" file.
+
+    Recent frames live in one preallocated ring buffer. When it fills up, the oldest
+    `spill_size` frames are copied out in one block and handed to a background thread
+    which appends them to disk, so the caller never waits on compression or I/O
+    (unless the writer falls more than `max_pending` blocks behind). Indexing and
+    iteration see one sequence regardless of where each frame lives. Frames from the
+    ring buffer are returned as copies, since their slots are reused by later frames.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 1024,
+        fname: Optional[str] = None,
+        spill_size: int = 256,
+        compression: Optional[str] = "zlib",
+        max_pending: int = 4,
+    ):
+        """
+        :param capacity: max number of frames kept in memory
+        :param fname: where to write spilled frames; defaults to a temporary file which
+          is deleted when this buffer is garbage collected.
+        :param spill_size: number of frames moved to disk at once; also the chunk size
+          of the file. Must be at most `capacity`.
+        :param max_pending: max number of spilled blocks waiting to be written before
+          `append` blocks
+        """
+        if not 0 < spill_size <= capacity:
+            raise ValueError(f"Need 0 < {spill_size=} <= {capacity=}.")
+        self.capacity = capacity
+        self.spill_size = spill_size
+        self.compression = compression
+        temp_fname = None
+        if fname is None:
+            fd, fname = tempfile.mkstemp(suffix=FrameWriter.extension)
+            os.close(fd)
+            temp_fname = fname
+        self.fname = fname
+        self._ring = None
+        self._n_spilled = 0  # frames [0, _n_spilled) are on disk (or queued for it)
+        self._n_frames = 0
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._writer_threads = []  # holds the writer thread once there is one
+        self._writer_errors = []
+        self._reader = None
+        # the writer thread doesn't reference `self`, so this runs once the buffer is
+        # garbage collected
+        weakref.finalize(
+            self, _close_frame_writer, self._queue, self._writer_threads, temp_fname
+        )
+
+    @property
+    def shape(self) -> Optional[Tuple[int, ...]]:
+        return None if self._ring is None else self._ring.shape[1:]
+
+    def append(self, frame: np.ndarray) -> None:
+        frame = np.asarray(frame)
+        if self._ring is None:
+            self._ring = np.empty((self.capacity, *frame.shape), frame.dtype)
+        elif self._n_frames - self._n_spilled == self.capacity:
+            self._spill()
+        self._ring[self._n_frames % self.capacity] = frame
+        self._n_frames += 1
+
+    def extend(self, frames: Union[np.ndarray, Sequence[np.ndarray]]) -> None:
+        for frame in frames:
+            self.append(frame)
+
+    def _spill(self) -> None:
+        self._check_writer()
+        if not self._writer_threads:
+            writer = FrameWriter(
+                self.fname, chunk_size=self.spill_size, compression=self.compression
+            )
+            thread = threading.Thread(
+                target=_frame_writer_loop,
+                args=(writer, self._queue, self._writer_errors),
+                daemon=True,
+            )
+            thread.start()
+            self._writer_threads.append(thread)
+        slots = np.arange(self._n_spilled, self._n_spilled + self.spill_size)
+        self._queue.put(self._ring[slots % self.capacity])  # fancy indexing copies
+        self._n_spilled += self.spill_size
+
+    def _check_writer(self) -> None:
+        if self._writer_errors:
+            raise RuntimeError(
+                f"Writing frames to {self.fname} failed."
+            ) from self._writer_errors[0]
+
+    def sync(self) -> None:
+        """Wait until every spilled frame has been written to disk."""
+        if not self._writer_threads:
+            return
+        self._queue.put(_FLUSH)
+        self._queue.join()
+        self._check_writer()
+        if self._reader is None:
+            self._reader = FrameReader(self.fname)
+        else:
+            self._reader.refresh()
+
+    def __len__(self) -> int:
+        return self._n_frames
+
+    def __getitem__(self, idx: Union[int, slice]) -> np.ndarray:
+        if isinstance(idx, slice):
+            start, stop, step = idx.indices(len(self))
+            frames = list(self.iter_frames(start, stop))[::step]
+            if not frames:
+                if self._ring is None:
+                    return np.empty(0)
+                return np.empty((0, *self.shape), self._ring.dtype)
+            return np.stack(frames)
+        if idx < 0:
+            idx += self._n_frames
+        if not 0 <= idx < self._n_frames:
+            raise IndexError(f"Frame {idx} out of range for {self._n_frames} frames.")
+        if idx >= self._n_spilled:
+            return self._ring[idx % self.capacity].copy()
+        if self._reader is None or len(self._reader) <= idx:
+            self.sync()
+        return self._reader[idx]
+
+    def iter_frames(self, start: int = 0, stop: Optional[int] = None):
+        """Yield frames `start` to `stop` (exclusive), streaming the on-disk ones."""
+        stop = self._n_frames if stop is None else min(stop, self._n_frames)
+        if start < min(stop, self._n_spilled):
+            if self._reader is None or len(self._reader) < min(stop, self._n_spilled):
+                self.sync()
+            yield from self._reader.iter_frames(start, min(stop, self._n_spilled))
+        for idx in range(max(start, self._n_spilled), stop):
+            yield self._ring[idx % self.capacity].copy()
+
+    def __iter__(self):
+        return self.iter_frames()
+
+
+_FLUSH = object()
+_STOP = object()
+
+
+def _frame_writer_loop(writer: FrameWriter, blocks: queue.Queue, errors: list) -> None:
+    """Append blocks of frames from `blocks` to `writer` until `_STOP` is received."""
+    while True:
+        block = blocks.get()
+        try:
+            if block is _STOP:
+                writer.close()
+                return
+            if block is _FLUSH:
+                writer.flush()
+            elif not errors:
+                writer.extend(block)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            blocks.task_done()
+
+
+def _close_frame_writer(
+    blocks: queue.Queue, writer_threads: list, temp_fname: Optional[str]
+) -> None:
+    if writer_threads:
+        blocks.put(_STOP)
+        writer_threads[0].join()
+    if temp_fname:
+        try:
+            os.remove(temp_fname)
+        except OSError:
+            pass
+
+
+def _to_bgr(frame: np.ndarray) -> np.ndarray:
+    """Converts a grayscale, RGB, or RGBA (uint8 or [0, 1] float) frame to uint8 BGR."""
+    frame = np.asarray(frame)
+    if frame.dtype != np.uint8:
+        scaled = np.empty(frame.shape, np.uint8)
+        _copy_scaled(scaled, frame)
+        frame = scaled
+    if frame.ndim == 3 and frame.shape[2] == 1:
+        frame = frame[..., 0]
+    if frame.ndim == 2:
+        return np.repeat(frame[..., None], 3, axis=2)
+    return np.ascontiguousarray(frame[..., 2::-1])  # also drops any alpha channel
+
+
+def export_video(
+    frames: Union[str, Sequence[np.ndarray]],
+    fname: str,
+    fps: float = 30,
+    codec: str = "libx264",
+    crf: Optional[int] = None,
+    n_workers: Optional[int] = None,
+    segment_len: Optional[int] = None,
+    progress: Union[bool, Callable[[int, int], None]] = True,
+) -> None:
+    """
+    Encode frames to a video using several processes.
+
+    The frames are split into segments which are encoded in parallel with ffmpeg and
+    then joined without re-encoding (each segment starts on a keyframe).
+
+    :param frames: a file name (anything `open_frames` can read; it's read directly by
+      the workers without being loaded into memory) or a sequence of frames (which is
+      first written to a temporary uncompressed ".frames" file for the workers)
+    :param codec: ffmpeg video codec
+    :param crf: constant rate factor (lower = higher quality); the codec's default if
+      None
+    :param n_workers: number of encoding processes (default: number of CPUs)
+    :param segment_len: frames per segment; by default, there are two segments for each
+      worker
+    :param progress: if True, progress is printed; can also be a function which is
+      called with (frames encoded, total frames)
+    """
+    if ffmpeg_path is None:
+        raise RuntimeError("export_video requires ffmpeg.")
+    n_workers = n_workers or os.cpu_count() or 1
+    if isinstance(frames, str):
+        source = open_frames(frames)
+        n_frames = len(source)
+        if hasattr(source, "close"):
+            source.close()
+    else:
+        n_frames = len(frames)
+    if not n_frames:
+        raise ValueError("There are no frames to export.")
+    segment_len = segment_len or -(-n_frames // (2 * n_workers))
+    bounds = [
+        (start, min(start + segment_len, n_frames))
+        for start in range(0, n_frames, segment_len)
+    ]
+    if progress is True:
+
+        def progress(n_done: int, n_total: int) -> None:
+            print(f"\rEncoded {n_done}/{n_total} frames", end="")
+            if n_done == n_total:
+                print()
+
+    segment_dir = tempfile.mkdtemp(prefix="export_video_")
+    segment_fnames = [
+        os.path.join(segment_dir, f"{i:05d}{os.path.splitext(fname)[1] or '.mp4'}")
+        for i in range(len(bounds))
+    ]
+    try:
+        if not isinstance(frames, str):
+            # raw chunks are memory mapped by the workers, so this is mostly a copy
+            frames = save_frames(
+                frames, os.path.join(segment_dir, "source.frames"), compression=None
+            )
+        # spawn rather than fork: forking the kernel while other threads hold locks
+        # (e.g. the Visualizer's writer and display threads) can deadlock the workers
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(n_workers, mp_context=context) as pool:
+            futures = [
+                pool.submit(
+                    _encode_segment,
+                    frames,
+                    start,
+                    stop,
+                    segment_fname,
+                    fps,
+                    codec,
+                    crf,
+                )
+                for (start, stop), segment_fname in zip(bounds, segment_fnames)
+            ]
+            n_done = 0
+            for future in as_completed(futures):
+                n_done += future.result()
+                if progress:
+                    progress(n_done, n_frames)
+
+        list_fname = os.path.join(segment_dir, "segments.txt")
+        with open(list_fname, "w") as f:
+            f.writelines(f"file '{segment}'\n" for segment in segment_fnames)
+        result = subprocess.run(
+            [
+                ffmpeg_path,
+                *("-loglevel", "error", "-y"),
+                *("-f", "concat", "-safe", "0", "-i", list_fname),
+                *("-c", "copy", "-movflags", "+faststart", fname),
+            ],
+            capture_output=True,
+        )
+        if result.returncode:
+            raise RuntimeError(
+                f"ffmpeg failed joining segments:\n{result.stderr.decode()}"
+            )
+    finally:
+        shutil.rmtree(segment_dir, ignore_errors=True)
+
+
+def _encode_segment(
+    source_fname: str,
+    start: int,
+    stop: int,
+    fname: str,
+    fps: float,
+    codec: str,
+    crf: Optional[int],
+) -> int:
+    """
+    Encode frames [start, stop) of a file to `fname` (runs in a worker process).
+
+    :param source_fname: anything `open_frames` can read
+    :returns: the number of frames encoded
+    """
+    source = open_frames(source_fname)
+    if hasattr(source, "iter_frames"):
+        frames = source.iter_frames(start, stop)
+    else:
+        frames = (source[i] for i in range(start, stop))
+
+    writer = None
+    buffer = None
+    try:
+        for frame in frames:
+            frame = np.asarray(frame)
+            if writer is None:
+                writer = _FFmpegWriter(fname, frame.shape, fps, codec, crf)
+                buffer = np.empty(frame.shape, np.uint8)
+            if frame.dtype != np.uint8:
+                _copy_scaled(buffer, frame)
+                frame = buffer
+            writer.write(frame)
+    finally:
+        if hasattr(source, "close"):
+            source.close()
+    writer.close()
+    return stop - start
+
+
+class StreamingSeries:
+    """
+    Bounded-memory summary of an unbounded series of (x, y) points.
+
+    Consecutive points are grouped into buckets of `bucket_width` points, each holding
+    the count, first/last x, the mean and sum of squared deviations of y (Welford),
+    min/max of y, and the summed error (e.g. std) of its points. When `max_buckets`
+    buckets are full, adjacent pairs are merged (with Chan et al.'s parallel update for
+    the variance) and `bucket_width` doubles. This keeps the top level of a
+    min/max/mean pyramid over the whole history at roughly screen resolution, so adding
+    a point is O(1) and memory stays O(max_buckets) however long the series gets.
+    """
+
+    _fields = ("count", "x_first", "x_last", "mean", "m2", "min", "max", "err")
+
+    def __init__(self, max_buckets: int = 1000):
+        if max_buckets < 2 or max_buckets % 2:
+            raise ValueError(f"{max_buckets=} must be even and at least 2.")
+        self.max_buckets = max_buckets
+        self.bucket_width = 1
+        self.n_points = 0
+        self._n_buckets = 0
+        self._buckets = {
+            field: np.empty(max_buckets, np.int64 if field == "count" else np.float64)
+            for field in self._fields
+        }
+        self._reset_current()
+
+    def _reset_current(self) -> None:
+        self._count = 0
+        self._x_first = self._x_last = 0.0
+        self._mean = self._m2 = self._err = 0.0
+        self._min = np.inf
+        self._max = -np.inf
+
+    def add(self, x: float, y: float, err: float = 0.0) -> None:
+        if self._count == 0:
+            self._x_first = x
+        self._x_last = x
+        self._count += 1
+        delta = y - self._mean
+        self._mean += delta / self._count
+        self._m2 += delta * (y - self._mean)
+        self._err += err
+        if y < self._min:
+            self._min = y
+        if y > self._max:
+            self._max = y
+        self.n_points += 1
+        if self._count == self.bucket_width:
+            self._close_current()
+
+    def _close_current(self) -> None:
+        idx = self._n_buckets
+        values = (
+            self._count,
+            self._x_first,
+            self._x_last,
+            self._mean,
+            self._m2,
+            self._min,
+            self._max,
+            self._err,
+        )
+        for field, value in zip(self._fields, values):
+            self._buckets[field][idx] = value
+        self._n_buckets += 1
+        if self._n_buckets == self.max_buckets:
+            self._merge_pairs()
+        self._reset_current()
+
+    def _merge_pairs(self) -> None:
+        b = self._buckets
+        n_a, n_b = b["count"][0::2], b["count"][1::2]
+        n = n_a + n_b
+        mean_a, mean_b = b["mean"][0::2], b["mean"][1::2]
+        delta = mean_b - mean_a
+        half = self.max_buckets // 2
+        merged = {
+            "count": n,
+            "x_first": b["x_first"][0::2],
+            "x_last": b["x_last"][1::2],
+            "mean": mean_a + delta * n_b / n,
+            "m2": b["m2"][0::2] + b["m2"][1::2] + delta**2 * n_a * n_b / n,
+            "min": np.minimum(b["min"][0::2], b["min"][1::2]),
+            "max": np.maximum(b["max"][0::2], b["max"][1::2]),
+            "err": b["err"][0::2] + b["err"][1::2],
+        }
+        for field, values in merged.items():
+            b[field][:half] = values
+        self._n_buckets = half
+        self.bucket_width *= 2
+
+    def view(self) -> Dict[str, np.ndarray]:
+        """
+        :returns: one point per bucket (including the partly-filled one): the mean x,
+          mean y, mean error, standard deviation of y, and min/max y. The arrays are
+          copies, so they don't change when more points are added.
+        """
+        n = self._n_buckets
+        b = {field: values[:n].copy() for field, values in self._buckets.items()}
+        if self._count:
+            current = (
+                self._count,
+                self._x_first,
+                self._x_last,
+                self._mean,
+                self._m2,
+                self._min,
+                self._max,
+                self._err,
+            )
+            b = {
+                field: np.append(values, value)
+                for (field, values), value in zip(b.items(), current)
+            }
+        count = np.maximum(b["count"], 1)
+        return {
+            "x": (b["x_first"] + b["x_last"]) / 2,
+            "mean": b["mean"],
+            "err": b["err"] / count,
+            "std": np.sqrt(b["m2"] / count),
+            "min": b["min"],
+            "max": b["max"],
+        }
 
 
 def updating_curve(
@@ -395,6 +2106,7 @@ def updating_curve(
     curve_opts: Optional[Dict[str, Any]] = None,
     area_opts: Optional[Dict[str, Any]] = None,
     plot_error: bool = True,
+    max_fps: float = 10,
 ) -> Tuple[Any, Callable[[Sequence[float]], None]]:
     """
     Get a plot which shows a mean curve and shaded area (mean +/- std) region.
@@ -408,40 +2120,181 @@ def updating_curve(
     # generate 100 points, each from the mean of 10 random numbers
     for i in range(100):
         update(np.random.randint(10))
+    update.flush()
     ```
+    The whole history is kept (see `StreamingSeries`) but downsampled to at most
+    `max_n_points` points, so memory use and the cost of redrawing stay bounded.
+    :param max_n_points: max number of points drawn; once there are more updates than
+      this, neighbouring points are averaged together.
     :param plot_error: if True, a curve with a shaded error region is plotted. If False,
-      only the curve is plotted. If no error is required, the updating function should be
-      called with just a single point (only the first given point will be plotted).
+      only the curve is plotted; the updating function can still be called with several
+      points, and their mean is plotted.
+    :param max_fps: the plot is redrawn at most this many times per second; updates in
+      between are batched and drawn together once the interval has passed (from a
+      background thread if no more updates arrive). `update.flush()` draws the latest
+      updates right away.
     :returns: plot, updating function
     """
     curve_opts = curve_opts or {}
     area_opts = {"alpha": 0.5, **(area_opts or {})}
-    example = {x_axis_name: np.array([]), y_axis_name: np.array([])}
-    if plot_error:
-        example.update({"lb": np.array([]), "ub": np.array([])})
-    stream = hv.streams.Buffer(example, length=max_n_points)
+    series = StreamingSeries(max_n_points + max_n_points % 2)
+    # the series is read by the throttle's timer thread
+    lock = threading.Lock()
+
+    def get_data() -> Dict[str, np.ndarray]:
+        with lock:
+            view = series.view()
+        data = {x_axis_name: view["x"], y_axis_name: view["mean"]}
+        if plot_error:
+            data["lb"] = view["mean"] - view["err"]
+            data["ub"] = view["mean"] + view["err"]
+        return data
+
+    pipe = hv.streams.Pipe(data=get_data())
     curve_dmap = hv.DynamicMap(
-        partial(hv.Curve, kdims=x_axis_name, vdims=y_axis_name), streams=[stream]
+        partial(hv.Curve, kdims=x_axis_name, vdims=y_axis_name), streams=[pipe]
     )
     plot = curve_dmap.opts(**curve_opts)
     if plot_error:
         area_dmap = hv.DynamicMap(
-            partial(hv.Area, kdims=x_axis_name, vdims=["lb", "ub"]), streams=[stream]
+            partial(hv.Area, kdims=x_axis_name, vdims=["lb", "ub"]), streams=[pipe]
         )
         area_dmap.opts(**area_opts)
         plot *= area_dmap
 
     i = 0
+    throttle = _Throttle(lambda: pipe.send(get_data()), 1 / max_fps)
 
     def update(data):
         nonlocal i
-        mean = np.mean(data)
-        data = {x_axis_name: [i], y_axis_name: [mean]}
-        if plot_error:
-            std = np.std(data)
-            data["lb"] = [mean - std]
-            data["ub"] = [mean + std]
-        stream.send(data)
+        data = np.asarray(data, dtype=np.float64)
+        mean = data.mean()
+        std = data.std() if plot_error else 0.0
+        with lock:
+            series.add(i, mean, std)
         i += 1
+        throttle()
 
+    update.flush = throttle.flush
     return plot, update
+
+
+class MetricsDashboard:
+    """
+    Live curves for several metrics, all redrawn together in one update.
+
+    Usage:
+    ```python
+    dashboard = MetricsDashboard()
+    for step in range(n_steps):
+        ...
+        dashboard.log(loss=loss, reward=reward, lr=lr)
+    dashboard.flush()
+    ```
+    The dashboard is displayed on the first call to `log`. Logging only adds each value
+    to its metric's `StreamingSeries`; all series are sent to the frontend together in a
+    single message at most `max_fps` times per second (values logged since the last
+    message are sent from a background thread once the interval is over, so `flush`
+    only makes them show up sooner).
+    """
+
+    def __init__(
+        self,
+        metrics: Optional[Sequence[str]] = None,
+        x_axis_name: str = "step",
+        max_n_points: int = 1000,
+        max_fps: float = 5,
+        n_cols: int = 2,
+        show_range: bool = True,
+        curve_opts: Optional[Dict[str, Any]] = None,
+        area_opts: Optional[Dict[str, Any]] = None,
+    ):
+        """
+        :param metrics: names of the metrics to plot; by default, the metrics given in
+          the first call to `log` are used. Other metrics can't be added later.
+        :param max_n_points: max number of points drawn per metric (see
+          `StreamingSeries`)
+        :param show_range: whether to shade the min/max range of the points that were
+          averaged into each drawn point
+        """
+        self.x_axis_name = x_axis_name
+        self.max_n_points = max_n_points + max_n_points % 2
+        self.n_cols = n_cols
+        self.show_range = show_range
+        self.curve_opts = curve_opts or {}
+        self.area_opts = {"alpha": 0.3, **(area_opts or {})}
+        self.series = {}
+        if metrics is not None:
+            self.series = {name: StreamingSeries(self.max_n_points) for name in metrics}
+        self.step = 0
+        self._throttle = _Throttle(self._send, 1 / max_fps)
+        # the series are read by the throttle's timer thread
+        self._lock = threading.Lock()
+        self._pipe = None
+
+    def log(
+        self,
+        metrics: Optional[Dict[str, float]] = None,
+        step: Optional[int] = None,
+        **kwargs,
+    ) -> None:
+        """
+        Record one step of metrics, e.g. `log(loss=0.3, reward=1.2)` or
+        `log({"loss": 0.3}, step=10)`.
+
+        :param step: x-value for these metrics; defaults to one more than the last step
+        """
+        if metrics:
+            kwargs.update(metrics)
+        if step is None:
+            step = self.step
+        if self._pipe is None:
+            for name in kwargs:
+                self.series.setdefault(name, StreamingSeries(self.max_n_points))
+            self._show()
+        series = self.series
+        unknown = kwargs.keys() - series.keys()
+        if unknown:
+            raise ValueError(
+                f"Unknown metrics {sorted(unknown)}; pass all metric names to the "
+                "constructor to log metrics which weren't in the first step."
+            )
+        with self._lock:
+            for name, value in kwargs.items():
+                series[name].add(step, float(value))
+        self.step = step + 1
+        self._throttle()
+
+    __call__ = log
+
+    def _data(self) -> Dict[str, Dict[str, np.ndarray]]:
+        with self._lock:
+            return {name: series.view() for name, series in self.series.items()}
+
+    def _render(self, data: Dict[str, Dict[str, np.ndarray]]):
+        plots = []
+        for name, view in data.items():
+            plot = hv.Curve(
+                (view["x"], view["mean"]), kdims=self.x_axis_name, vdims=name
+            ).opts(**self.curve_opts)
+            if self.show_range:
+                plot *= hv.Area(
+                    (view["x"], view["min"], view["max"]),
+                    kdims=self.x_axis_name,
+                    vdims=[f"{name}_min", f"{name}_max"],
+                ).opts(**self.area_opts)
+            plots.append(plot)
+        return hv.Layout(plots).cols(self.n_cols)
+
+    def _show(self) -> None:
+        self._pipe = hv.streams.Pipe(data=self._data())
+        display.display(hv.DynamicMap(self._render, streams=[self._pipe]))
+
+    def _send(self) -> None:
+        self._pipe.send(self._data())
+
+    def flush(self) -> None:
+        """Send the latest values of all metrics to the frontend now."""
+        if self._pipe is None:
+            return
+        self._throttle.flush()
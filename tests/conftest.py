@@ -0,0 +1,22 @@
+import pytest
+from IPython.core.interactiveshell import InteractiveShell
+
+# the magics modules register their magics with the running shell when imported
+InteractiveShell.instance()
+
+
+@pytest.fixture
+def shell():
+    return InteractiveShell.instance()
+
+
+@pytest.fixture
+def no_display(monkeypatch):
+    """Replace `IPython.display.display` with a function which records what's shown."""
+    from IPython import display
+
+    shown = []
+    monkeypatch.setattr(
+        display, "display", lambda obj, *args, **kwargs: shown.append(obj)
+    )
+    return shown
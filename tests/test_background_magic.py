@@ -0,0 +1,331 @@
+import hashlib
+import http.server
+import json
+import os
+import pickle
+import threading
+import time
+
+import pytest
+
+from jupyter_magics import background_magic as bm
+
+
+@pytest.fixture
+def manager(tmp_path, monkeypatch):
+    manager = bm.JobManager(max_workers=2, jobs_dir=str(tmp_path / "jobs"))
+    monkeypatch.setattr(bm, "_job_manager", manager)
+    return manager
+
+
+def _run(shell, line: str, cell: str):
+    shell.run_cell_magic("background", line, cell)
+    job = bm.get_job_manager().jobs[len(bm.get_job_manager().jobs)]
+    assert job.wait(timeout=60)
+    return job
+
+
+def test_serialize_skips_only_ipython_names(shell, tmp_path):
+    shell.user_ns.update({"_private": 1, "_i3": "x = 1", "_": 2, "__name__": "main"})
+    job = bm.Job(1, "serialize", "", str(tmp_path), {"lr": 0.1})
+    bm._prepare_serialized(job, "print(_private, _i3, _, __name__, lr)", [], [])
+    with open(tmp_path / "state.pkl", "rb") as f:
+        modules, state, return_names = pickle.load(f)
+    assert sorted(state) == ["_private", "lr"]
+    assert pickle.loads(state["_private"]) == 1
+
+
+def test_replay_mode_is_the_default(shell, manager, tmp_path, monkeypatch):
+    cells = ["x = 2\n", "%%background\nprint(x * 3)\n"]
+    nb = {
+        "cells": [
+            {"cell_type": "code", "source": c.splitlines(keepends=True)} for c in cells
+        ]
+    }
+    nb_fname = tmp_path / "nb.ipynb"
+    nb_fname.write_text(json.dumps(nb))
+    monkeypatch.setattr(bm, "_notebook_path", str(nb_fname))
+    job = _run(shell, "", "print(x * 3)")
+    assert job.mode == "replay"
+    assert job.status == "done", open(job.stderr).read()
+    assert open(job.stdout).read() == "6\n"
+    with pytest.raises(bm.UsageError):
+        shell.run_cell_magic("background", "-s x=[1,2]", "print(x)")
+
+
+def test_serialize_mode(shell, manager):
+    shell.user_ns.update({"_scale": 3, "os": os, "values": [1, 2]})
+    job = _run(shell, "-m serialize -r total", "total = sum(values) * _scale\nos.sep")
+    assert job.status == "done", open(job.stderr).read()
+    assert shell.run_line_magic("job_result", str(job.id)) == os.sep
+    assert shell.user_ns["total"] == 9
+
+
+def test_serialize_mode_skips_unpicklable_values(shell, manager, capsys):
+    shell.user_ns.update({"lock": threading.Lock(), "x": 1})
+    job = _run(shell, "-m serialize -n lock", "x + 1")
+    assert "lock" in capsys.readouterr().out
+    assert shell.run_line_magic("job_result", str(job.id)) == 2
+
+
+def test_serialize_mode_needs_cloudpickle(shell, manager, monkeypatch):
+    monkeypatch.setattr(bm, "cloudpickle_imported", False)
+    with pytest.raises(bm.UsageError, match="cloudpickle"):
+        shell.run_cell_magic("background", "-m serialize", "x + 1")
+    assert not manager.jobs
+
+
+needs_fork = pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+
+
+def _submit(shell, line: str, cell: str):
+    manager = bm.get_job_manager()
+    n_jobs = len(manager.jobs)
+    shell.run_cell_magic("background", line, cell)
+    return [manager.jobs[i] for i in range(n_jobs + 1, len(manager.jobs) + 1)]
+
+
+def _wait_until(condition, timeout: float = 30) -> None:
+    end = time.time() + timeout
+    while not condition():
+        assert time.time() < end, "timed out"
+        time.sleep(0.02)
+
+
+def _children(pid: int):
+    children = []
+    for entry in os.listdir("/proc"):
+        try:
+            with open(f"/proc/{entry}/stat") as f:
+                fields = f.read().rpartition(")")[2].split()
+        except OSError:
+            continue
+        if int(fields[1]) == pid:
+            children.append(int(entry))
+    return children
+
+
+@needs_fork
+def test_fork_mode_sweep(shell, manager):
+    manager.set_max_workers(1)
+    shell.user_ns["offset"] = 10
+    jobs = _submit(
+        shell, "-m fork -s x=[1,2,3] -r y", "import os\ny = x + offset\nos.getppid()"
+    )
+    shell.user_ns["offset"] = 0  # the jobs see the value from when the cell ran
+    results = []
+    for job in jobs:
+        assert job.wait(timeout=60)
+        assert job.status == "done", open(job.stderr).read()
+        results.append(shell.run_line_magic("job_result", str(job.id)))
+        assert shell.user_ns["y"] == job.params["x"] + 10
+    # the jobs were forked from one copy of the kernel
+    assert len(set(results)) == 1 and results[0] != os.getpid()
+    assert jobs[0].cpu_time is not None and jobs[0].max_rss > 0
+
+
+@needs_fork
+@pytest.mark.skipif(not os.path.exists("/proc/self/stat"), reason="needs /proc")
+def test_fork_mode_forks_jobs_when_they_start(shell, manager, tmp_path):
+    manager.set_max_workers(1)
+    jobs = _submit(shell, "-m fork -s x=[1,2,3]", "import time\ntime.sleep(30)")
+    _wait_until(lambda: jobs[0].status == "running")
+    with open(f"/proc/{jobs[0].pid}/stat") as f:
+        server_pid = int(f.read().rpartition(")")[2].split()[1])
+    assert _children(server_pid) == [jobs[0].pid]
+    assert jobs[1].status == "queued"
+
+    cpu_time, memory = jobs[0].usage()  # sampled while it's running
+    assert cpu_time is not None and memory > 0
+    for job in jobs:
+        manager.kill(job)
+    for job in jobs:
+        assert job.wait(timeout=30)
+        assert job.status == "killed"
+    _wait_until(lambda: not os.path.exists(f"/proc/{server_pid}"))
+
+
+@needs_fork
+def test_fork_server_is_reaped_if_reading_its_status_fails():
+    server = bm._ForkServer.__new__(bm._ForkServer)  # without forking the kernel
+    server._status = threading.Condition()
+    server._pids = {}
+    server._exits = {}
+    server._exited = False
+    server.pid = os.fork()
+    if server.pid == 0:
+        os._exit(0)
+    read_fd, write_fd = os.pipe()
+    os.write(write_fd, b"exited not-a-pid\n")
+    os.close(write_fd)
+    with pytest.raises(ValueError):
+        server._read_status(read_fd)
+    assert server._exited
+    with pytest.raises(ChildProcessError):  # already reaped
+        os.waitpid(server.pid, os.WNOHANG)
+
+
+@needs_fork
+def test_killing_a_finished_job(shell, manager):
+    (job,) = _submit(shell, "-m fork", "1")
+    assert job.wait(timeout=60)
+    job.status = "running"  # as if it exited just before being killed
+    manager.kill(job)
+    assert job.status == "killed"
+
+
+@pytest.mark.parametrize("mode", ["serialize", pytest.param("fork", marks=needs_fork)])
+def test_output_option(shell, manager, tmp_path, mode):
+    output = str(tmp_path / "log.txt")
+    cell = "import sys\nprint('out')\nprint('err', file=sys.stderr)\nsys.exit(3)"
+    (job,) = _submit(shell, f"-m {mode} -o {output}", cell)
+    assert job.wait(timeout=60)
+    assert job.status == "failed" and job.returncode == 1
+    with open(output) as f:
+        text = f.read()
+    assert "out" in text and "err" in text
+
+    jobs = _submit(shell, f"-m {mode} -o {output} -s x=[1,2]", "print(x)")
+    for job in jobs:
+        assert job.wait(timeout=60)
+        with open(tmp_path / f"log-{job.id}.txt") as f:
+            assert f.read().strip() == str(job.params["x"])
+
+
+def test_process_usage_without_psutil(monkeypatch):
+    if not os.path.exists("/proc/self/stat"):
+        pytest.skip("needs /proc")
+    monkeypatch.setattr(bm, "psutil_imported", False)
+    cpu_time, memory = bm._process_usage(os.getpid())
+    assert cpu_time > 0 and memory > 2**20
+    assert bm._process_usage(2**22 + 1) is None
+
+
+class _SessionsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves /api/sessions like jupyter_server, including ETags and 304 responses."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get("If-None-Match"))
+        body = json.dumps(server.sessions).encode()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def sessions_server(tmp_path, monkeypatch):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _SessionsHandler)
+    server.requests = []
+    server.sessions = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    info = {
+        "url": f"http://127.0.0.1:{server.server_address[1]}/",
+        "token": "",
+        "root_dir": str(tmp_path),
+    }
+    monkeypatch.setattr(bm, "_list_running_servers", lambda: [info])
+    monkeypatch.setattr(bm, "_find_notebook_path_offline", lambda: None)
+    monkeypatch.setattr(bm, "_kernel_id", lambda: "kernel-1")
+    monkeypatch.setattr(bm, "_notebook_path_cache", {})
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def _session(path: str, kernel_id: str = "kernel-1"):
+    return {"path": path, "kernel": {"id": kernel_id}}
+
+
+def test_notebook_path_cache_is_revalidated(sessions_server, tmp_path, monkeypatch):
+    for name in ("a.ipynb", "b.ipynb"):
+        (tmp_path / name).touch()
+    sessions_server.sessions = [
+        _session("other.ipynb", "kernel-2"),
+        _session("a.ipynb"),
+    ]
+    assert bm.get_notebook_path() == str(tmp_path / "a.ipynb")
+    assert bm.get_notebook_path() == str(tmp_path / "a.ipynb")
+    assert sessions_server.requests == [None]  # the second call used the cache
+
+    monkeypatch.setattr(bm, "_NOTEBOOK_PATH_TTL", 0)
+    assert bm.get_notebook_path() == str(tmp_path / "a.ipynb")
+    etag = sessions_server.requests[-1]
+    assert etag is not None  # a conditional request, which got a 304
+
+    # e.g. the notebook was renamed while the old file still exists
+    sessions_server.sessions = [_session("b.ipynb")]
+    assert bm.get_notebook_path() == str(tmp_path / "b.ipynb")
+    assert sessions_server.requests[-1] == etag
+
+    sessions_server.sessions = []
+    assert bm.get_notebook_path() is None
+    assert not bm._notebook_path_cache
+
+
+def test_notebook_path_cache_without_the_server(sessions_server, tmp_path, monkeypatch):
+    (tmp_path / "a.ipynb").touch()
+    sessions_server.sessions = [_session("a.ipynb")]
+    assert bm.get_notebook_path() == str(tmp_path / "a.ipynb")
+    sessions_server.shutdown()
+    sessions_server.server_close()
+    monkeypatch.setattr(bm, "_NOTEBOOK_PATH_TTL", 0)
+    # the cached path is still used while the file exists
+    assert bm.get_notebook_path(timeout=0.2) == str(tmp_path / "a.ipynb")
+    os.remove(tmp_path / "a.ipynb")
+    assert bm.get_notebook_path(timeout=0.2) is None
+
+
+def test_slice_cells():
+    cells = [
+        "import numpy as np",
+        "data = load()",  # uses an undefined name, but doesn't matter
+        "unrelated = 1",
+        "def f(x):\n    return np.mean(x) + offset",
+        "offset = 2",
+        "data.append(3)",  # modifies data
+        "unrelated += 1",
+        "print(f(data))",
+    ]
+    assert bm._slice_cells(cells) == [cells[i] for i in (0, 1, 3, 4, 5, 7)]
+
+
+def test_slice_cells_follows_augmented_assignments():
+    cells = ["total = 0", "y = 1", "total += 1"]
+    assert bm._slice_cells(cells) == ["total = 0", "total += 1"]
+
+
+def test_slice_cells_keeps_cells_it_cant_analyze():
+    cells = ["from os.path import *", "a = (", "b = 1", "print(join('x'))"]
+    assert bm._slice_cells(cells) == [cells[0], cells[1], cells[3]]
+
+
+def test_replay_code(tmp_path):
+    def cell(source, cell_type="code"):
+        return {"cell_type": cell_type, "source": source.splitlines(keepends=True)}
+
+    nb = {
+        "cells": [
+            cell("x = 1\n%matplotlib inline\n"),
+            cell("# Title", "markdown"),
+            cell("%%bash\necho hi\n"),
+            cell("y = 2\n"),
+            cell("%%background --slice\nprint(x)\n"),
+            cell("z = 3\n"),
+        ]
+    }
+    nb_fname = tmp_path / "nb.ipynb"
+    nb_fname.write_text(json.dumps(nb))
+    assert bm._replay_code(str(nb_fname)) == "x = 1\n\ny = 2\n\nprint(x)\n\n"
+    assert bm._replay_code(str(nb_fname), slice_cells=True) == "x = 1\n\nprint(x)\n\n"
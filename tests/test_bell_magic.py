@@ -0,0 +1,70 @@
+import time
+
+import pytest
+
+from jupyter_magics import bell_magic
+
+
+def _busy(seconds: float) -> None:
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+@pytest.fixture
+def shown(monkeypatch):
+    shown = []
+    monkeypatch.setattr(bell_magic, "display", shown.append)
+    return shown
+
+
+def test_format_bytes_and_seconds():
+    assert bell_magic._format_bytes(512) == "512.0 B"
+    assert bell_magic._format_bytes(3 * 2**20) == "3.0 MiB"
+    assert bell_magic._format_bytes(2**50) == "1024.0 TiB"
+    assert bell_magic._format_seconds(1.234) == "1.23s"
+    assert bell_magic._format_seconds(125) == "2m 5.0s"
+    assert bell_magic._format_seconds(3725) == "1h 2m 5s"
+
+
+def test_resource_usage_report():
+    usage = bell_magic._ResourceUsage()
+    _busy(0.05)
+    report = usage.report()
+    assert report.startswith("Wall time: ")
+    assert "CPU time: " in report
+    if bell_magic.resource_imported:
+        assert "Peak RSS: " in report
+        assert "Context switches (voluntary/involuntary): " in report
+
+
+def test_sampling_profiler_finds_the_busy_function():
+    profiler = bell_magic._SamplingProfiler(interval=0.005)
+    _busy(0.3)
+    profiler.stop()
+    assert profiler.n_samples > 10
+    assert not profiler._thread.is_alive()
+    (_, _, function), _ = profiler.self_counts.most_common(1)[0]
+    assert function == "_busy"
+    assert "(_busy)" in profiler.report(n_top=3)
+
+
+def test_sampling_profiler_without_samples():
+    profiler = bell_magic._SamplingProfiler(interval=10)
+    profiler.stop()
+    assert "no samples" in profiler.report()
+
+
+def test_notify_reports_time_and_profile(shell, shown, capsys):
+    shell.user_ns["busy"] = _busy
+    shell.run_line_magic("notify", "-p --interval 0.005 --top 3 busy(0.2)")
+    out = capsys.readouterr().out
+    assert "Wall time: " in out
+    assert "(_busy)" in out
+    assert len(shown) == 1  # the bell
+
+
+def test_notify_plays_the_bell_when_the_code_fails(shell, shown):
+    with pytest.raises(ZeroDivisionError):
+        shell.run_line_magic("notify", "1 / 0")
+    assert len(shown) == 1
@@ -0,0 +1,66 @@
+import subprocess
+import sys
+import textwrap
+from pathlib import Path
+
+from jupyter_magics import save_load
+
+REPO_DIR = Path(__file__).resolve().parent.parent
+
+
+def test_load_ext_is_lazy():
+    script = textwrap.dedent(
+        """
+        import sys
+        from IPython.core.interactiveshell import InteractiveShell
+
+        shell = InteractiveShell.instance()
+        shell.run_line_magic("load_ext", "jupyter_magics")
+        assert "jupyter_magics.save_load" not in sys.modules
+        assert "holoviews" not in sys.modules
+        shell.run_line_magic("saves", "")
+        assert "jupyter_magics.save_load" in sys.modules
+        magic = shell.magics_manager.magics["line"]["saves"]
+        assert magic.__module__ == "jupyter_magics.save_load", magic
+        """
+    )
+    result = subprocess.run(
+        [sys.executable, "-c", script], cwd=REPO_DIR, capture_output=True, text=True
+    )
+    assert result.returncode == 0, result.stderr
+    assert "No saves running." in result.stdout
+
+
+def test_reload_ext_keeps_real_magics(shell, capsys):
+    # save_load is already imported, so importing it from a stub would be a no-op
+    shell.run_line_magic("reload_ext", "jupyter_magics")
+    assert shell.magics_manager.magics["line"]["saves"] is save_load.saves
+    shell.run_line_magic("saves", "")
+    shell.run_line_magic("reload_ext", "jupyter_magics")
+    shell.run_line_magic("saves", "")
+    assert capsys.readouterr().out.count("No saves running.") == 2
+
+
+def test_magics_classes_have_stubs():
+    from jupyter_magics import _MAGICS, bell_magic, test_magic
+
+    for magics in (bell_magic.NotificationMagics, test_magic.TestMagics):
+        for names in magics.magics.values():
+            for name in names:
+                assert name in _MAGICS, name
+
+
+def test_stubs_match_the_real_magics(shell):
+    import importlib
+
+    from jupyter_magics import _MAGICS
+
+    for name, (module, kind, local_scope, no_var_expand) in _MAGICS.items():
+        importlib.import_module(f"jupyter_magics.{module}").load_ipython_extension(
+            shell
+        )
+        magic = shell.magics_manager.magics["cell" if kind == "cell" else "line"][name]
+        assert getattr(magic, "needs_local_scope", False) == local_scope, name
+        assert (
+            getattr(magic, "_ipython_magic_no_var_expand", False) == no_var_expand
+        ), name
@@ -0,0 +1,166 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from jupyter_magics import visualization_magic as vm
+
+
+def _frames(n_frames: int, height: int = 6, width: int = 5) -> np.ndarray:
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 256, (n_frames, height, width, 3), dtype=np.uint8)
+
+
+@pytest.mark.parametrize("compression", ["zlib", None])
+def test_save_frames_round_trip(tmp_path, compression):
+    frames = _frames(10)
+    fname = vm.save_frames(
+        frames, str(tmp_path / "video"), chunk_size=4, compression=compression
+    )
+    assert fname.endswith(".frames")
+    with vm.open_frames(str(tmp_path / "video")) as reader:
+        assert len(reader) == 10
+        assert reader.shape == frames.shape[1:] and reader.dtype == frames.dtype
+        np.testing.assert_array_equal(reader[7], frames[7])
+        np.testing.assert_array_equal(reader[-1], frames[-1])
+        np.testing.assert_array_equal(np.stack(list(reader.iter_frames(3))), frames[3:])
+        np.testing.assert_array_equal(reader[2:9:3], frames[2:9:3])
+        with pytest.raises(IndexError):
+            reader[10]
+
+
+def test_save_frames_accepts_an_iterable(tmp_path):
+    frames = _frames(5)
+    fname = vm.save_frames(iter(frames), str(tmp_path / "video.frames"), chunk_size=2)
+    with vm.FrameReader(fname) as reader:
+        np.testing.assert_array_equal(reader[:], frames)
+
+
+def test_save_frames_without_frames_raises(tmp_path):
+    fname = str(tmp_path / "empty.frames")
+    with pytest.raises(ValueError):
+        vm.save_frames([], fname)
+    assert not os.path.exists(fname)
+
+
+def test_frame_writer_appends(tmp_path):
+    frames = _frames(7)
+    fname = str(tmp_path / "video.frames")
+    with vm.FrameWriter(fname, chunk_size=3) as writer:
+        writer.extend(frames[:4])
+    with vm.FrameWriter(fname, append=True) as writer:
+        writer.extend(frames[4:])
+        assert len(writer) == 7
+    with vm.FrameReader(fname) as reader:
+        np.testing.assert_array_equal(reader[:], frames)
+
+
+def test_frame_writer_rejects_other_shapes(tmp_path):
+    with vm.FrameWriter(str(tmp_path / "video.frames")) as writer:
+        writer.append(np.zeros((2, 2), np.uint8))
+        with pytest.raises(ValueError):
+            writer.append(np.zeros((3, 2), np.uint8))
+
+
+def test_legacy_npy_gz(tmp_path):
+    frames = _frames(4)
+    fname = vm.save_frames(frames, str(tmp_path / "video.npy.gz"))
+    reader = vm.open_frames(fname)
+    assert len(reader) == 4
+    np.testing.assert_array_equal(reader[2], frames[2])
+    np.testing.assert_array_equal(reader[0], frames[0])  # seeking backward
+    reader.close()
+
+
+def test_from_files_closes_readers(tmp_path, monkeypatch, no_display):
+    pytest.importorskip("holoviews")
+    fname = vm.save_frames(_frames(5), str(tmp_path / "video"), chunk_size=2)
+    closed = []
+    close = vm.FrameReader.close
+
+    def record_close(reader):
+        closed.append(reader.fname)
+        close(reader)
+
+    monkeypatch.setattr(vm.FrameReader, "close", record_close)
+    vm.Visualizer.from_files(fname, start_index=3)
+    assert closed == [fname]
+
+
+def test_replay_callback_counts(no_display):
+    pytest.importorskip("holoviews")
+    visualizer = vm.Visualizer(save_obs=True)
+    for frame in _frames(4):
+        visualizer(frame)
+    calls = []
+    visualizer.replay(callback=calls.append)
+    # end_index=-1 stops before the last frame, like slicing
+    assert calls == [0, 1, 2]
+
+    calls.clear()
+    visualizer.replay(start_index=3, callback=calls.append)  # no frames after the first
+    assert calls == [0]
+
+
+def test_frame_buffer_spills_to_disk(tmp_path):
+    frames = _frames(50)
+    buffer = vm.FrameBuffer(
+        capacity=8, fname=str(tmp_path / "obs.frames"), spill_size=4
+    )
+    buffer.extend(frames)
+    assert len(buffer) == 50
+    assert buffer._n_spilled > 0  # most frames are on disk
+    np.testing.assert_array_equal(buffer[0], frames[0])
+    np.testing.assert_array_equal(buffer[-1], frames[-1])
+    np.testing.assert_array_equal(buffer[10:45:5], frames[10:45:5])
+    np.testing.assert_array_equal(np.stack(list(buffer)), frames)
+
+
+def test_frame_buffer_returns_copies():
+    frames = _frames(6)
+    buffer = vm.FrameBuffer(capacity=4, spill_size=2)
+    buffer.extend(frames[:3])
+    last = buffer[-1]
+    iterated = list(buffer)
+    buffer.extend(frames[3:])  # reuses the ring buffer's slots
+    np.testing.assert_array_equal(last, frames[2])
+    np.testing.assert_array_equal(np.stack(iterated), frames[:3])
+
+
+def test_empty_frame_buffer_slices():
+    buffer = vm.FrameBuffer(capacity=4, spill_size=2)
+    assert len(buffer[:]) == 0
+    buffer.extend(_frames(3))
+    assert buffer[2:2].shape == (0, 6, 5, 3)
+
+
+def test_prefetch():
+    assert list(vm.prefetch(range(10), n_ahead=2)) == list(range(10))
+
+
+def test_prefetch_raises_errors_from_the_worker():
+    def items():
+        yield 1
+        raise OSError("read failed")
+
+    with pytest.raises(OSError, match="read failed"):
+        list(vm.prefetch(items(), n_ahead=1))
+
+
+def test_prefetch_worker_stops_when_closed():
+    threads = set(threading.enumerate())
+    read = []
+
+    def items():
+        for i in range(100):
+            read.append(i)
+            yield i
+
+    steps = vm.prefetch(items(), n_ahead=1)
+    assert next(steps) == 0
+    time.sleep(0.2)  # the worker is blocked on a full queue now
+    steps.close()
+    assert set(threading.enumerate()) == threads
+    assert len(read) <= 3
@@ -0,0 +1,245 @@
+import hashlib
+import io
+import json
+import os
+import pickle
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from jupyter_magics import save_load
+
+
+def _obj():
+    rng = np.random.default_rng(0)
+    return {
+        "big": rng.standard_normal((512, 300)),  # kept out of band
+        "small": np.arange(10),
+        "text": "hello",
+    }
+
+
+def _assert_same(a, b):
+    assert a.keys() == b.keys()
+    np.testing.assert_array_equal(a["big"], b["big"])
+    np.testing.assert_array_equal(a["small"], b["small"])
+    assert a["text"] == b["text"]
+
+
+@pytest.mark.parametrize("codec", list(save_load.CODECS))
+def test_dump_load_round_trip(codec):
+    f = io.BytesIO()
+    save_load._dump(_obj(), f, codec, n_threads=3)
+    header = save_load._read_header(f)
+    assert header["codec"] == codec
+    assert len(header["buffers"]) == 1
+    _assert_same(save_load._load(f, n_threads=3), _obj())
+
+
+def test_dump_splits_into_chunks():
+    array = np.random.default_rng(0).standard_normal(1_300_000)  # 10.4 MB
+    f = io.BytesIO()
+    save_load._dump(array, f, "zlib", n_threads=4)
+    # chunks are 4 MiB
+    assert len(save_load._read_header(f)["buffers"][0]["chunks"]) == 3
+    np.testing.assert_array_equal(save_load._load(f, n_threads=4), array)
+
+
+def test_save_and_load_magics(tmp_path):
+    path = str(tmp_path / "obj")
+    save_load.save(f"-c zlib obj {path}", {"obj": _obj()})
+    _assert_same(save_load.load(path), _obj())
+
+
+def test_load_detects_plain_pickles(tmp_path):
+    path = tmp_path / "old.pkl"
+    path.write_bytes(pickle.dumps(_obj()))
+    _assert_same(save_load.load(str(path)), _obj())
+
+
+@pytest.mark.parametrize("codec", ["zlib", "none"])
+def test_load_files_without_buffer_codec(tmp_path, codec):
+    # files written before `%save --mmap` existed have no "buffer_codec"
+    f = io.BytesIO()
+    save_load._dump(_obj(), f, codec)
+    header = save_load._read_header(f)
+    footer_size = (
+        len(json.dumps(header)) + save_load._HEADER_LEN.size + len(save_load._MAGIC)
+    )
+    del header["buffer_codec"]
+    header = json.dumps(header).encode()
+    path = tmp_path / "old.pkl"
+    path.write_bytes(
+        f.getvalue()[:-footer_size]
+        + header
+        + save_load._HEADER_LEN.pack(len(header))
+        + save_load._MAGIC
+    )
+    with open(path, "rb") as f:
+        _assert_same(save_load._load(f), _obj())
+        if codec == "none":
+            _assert_same(save_load._load(f, mmap=True), _obj())
+
+
+def test_dedup_versions(tmp_path):
+    path = str(tmp_path / "store")
+    obj = _obj()
+    assert save_load.save(f"--dedup obj {path}", {"obj": obj}) == 1
+    obj["text"] = "changed"
+    assert save_load.save(f"--dedup obj {path}", {"obj": obj}) == 2
+    assert save_load.load(f"{path}@1")["text"] == "hello"
+    assert save_load.load(path)["text"] == "changed"
+
+
+def test_load_paths_containing_at(tmp_path):
+    obj = _obj()
+    save_load.save(f"obj {tmp_path}/user@host", {"obj": obj})
+    _assert_same(save_load.load(f"{tmp_path}/user@host.pkl"), obj)
+    save_load.save(f"obj {tmp_path}/run@3", {"obj": obj})
+    _assert_same(save_load.load(f"{tmp_path}/run@3"), obj)
+
+
+@pytest.mark.parametrize(
+    "fork",
+    [
+        False,
+        pytest.param(
+            True,
+            marks=pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork"),
+        ),
+    ],
+)
+def test_save_async(tmp_path, fork):
+    obj = _obj()
+    fork_option = "--fork" if fork else ""
+    handle = save_load.save(f"--async {fork_option} obj {tmp_path}/obj", {"obj": obj})
+    obj["big"][:] = 0  # the snapshot was taken already
+    assert handle.wait(timeout=30) is None
+    assert handle.status == "done" and handle.progress == 1.0
+    _assert_same(save_load.load(f"{tmp_path}/obj"), _obj())
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="needs os.fork")
+def test_forked_save_is_reaped_if_reading_its_messages_fails(tmp_path, monkeypatch):
+    pids = []
+    fork = os.fork
+
+    def record_fork():
+        pid = fork()
+        pids.append(pid)
+        return pid
+
+    def bad_loads(line):
+        raise ValueError("bad message")
+
+    monkeypatch.setattr(save_load.os, "fork", record_fork)
+    monkeypatch.setattr(save_load.json, "loads", bad_loads)
+    handle = save_load._save_async(_obj(), "obj", str(tmp_path / "obj"), fork=True)
+    with pytest.raises(RuntimeError, match="bad message"):
+        handle.wait(timeout=30)
+    with pytest.raises(ChildProcessError):  # already reaped
+        os.waitpid(pids[0], os.WNOHANG)
+
+
+def test_async_saves_through_a_symlink_are_ordered(tmp_path, monkeypatch):
+    os.symlink(tmp_path, tmp_path / "link")
+    release = threading.Event()
+    write_snapshot = save_load._write_snapshot
+
+    def slow_write_snapshot(*args):
+        release.wait(timeout=30)
+        return write_snapshot(*args)
+
+    monkeypatch.setattr(save_load, "_write_snapshot", slow_write_snapshot)
+    first = save_load._save_async(1, "x", str(tmp_path / "link" / "x.pkl"))
+    monkeypatch.setattr(save_load, "_write_snapshot", write_snapshot)
+    second = save_load._save_async(2, "x", str(tmp_path / "x.pkl"))
+    time.sleep(0.2)
+    assert not second.done()  # waits for the earlier save to commit first
+    release.set()
+    first.wait(timeout=30)
+    second.wait(timeout=30)
+    assert save_load.load(str(tmp_path / "x.pkl")) == 2
+    assert not save_load._last_save_to_path
+
+
+def test_finished_save_handles_are_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(save_load, "_save_handles", [])
+    for i in range(save_load._MAX_FINISHED_HANDLES + 5):
+        save_load._save_async(i, "x", str(tmp_path / f"{i}.pkl")).wait(timeout=30)
+    save_load._save_async(0, "x", str(tmp_path / "last.pkl")).wait(timeout=30)
+    assert len(save_load._save_handles) == save_load._MAX_FINISHED_HANDLES + 1
+    assert save_load._save_handles[-1].path.endswith("last.pkl")
+
+
+def test_cell_inputs_outputs():
+    code = "y = x + 1\nimport os\nx.append(y)\nz = sorted(y)\n"
+    inputs, outputs = save_load._cell_inputs_outputs(code)
+    assert inputs == ["x", "sorted"]  # y is assigned before it's read
+    assert outputs == ["y", "os", "x", "z"]
+
+
+def _function(source: str, fname: str):
+    namespace = {}
+    exec(compile(source, fname, "exec"), namespace)
+    return namespace["f"]
+
+
+def _hash(value) -> str:
+    hasher = hashlib.blake2b(digest_size=16)
+    assert save_load._hash_value(value, hasher)
+    return hasher.hexdigest()
+
+
+def test_function_hashes_ignore_where_they_were_defined():
+    source = "def f(x, n=2):\n    return [x ** n for _ in {'a', 'b'}]\n"
+    f = _function(source, "<cell 1>")
+    moved = _function("\n\n" + source, "<cell 7>")  # e.g. after a restart
+    assert _hash(f) == _hash(moved)
+    assert _hash(f) != _hash(_function(source.replace("n=2", "n=3"), "<cell 1>"))
+    assert _hash(f) != _hash(_function(source.replace("x **", "x *"), "<cell 1>"))
+
+
+def test_cache_magic(shell, tmp_path, monkeypatch):
+    cache_dir = str(tmp_path)
+    monkeypatch.setattr(
+        save_load, "_cache_stats", dict.fromkeys(save_load._cache_stats, 0)
+    )
+    shell.user_ns["x"] = 1
+    cell = f"%%cache -d {cache_dir} y\ny = x + 1"
+    shell.run_cell(cell)
+    del shell.user_ns["y"]
+    shell.run_cell(cell)
+    assert shell.user_ns["y"] == 2
+    assert save_load._cache_stats["hits"] == 1
+
+    shell.user_ns["x"] = 2
+    shell.run_cell(cell)
+    assert shell.user_ns["y"] == 3
+    assert save_load._cache_stats["misses"] == 2
+
+
+def test_cell_inputs_include_augmented_assignments():
+    code = "total += x\ncounts['a'] += 1\nobj.n -= 1\nnew = 0\nnew += 1\n"
+    inputs, outputs = save_load._cell_inputs_outputs(code)
+    assert inputs == ["total", "x", "counts", "obj"]  # new is assigned first
+    assert outputs == ["total", "counts", "obj", "new"]
+
+
+def test_cache_magic_with_an_augmented_assignment(shell, tmp_path):
+    shell.user_ns.update(total=0, x=1)
+    cell = f"%%cache -d {tmp_path} acc\ntotal += x"
+    shell.run_cell(cell)
+    assert shell.user_ns["total"] == 1
+    shell.user_ns["total"] = 100
+    shell.run_cell(cell)
+    assert shell.user_ns["total"] == 101
+
+
+def test_cache_max_gb_zero_evicts_everything(shell, tmp_path):
+    shell.user_ns["x"] = 1
+    shell.run_cell(f"%%cache -d {tmp_path} --max-gb 0 y\ny = x + 1")
+    assert shell.user_ns["y"] == 2
+    assert not list(tmp_path.glob("*.pkl"))
@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+
+from jupyter_magics import test_magic
+
+
+@pytest.fixture
+def magics(shell, tmp_path):
+    magics = test_magic.TestMagics(shell)
+    magics.set_test_path(str(tmp_path / "test_generated.py"))
+    return magics
+
+
+def _run_tests(magics, **namespace) -> dict:
+    """
+    Run each test in the generated file with `namespace` as its globals.
+    :returns: the generated file's globals
+    """
+    path = magics.test_path
+    namespace["__file__"] = str(path)
+    exec(compile(path.read_text(), str(path), "exec"), namespace)
+    for name, value in list(namespace.items()):
+        if name.startswith("test_"):
+            value()
+    return namespace
+
+
+def test_add_binary_test_evaluates_the_call_once(magics, shell):
+    calls = []
+
+    def scale(x, factor=1.0):
+        calls.append(x)
+        return {"scaled": x * factor, "n": len(x)}
+
+    x = np.linspace(0, 1, 1000)
+    shell.user_ns.update(scale=scale, x=x)
+    result = magics.add_test("--binary --rtol 1e-5 scale(x, factor=0.5)")
+    assert len(calls) == 1
+    np.testing.assert_array_equal(result["scaled"], x * 0.5)
+
+    source = magics.test_path.read_text()
+    assert "rtol=1e-05" in source and "factor = 0.5" in source
+    assert len(list((magics.test_path.parent / "fixtures").iterdir())) == 2
+    _run_tests(magics, scale=scale)
+    with pytest.raises(AssertionError):
+        _run_tests(magics, scale=lambda x, factor: {"scaled": x, "n": len(x)})
+
+
+def test_add_binary_test_shares_fixtures(magics, shell):
+    shell.user_ns.update(double=lambda x: x * 2, x=np.arange(100), y=np.arange(100))
+    magics.add_test("-b double(x)")
+    magics.add_test("-b double(y)")
+    source = magics.test_path.read_text()
+    # the helpers are only written once and the second test is renamed
+    assert source.count("def _load_fixture(") == 1
+    assert "def test_double_2():" in source
+    assert len(list((magics.test_path.parent / "fixtures").iterdir())) == 2
+    _run_tests(magics, double=lambda x: x * 2)
+
+
+def test_add_binary_test_rejects_other_expressions(magics):
+    with pytest.raises(test_magic.UsageError):
+        magics.add_test("-b 1 + 2")
+    with pytest.raises(test_magic.UsageError):
+        magics.add_test("-b f(*args)")
+
+
+def test_add_test_rejects_tolerances_without_binary(magics):
+    with pytest.raises(test_magic.UsageError, match="--binary"):
+        magics.add_test("--rtol 1e-3 f(1)")
+    assert not magics.test_path.exists()
+
+
+def test_binary_fixtures_are_copy_on_write(magics, shell):
+    shell.user_ns.update(total=np.sum, x=np.arange(1000))
+    magics.add_test("-b total(x)")
+    namespace = _run_tests(magics, total=np.sum)
+    (name,) = [p.name for p in magics.test_path.parent.glob("fixtures/*.npy")]
+    x = namespace["_load_fixture"](name)
+    assert isinstance(x, np.memmap)
+    x[0] = 5  # doesn't change the file
+    assert namespace["_load_fixture"](name)[0] == 0
+
+
+def test_add_benchmark(magics, shell, monkeypatch):
+    shell.user_ns.update(total=np.sum, x=np.arange(1000))
+    baseline = magics.add_benchmark("-r 3 -t 0.25 total(x)")
+    assert baseline["seconds"] > 0
+    source = magics.test_path.read_text()
+    assert "np.array(_load_fixture(" in source
+    assert "threshold=0.25" in source
+    magics.add_benchmark("total(x)")
+    source = magics.test_path.read_text()
+    assert source.count("def _measure(") == 1
+    assert "def test_benchmark_total_2():" in source
+
+    monkeypatch.setenv("BENCHMARK_THRESHOLD", "100")  # don't fail on a busy machine
+    _run_tests(magics, total=np.sum)
+    monkeypatch.setenv("BENCHMARK_THRESHOLD", "-1")
+    with pytest.raises(AssertionError, match="baseline"):
+        _run_tests(magics, total=np.sum)
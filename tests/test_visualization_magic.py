@@ -0,0 +1,336 @@
+import io
+import os
+import sys
+import time
+import types
+
+import numpy as np
+import pytest
+
+from jupyter_magics import visualization_magic as vm
+
+
+def _float_frames(n_frames: int, height: int = 6, width: int = 5) -> np.ndarray:
+    return np.random.default_rng(0).random((n_frames, 3, height, width), np.float32)
+
+
+def test_normalize_imgs_layouts():
+    frames = _float_frames(4)
+    expected = np.round(frames.transpose(0, 2, 3, 1) * 255).astype(np.uint8)
+    np.testing.assert_array_equal(vm.normalize_imgs(frames), expected)
+    np.testing.assert_array_equal(vm.normalize_imgs(list(frames)), expected)
+    out = np.empty_like(expected)
+    assert vm.normalize_imgs(frames, out=out) is out
+    gray = vm.normalize_imgs(np.zeros((2, 1, 6, 5), np.uint8))
+    assert gray.shape == (2, 6, 5)
+    with pytest.raises(ValueError):
+        vm.normalize_imgs([])
+
+
+def test_recorder_converts_single_frames_like_batches():
+    frames = _float_frames(3)
+    single = vm.Recorder(backend="mpl")
+    for frame in frames:
+        single.add_frame(frame)
+    batched = vm.Recorder(backend="mpl")
+    batched.add_frames(frames)
+    assert all(frame.dtype == np.uint8 for frame in single.frames)
+    np.testing.assert_array_equal(np.stack(single.frames), np.stack(batched.frames))
+
+
+class _FailingWriter:
+    def __init__(self, fname, frame_shape, fps):
+        self.frames = []
+
+    def write(self, frames):
+        self.frames.extend(frames)
+
+    def close(self):
+        raise RuntimeError("ffmpeg failed")
+
+
+def test_recorder_reports_errors_closing_the_encoder(monkeypatch, tmp_path):
+    monkeypatch.setattr(vm, "_FFmpegWriter", _FailingWriter)
+    recorder = vm.Recorder(backend="ffmpeg", fname=str(tmp_path / "video.mp4"))
+    recorder.add_frames(_float_frames(3))
+    with pytest.raises(RuntimeError, match="Encoding the video failed"):
+        recorder.to_video()  # used to hang waiting for the encoder thread
+    assert not recorder._encoder_thread.is_alive()
+
+
+class _FakeWriter:
+    """Writes a placeholder file instead of running ffmpeg."""
+
+    instances = []
+
+    def __init__(self, fname, frame_shape, fps):
+        self.fname = fname
+        self.killed = False
+        with open(fname, "wb") as f:
+            f.write(b"partial")
+        self.instances.append(self)
+
+    def write(self, frames):
+        pass
+
+    def close(self):
+        with open(self.fname, "ab") as f:
+            f.write(b" video")
+
+    def kill(self):
+        self.killed = True
+
+
+@pytest.fixture
+def fake_writer(monkeypatch, tmp_path):
+    monkeypatch.setattr(vm, "_FFmpegWriter", _FakeWriter)
+    monkeypatch.setattr(_FakeWriter, "instances", [])
+    monkeypatch.chdir(tmp_path)
+    return _FakeWriter
+
+
+def test_recorder_only_keeps_videos_too_large_to_embed(fake_writer, tmp_path):
+    recorder = vm.Recorder(backend="ffmpeg")
+    recorder.add_frames(_float_frames(2))
+    video = recorder.to_video()
+    assert video.embed and video.data == b"partial video"
+    assert not os.path.exists(recorder.fname)
+    assert not (tmp_path / vm.Recorder.video_dir).exists()
+
+    recorder = vm.Recorder(backend="ffmpeg", max_inline_mb=0)
+    recorder.add_frames(_float_frames(2))
+    recorder.to_video()
+    assert os.path.dirname(recorder.fname) == vm.Recorder.video_dir
+    assert (tmp_path / recorder.fname).read_bytes() == b"partial video"
+
+
+def test_anim_cleans_up_when_the_cell_fails(shell, fake_writer):
+    shell.user_ns["np"] = np
+    result = shell.run_cell(
+        '%%anim backend="ffmpeg"\n%anim np.zeros((4, 4, 3), np.uint8)\n1 / 0'
+    )
+    assert isinstance(result.error_in_exec, ZeroDivisionError)
+    assert "_recorder" not in shell.user_ns
+    (writer,) = fake_writer.instances
+    assert writer.killed
+    assert not os.path.exists(writer.fname)
+
+
+def test_rate_limited_updater_copies_frames():
+    shown = []
+    updater = vm._RateLimitedUpdater(shown.append, max_fps=1000)
+    frame = np.zeros((2, 2), np.uint8)
+    updater(frame)
+    frame[:] = 1  # e.g. an environment reusing its observation buffer
+    updater.flush()
+    updater.close()
+    np.testing.assert_array_equal(shown[-1], 0)
+
+
+def test_img_stops_the_previous_display_thread(shell, no_display):
+    pytest.importorskip("holoviews")
+    shell.register_magics(vm.Vis)
+    magics = shell.magics_manager.registry["Vis"]
+    shell.user_ns["np"] = np
+    shell.run_cell("%img np.zeros((4, 4, 3), np.uint8)").raise_error()
+    shell.run_cell("%img -c np.ones((4, 4, 3), np.uint8)").raise_error()
+    updater = magics.vis.update
+    assert updater._thread.is_alive()
+    shell.run_cell("%img np.zeros((4, 4), np.uint8)").raise_error()
+    assert not updater._thread.is_alive()
+    assert magics.vis.update is not updater
+
+
+class _FakeCv2:
+    IMWRITE_JPEG_QUALITY = IMWRITE_WEBP_QUALITY = IMWRITE_PNG_COMPRESSION = 0
+
+    def __init__(self):
+        self.encoded = []
+
+    def imencode(self, ext, frame, params):
+        self.encoded.append(frame)
+        return True, np.frombuffer(b"data", np.uint8)
+
+
+@pytest.mark.parametrize(
+    "image_format, n_channels, expected",
+    [("png", 3, [3, 2, 1]), ("png", 4, [3, 2, 1, 4]), ("jpeg", 4, [3, 2, 1])],
+)
+def test_frame_encoder_passes_cv2_bgr(image_format, n_channels, expected):
+    pytest.importorskip("PIL")
+    encoder = vm._FrameEncoder(image_format)
+    encoder._cv2 = cv2 = _FakeCv2()
+    frame = np.broadcast_to(
+        np.arange(1, n_channels + 1, dtype=np.uint8), (2, 2, n_channels)
+    )
+    assert encoder.encode(frame) == b"data"
+    assert cv2.encoded[0][0, 0].tolist() == expected
+    assert encoder.encode(frame) is None  # unchanged
+
+
+@pytest.mark.parametrize("image_format", ["jpeg", "png", "webp"])
+def test_frame_encoder_with_pil(image_format):
+    Image = pytest.importorskip("PIL.Image")
+    encoder = vm._FrameEncoder(image_format, quality=100)
+    encoder._cv2 = None
+    frame = np.zeros((8, 8, 4), np.uint8)
+    frame[..., 0] = 255  # red
+    frame[..., 3] = 255
+    data = encoder.encode(frame)
+    decoded = np.array(Image.open(io.BytesIO(data)).convert("RGB"))
+    assert decoded[..., 0].min() > 200 and decoded[..., 2].max() < 50
+
+
+def test_frame_encoder_needs_cv2_or_pil(monkeypatch):
+    monkeypatch.setitem(sys.modules, "cv2", None)  # makes importing it fail
+    monkeypatch.setattr(vm.importlib.util, "find_spec", lambda name: None)
+    with pytest.raises(RuntimeError, match="requires cv2 or PIL"):
+        vm._FrameEncoder()
+
+
+@pytest.mark.parametrize(
+    "frame",
+    [
+        np.full((4, 5), 0.5, np.float32),  # gray, float
+        np.full((4, 5, 1), 128, np.uint8),
+        np.stack([np.full((4, 5), c, np.uint8) for c in (1, 2, 3, 255)], axis=2),
+    ],
+)
+def test_to_bgr(frame):
+    bgr = vm._to_bgr(frame)
+    assert bgr.shape == (4, 5, 3) and bgr.dtype == np.uint8
+    assert bgr.flags.c_contiguous
+    if frame.ndim == 3 and frame.shape[2] == 4:
+        assert bgr[0, 0].tolist() == [3, 2, 1]
+    else:
+        assert (bgr == 128).all()
+
+
+class _FakeVideoWriter:
+    def __init__(self, fname, fourcc, fps, size):
+        self.size = size
+        self.frames = []
+        _FakeVideoWriter.instance = self
+
+    def write(self, frame):
+        assert frame.shape[:2][::-1] == self.size
+        self.frames.append(frame)
+
+    def release(self):
+        pass
+
+
+def test_save_video_with_cv2_converts_frames(monkeypatch):
+    cv2 = types.SimpleNamespace(
+        VideoWriter_fourcc=lambda *chars: 0, VideoWriter=_FakeVideoWriter
+    )
+    monkeypatch.setitem(sys.modules, "cv2", cv2)
+    visualizer = vm.Visualizer(show=False, save_obs=True)
+    for _ in range(3):
+        visualizer(np.zeros((4, 6), np.float32))
+    visualizer.save_video("video.mp4")
+    frames = _FakeVideoWriter.instance.frames
+    assert len(frames) == 3 and frames[0].shape == (4, 6, 3)
+
+
+@pytest.mark.skipif(not vm.ffmpeg_path, reason="needs ffmpeg")
+def test_export_video_from_memory(tmp_path):
+    frames = [frame for frame in _float_frames(20, 16, 16).transpose(0, 2, 3, 1)]
+    fname = str(tmp_path / "video.mp4")
+    vm.export_video(frames, fname, n_workers=2, progress=False)
+    assert os.path.getsize(fname) > 0
+
+
+def test_throttle_sends_the_last_calls():
+    sent = []
+    throttle = vm._Throttle(lambda: sent.append(time.perf_counter()), 0.1)
+    for _ in range(10):
+        throttle()
+    assert len(sent) == 1  # the first call is sent right away
+    time.sleep(0.3)
+    assert len(sent) == 2  # the rest are sent together once the interval is over
+    assert sent[1] - sent[0] >= 0.09
+    throttle()
+    throttle.flush()
+    time.sleep(0.2)
+    assert len(sent) == 4  # flush cancels the scheduled send
+
+
+def test_updating_curve_draws_the_last_updates(monkeypatch):
+    hv = pytest.importorskip("holoviews")
+    sent = []
+    monkeypatch.setattr(hv.streams.Pipe, "send", lambda pipe, data: sent.append(data))
+    _, update = vm.updating_curve(max_fps=10)
+    for i in range(5):
+        update([i, i + 2])
+    time.sleep(0.3)  # no flush
+    assert sent[-1]["mean"].tolist() == [1, 2, 3, 4, 5]
+    assert sent[-1]["ub"].tolist() == [2, 3, 4, 5, 6]
+
+
+def test_updating_curve_without_error_plots_the_mean(monkeypatch):
+    hv = pytest.importorskip("holoviews")
+    sent = []
+    monkeypatch.setattr(hv.streams.Pipe, "send", lambda pipe, data: sent.append(data))
+    _, update = vm.updating_curve(plot_error=False)
+    update([1, 5])
+    update(4)
+    update.flush()
+    assert sent[-1]["mean"].tolist() == [3, 4]
+    assert "ub" not in sent[-1]
+
+
+def test_metrics_dashboard_draws_the_last_steps(monkeypatch, no_display):
+    hv = pytest.importorskip("holoviews")
+    sent = []
+    monkeypatch.setattr(hv.streams.Pipe, "send", lambda pipe, data: sent.append(data))
+    dashboard = vm.MetricsDashboard(max_fps=10)
+    for step in range(5):
+        dashboard.log(loss=1 / (step + 1), reward=step)
+    time.sleep(0.3)  # no flush
+    assert sent[-1]["reward"]["mean"].tolist() == [0, 1, 2, 3, 4]
+    assert len(sent[-1]["loss"]["mean"]) == 5
+
+    with pytest.raises(ValueError, match="accuracy"):
+        dashboard.log(loss=0.1, accuracy=0.9)
+    assert dashboard.series["loss"].n_points == 5
+
+
+def test_tile_compositor():
+    frames = np.arange(5 * 4 * 6 * 3, dtype=np.uint8).reshape(5, 4, 6, 3)
+    compositor = vm._TileCompositor(n_cols=2, downscale=2)
+    assert compositor.label_positions() == []  # before the first batch
+    canvas = compositor.compose(frames)
+    assert compositor.grid_shape == (3, 2) and compositor.tile_shape == (2, 3)
+    assert canvas.shape == (6, 6, 3)
+    np.testing.assert_array_equal(canvas[2:4, 3:], frames[3, ::2, ::2])
+    np.testing.assert_array_equal(canvas[4:, :3], frames[4, ::2, ::2])
+    assert not canvas[4:, 3:].any()  # 5 frames leave the last tile empty
+    # the canvas is reused while the batch shape stays the same
+    assert compositor.compose(frames[::-1]) is canvas
+    np.testing.assert_array_equal(canvas[:2, :3], frames[4, ::2, ::2])
+    np.testing.assert_allclose(
+        compositor.label_positions(),
+        [(1.5, 5.8), (4.5, 5.8), (1.5, 3.8), (4.5, 3.8), (1.5, 1.8)],
+    )
+    gray = compositor.compose(frames[:3, ..., 0])
+    assert gray.shape == (4, 6) and gray is not canvas
+
+
+def test_multi_visualizer_sends_copies_of_the_canvas(monkeypatch, no_display):
+    pytest.importorskip("holoviews")
+    sent = []
+    send = vm.hv.streams.Pipe.send
+
+    def record_send(pipe, data):
+        sent.append(data)
+        send(pipe, data)
+
+    monkeypatch.setattr(vm.hv.streams.Pipe, "send", record_send)
+    batches = np.random.default_rng(0).integers(0, 256, (3, 4, 2, 2, 3), np.uint8)
+    visualizer = vm.Visualizer(multi=True, n_cols=2)
+    for batch in batches:
+        visualizer(batch)
+    assert len(sent) == 2 and sent[0] is not sent[1]
+    np.testing.assert_array_equal(sent[0][:2, :2], batches[1][0])
+    np.testing.assert_array_equal(sent[1][:2, :2], batches[2][0])